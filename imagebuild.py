@@ -15,8 +15,51 @@ import errno
 import glob
 import configparser
 import datetime
+import time
 import argparse
+import shutil
+import struct
+import hashlib
+import copy
+import concurrent.futures
+import traceback
+import json
+import urllib.request
+import xml.etree.ElementTree
+import tarfile
+import stat
+import threading
+import collections
+import zlib
+import fnmatch
+import gzip
+import lzma
+import bz2
+import contextlib
+import functools
+import resource
+import selectors
+import signal
+import multiprocessing
+import fcntl
+import io
+import socket
+import socketserver
+import http.client
+import urllib.parse
+import sqlite3
+import random
+import statistics
+import tempfile
 from distutils.version import LooseVersion
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+try:
+  from yaml import CSafeLoader as YamlLoader
+except ImportError:
+  from yaml import SafeLoader as YamlLoader
 
 class ShellConfig:
 
@@ -67,6 +110,160 @@ class DictToObject:
 
 
 
+class RunResult:
+  def __init__(self, returncode, tail, output=None, log_file=None, timed_out=False, cancelled=False):
+    self.returncode = returncode
+    self.tail       = tail
+    self.output     = output
+    self.log_file   = log_file
+    self.timed_out  = timed_out
+    self.cancelled  = cancelled
+
+
+class ProcessRunner:
+  # Runs every external command: output is read in large chunks through a selector,
+  # written completely to a log file and only a bounded tail is kept in memory.
+  # Commands run in their own process group, which is killed on timeout or cancel.
+  def __init__(self, log_dir=None, timeout=None, idle_timeout=None, echo=True, tail_size=64*1024):
+    self.log_dir      = log_dir
+    self.deadline     = time.time() + timeout if timeout else None
+    self.idle_timeout = idle_timeout
+    self.echo         = echo
+    self.tail_size    = tail_size
+    self.cancelled    = threading.Event()
+    self.processes    = set()
+    self.lock         = threading.Lock()
+
+  def cancel(self):
+    self.cancelled.set()
+    with self.lock:
+      for process in list(self.processes):
+        self.kill(process)
+
+  def kill(self, process, grace=5.0):
+    for sig in [ signal.SIGTERM, signal.SIGKILL ]:
+      try:
+        os.killpg(process.pid, sig)
+      except (ProcessLookupError, PermissionError):
+        return
+      try:
+        process.wait(grace)
+        return
+      except subprocess.TimeoutExpired:
+        pass
+
+  def log_file(self, name):
+    if self.log_dir is None or name is None:
+      return None
+    PackageManagerBase().mkdir_p(self.log_dir)
+    return os.path.join(self.log_dir, re.sub(r'[^A-Za-z0-9_.-]+', '-', name)+".log")
+
+  def run(self, cmd, name=None, env=None, cwd=None, timeout=None, output_callback=None, stdin_writer=None, capture=False, echo=None):
+    if echo is None:
+      echo = self.echo
+    if self.cancelled.is_set():
+      return RunResult(-1, b'', b'' if capture else None, cancelled=True)
+
+    log_file = self.log_file(name)
+    log      = open(log_file, "wb") if log_file is not None else None
+    stdin    = subprocess.PIPE if stdin_writer is not None else subprocess.DEVNULL
+    try:
+      process = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, cwd=cwd, start_new_session=True)
+    except OSError as exc:
+      if log is not None:
+        log.close()
+      message = (str(cmd[0])+": "+str(exc)+"\n").encode('utf-8')
+      if echo:
+        sys.stdout.write(message.decode('utf-8'))
+      return RunResult(127, message, message if capture else None, log_file)
+
+    with self.lock:
+      self.processes.add(process)
+
+    writer_errors = []
+    writer = None
+    if stdin_writer is not None:
+      def write_stdin():
+        try:
+          stdin_writer(process.stdin)
+          process.stdin.close()
+        except BrokenPipeError:
+          pass
+        except BaseException as exc:
+          writer_errors.append(exc)
+          # do not let the command see a truncated input
+          self.kill(process)
+      writer = threading.Thread(target=write_stdin)
+      writer.start()
+
+    tail      = collections.deque()
+    tail_len  = 0
+    output    = [] if capture else None
+    timed_out = False
+    limit     = time.time() + timeout if timeout else None
+    if self.deadline is not None:
+      limit = self.deadline if limit is None else min(limit, self.deadline)
+    last_output = time.time()
+    fd = process.stdout.fileno()
+
+    selector = selectors.DefaultSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    try:
+      while True:
+        if self.cancelled.is_set():
+          self.kill(process)
+          break
+        now = time.time()
+        if (limit is not None and now > limit) or (self.idle_timeout and now - last_output > self.idle_timeout):
+          print("Timeout: "+" ".join(str(c) for c in cmd))
+          timed_out = True
+          self.kill(process)
+          break
+        if len(selector.select(0.5)) == 0:
+          continue
+        data = os.read(fd, 256*1024)
+        if data == b'':
+          break
+        last_output = time.time()
+        if log is not None:
+          log.write(data)
+        if echo:
+          sys.stdout.flush()
+          sys.stdout.buffer.write(data)
+          sys.stdout.buffer.flush()
+        if capture:
+          output.append(data)
+        if output_callback is not None:
+          output_callback(data)
+        tail.append(data)
+        tail_len += len(data)
+        while tail_len - len(tail[0]) >= self.tail_size:
+          tail_len -= len(tail.popleft())
+    except BaseException:
+      self.kill(process)
+      raise
+    finally:
+      selector.close()
+      process.stdout.close()
+      process.wait()
+      if writer is not None:
+        writer.join()
+      if log is not None:
+        log.close()
+      with self.lock:
+        self.processes.discard(process)
+
+    if len(writer_errors) > 0:
+      raise writer_errors[0]
+    return RunResult(process.returncode, b''.join(tail)[-self.tail_size:], b''.join(output) if capture else None,
+                     log_file, timed_out, self.cancelled.is_set())
+
+  def print_tail(self, result, lines=20):
+    print("\n".join(result.tail.decode('utf-8', 'replace').splitlines()[-lines:]))
+    if result.log_file is not None:
+      print("Full output in "+result.log_file)
+
+
 class PackageManagerBase:
   def __init__(self):
     pass
@@ -171,20 +368,16 @@ class PackageManagerBase:
         else:
             raise
 
-  def execute2(self, cmd, home_dir):
+  def execute2(self, cmd, home_dir, output_callback=None, runner=None, name=None, timeout=None):
     my_env = os.environ.copy()
     # this setting is importent to get the ".rpmmacro" from a "home" directory of our choice
     my_env["HOME"] = home_dir
-    process  = subprocess.Popen(cmd,  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=my_env)
-
-    while True:
-      out = process.stdout.readline()
-      if out == b'' and process.poll() != None:
-        break
-      if out != b'':
-        print(out.decode('utf-8'), end="")
-
-    return process.returncode
+    if runner is None:
+      runner = ProcessRunner()
+    result = runner.run(cmd, name, env=my_env, timeout=timeout, output_callback=output_callback)
+    if result.returncode != 0 and not runner.echo:
+      runner.print_tail(result)
+    return result.returncode
 
 
 class AlpinePackageManager(PackageManagerBase):
@@ -195,10 +388,8 @@ class AlpinePackageManager(PackageManagerBase):
 class RedhatPackageManager(PackageManagerBase):
   def __init__(self):
     self.test = ""
-  def install_distribution(self):
-    self.test = ""
 
-  def create_package_manager_conf_file(self, package_manager, build_dir, http_proxy='', nodocs=''):
+  def create_package_manager_conf_file(self, package_manager, build_dir, http_proxy='', nodocs='', keepcache=0, cache_dir=None):
     array=[]
     array.append("[main]")
     array.append("gpgcheck=1")
@@ -206,10 +397,15 @@ class RedhatPackageManager(PackageManagerBase):
     array.append("clean_requirements_on_remove=true")
     # cachedir will be used when already running the "chroot" environment
     # thereforee there MUST NOT be a "build_dir" prefix
-    array.append("cachedir=/var/cache/"+package_manager+"/$basearch/$releasever")
+    if cache_dir is None:
+      cache_dir = "var/cache/"+package_manager
+    array.append("cachedir=/"+cache_dir+"/$basearch/$releasever")
     array.append("reposdir="+build_dir+"/etc/yum.repos.d")
     array.append("pluginconfpath="+build_dir+"/etc/"+package_manager+"/plugins")
-  
+    # keep downloaded packages, so they can be harvested into the shared package cache
+    if keepcache == 1:
+      array.append("keepcache=1")
+
 
     if nodocs == 1:
       array.append("tsflags=nodocs")
@@ -267,28 +463,39 @@ class RedhatPackageManager(PackageManagerBase):
     return result
  
 
-  def install_distribution(self, package_manager, target_os_version, install_root, repo_list, package_list, build_dir):
-    self.test=""
-    array=[]
-    array.append(package_manager)
-    array.append("-y")
-    array.append("-c")
-    array.append(build_dir+"/etc/"+package_manager+".conf")
-    array.append("--releasever="+str(target_os_version))
-    array.append("--nogpg")
-    array.append("--installroot="+install_root)
-    array.append("--disablerepo=*")
-    array.extend(["--enablerepo="+repo for repo in repo_list])
-    array.append("install")
-    array.extend(package_list)
-    return array
-
   def create_repo_url(self,repo_var,baseurl):
     if baseurl != "":
       return baseurl
     return "metalink=https://mirrors.fedoraproject.org/metalink?repo="+repo_var+"$releasever&arch=$basearch"
 
 
+  def repo_source(self, os_name, repo_short_name, repo_url={}):
+    # Where the metadata of a repository comes from, like it is written into the .repo files
+    if os_name == "fedora":
+      if repo_short_name in repo_url:
+        return "baseurl", repo_url[repo_short_name]
+      table = {
+        "fedora"          : "fedora-",
+        "updates"         : "updates-released-f",
+        "updates-testing" : "updates-testing-f",
+      }
+      if repo_short_name in table:
+        return "metalink", self.create_repo_url(table[repo_short_name], "").split("=", 1)[1]
+    elif os_name == "centos":
+      if repo_short_name in repo_url:
+        return "baseurl", repo_url[repo_short_name]
+      table = {
+        "centos-base"       : "os",
+        "centos-updates"    : "updates",
+        "centos-extras"     : "extras",
+        "centos-centosplus" : "centosplus",
+      }
+      if repo_short_name in table:
+        return "mirrorlist", "http://mirrorlist.centos.org/?release=$releasever&arch=$basearch&repo="+table[repo_short_name]+"&infra=$infra"
+    elif os_name == "alpine":
+      return "apk", repo_short_name
+    return None, None
+
   def install_yum_repo(self,repo_short_name, baseurl=""):
 
     if repo_short_name == "fedora":
@@ -316,7 +523,7 @@ class RedhatPackageManager(PackageManagerBase):
     result = "\n".join(array)
     return result
 
-  def install_yum_repo_centos(self):
+  def install_yum_repo_centos(self, repo_url={}):
     result = """
 [centos-base]
 name=CentOS-$releasever - Base
@@ -353,19 +560,16 @@ gpgcheck=1
 enabled=0
 gpgkey=file:///etc/pki/rpm-gpg/RPM-GPG-KEY-CentOS-7
 """
+    # a configured baseurl (e.g. a local snapshot) replaces the mirrorlist
+    for repo_name in repo_url:
+      pattern = r'(\[' + re.escape(repo_name) + r'\]\nname=[^\n]*\n)mirrorlist=[^\n]*\n'
+      result  = re.sub(pattern, lambda m: m.group(1) + "baseurl=" + repo_url[repo_name] + "\n", result)
     return result
 
-  def execute(self, cmd):
-#    print("HERE!")
-#    print(cmd)
-    process  = subprocess.Popen(cmd,  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    while True:
-      out = process.stdout.readline()
-      if out == b'' and process.poll() != None:
-        break
-      if out != b'':
-        print(out.decode('utf-8'), end="")
+  def execute(self, cmd, runner=None, name=None):
+    if runner is None:
+      runner = ProcessRunner()
+    return runner.run(cmd, name).returncode
 
 
   def current_dir(self):
@@ -382,37 +586,2631 @@ gpgkey=file:///etc/pki/rpm-gpg/RPM-GPG-KEY-CentOS-7
       shutil.copy(file, dest_dir)
 
 
-def merge_recursive(target, source):
+class RepoMetadata:
+  def __init__(self, os_version, http_proxy=''):
+    self.os_version = str(os_version)
+    self.http_proxy = http_proxy
+
+  def expand(self, url):
+    url = url.replace("$releasever", self.os_version)
+    url = url.replace("$basearch",   os.uname().machine)
+    url = url.replace("$infra",      "stock")
+    return url
+
+  def fetch(self, url, timeout=60):
+    handlers = []
+    if len(self.http_proxy) > 0:
+      handlers.append(urllib.request.ProxyHandler({ "http": self.http_proxy, "https": self.http_proxy }))
+    opener = urllib.request.build_opener(*handlers)
+    with opener.open(self.expand(url), timeout=timeout) as response:
+      return response.read()
+
+  def mirrors(self, kind, url):
+    if kind == "baseurl":
+      return [ self.expand(url) ]
+    content = self.fetch(url).decode('utf-8')
+    if kind == "mirrorlist":
+      return [ line.strip() for line in content.splitlines() if line.strip() != "" and not line.startswith("#") ]
+    if kind == "metalink":
+      mirrors = []
+      for element in xml.etree.ElementTree.fromstring(content).iter():
+        if element.tag.endswith("}url") and element.get("protocol") in ("https", "http"):
+          url = element.text.strip()
+          if url.endswith("/repodata/repomd.xml"):
+            url = url[:-len("/repodata/repomd.xml")]
+          mirrors.append(url)
+      return mirrors
+    return []
+
+  def fetch_to(self, url, filename, checksum=None, checksum_type="sha256", timeout=60):
+    handlers = []
+    if len(self.http_proxy) > 0:
+      handlers.append(urllib.request.ProxyHandler({ "http": self.http_proxy, "https": self.http_proxy }))
+    opener = urllib.request.build_opener(*handlers)
+    PackageManagerBase().mkdir_p(os.path.dirname(filename))
+    tmp = filename + ".tmp." + str(os.getpid()) + "." + str(threading.get_ident())
+    h = hashlib.new(checksum_type) if checksum is not None else None
+    try:
+      with opener.open(self.expand(url), timeout=timeout) as response, open(tmp, "wb") as f:
+        for block in iter(lambda: response.read(1024*1024), b''):
+          f.write(block)
+          if h is not None:
+            h.update(block)
+      if h is not None and h.hexdigest() != checksum:
+        raise ValueError("checksum mismatch for "+url)
+      os.replace(tmp, filename)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+    return filename
+
+  def parse_repomd(self, content):
+    # type -> location, checksum and size of the metadata files
+    result = {}
+    for data in xml.etree.ElementTree.fromstring(content):
+      if not data.tag.endswith("}data"):
+        continue
+      entry = { "type": data.get("type") }
+      for child in data:
+        if child.tag.endswith("}location"):
+          entry["href"] = child.get("href")
+        elif child.tag.endswith("}checksum"):
+          entry["checksum_type"] = child.get("type")
+          entry["checksum"]      = child.text.strip()
+        elif child.tag.endswith("}size"):
+          entry["size"] = int(child.text)
+      result[entry["type"]] = entry
+    return result
+
+  def repodata(self, kind, url, cache_dir, types):
+    # local paths of the metadata files of a repository, remote files are cached by checksum
+    last_error = None
+    for mirror in self.mirrors(kind, url):
+      base = mirror.rstrip("/")
+      if base.startswith("file://"):
+        path = base[len("file://"):]
+        with open(os.path.join(path, "repodata", "repomd.xml"), "rb") as f:
+          repomd = self.parse_repomd(f.read())
+        return base, dict((type, os.path.join(path, repomd[type]["href"])) for type in types if type in repomd)
+      try:
+        repomd = self.parse_repomd(self.fetch(base+"/repodata/repomd.xml"))
+        files = {}
+        for type in types:
+          if not type in repomd:
+            continue
+          entry = repomd[type]
+          filename = os.path.join(cache_dir, entry["checksum"] + "-" + os.path.basename(entry["href"]))
+          if not os.path.exists(filename):
+            self.fetch_to(base+"/"+entry["href"], filename, entry["checksum"], entry.get("checksum_type", "sha256"))
+          files[type] = filename
+        return base, files
+      except (OSError, ValueError) as exc:
+        last_error = exc
+    raise IOError("no usable mirror for "+url+": "+str(last_error))
+
+  def repomd_digest(self, kind, url):
+    # sha256 of the current repomd.xml (its revision changes with every compose)
+    if kind == "metalink":
+      content = self.fetch(url)
+      for element in xml.etree.ElementTree.fromstring(content).iter():
+        if element.tag.endswith("}file") and element.get("name") == "repomd.xml":
+          for hash in element.iter():
+            if hash.tag.endswith("}hash") and hash.get("type") == "sha256":
+              return hash.text.strip()
+      return None
+    if kind == "apk":
+      content = self.fetch(url.rstrip("/")+"/"+os.uname().machine+"/APKINDEX.tar.gz")
+      return hashlib.sha256(content).hexdigest()
+    for mirror in self.mirrors(kind, url):
+      content = self.fetch(mirror.rstrip("/")+"/repodata/repomd.xml")
+      return hashlib.sha256(content).hexdigest()
+    return None
+
+
+def open_compressed(filename):
+  if filename.endswith(".gz"):
+    return gzip.open(filename, "rb")
+  if filename.endswith(".xz"):
+    return lzma.open(filename, "rb")
+  if filename.endswith(".bz2"):
+    return bz2.open(filename, "rb")
+  if filename.endswith(".zst"):
+    if zstandard is None:
+      raise RuntimeError("reading "+filename+" needs the python zstandard module")
+    return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+  return open(filename, "rb")
+
+
+class PrimaryParser:
+  # Streams the packages of a primary.xml(.gz), memory stays flat with large repositories
+  def __init__(self, filename, dependencies=False):
+    self.filename     = filename
+    self.dependencies = dependencies
+
+  def packages(self):
+    with open_compressed(self.filename) as f:
+      context = xml.etree.ElementTree.iterparse(f, events=("end",))
+      for event, element in context:
+        if element.tag != "{http://linux.duke.edu/metadata/common}package":
+          continue
+        yield self.package(element)
+        element.clear()
+
+  def package(self, element):
+    package = {}
+    for child in element:
+      tag = child.tag.split("}")[1]
+      if tag in ("name", "arch"):
+        package[tag] = child.text
+      elif tag == "version":
+        package["epoch"]   = child.get("epoch", "0")
+        package["version"] = child.get("ver")
+        package["release"] = child.get("rel")
+      elif tag == "checksum":
+        package["checksum_type"] = child.get("type")
+        package["checksum"]      = child.text.strip()
+      elif tag == "size":
+        package["size"]      = int(child.get("package", 0))
+        package["installed"] = int(child.get("installed", 0))
+      elif tag == "location":
+        package["href"] = child.get("href")
+      elif tag == "format" and self.dependencies:
+        self.format(child, package)
+    return package
+
+  def format(self, element, package):
+    for child in element:
+      tag = child.tag.split("}")[1]
+      if tag in ("provides", "requires", "recommends"):
+        entries = []
+        for entry in child:
+          name = sys.intern(entry.get("name"))
+          if tag == "requires" and name.startswith("rpmlib("):
+            continue
+          flags = entry.get("flags")
+          if flags is None:
+            entries.append((name, None, None, None, None))
+          else:
+            entries.append((name, sys.intern(flags), entry.get("epoch", "0"), entry.get("ver"), entry.get("rel")))
+        package[tag] = entries
+      elif tag == "file":
+        package.setdefault("files", []).append(sys.intern(child.text))
+
+
+def rpmvercmp(a, b):
+  # version comparison of rpm (rpmvercmp.c), including ~ and ^
+  if a == b:
+    return 0
+  i = 0
+  j = 0
+  while i < len(a) or j < len(b):
+    while i < len(a) and not a[i].isalnum() and a[i] not in "~^":
+      i += 1
+    while j < len(b) and not b[j].isalnum() and b[j] not in "~^":
+      j += 1
+    if (i < len(a) and a[i] == "~") or (j < len(b) and b[j] == "~"):
+      if i >= len(a) or a[i] != "~":
+        return 1
+      if j >= len(b) or b[j] != "~":
+        return -1
+      i += 1
+      j += 1
+      continue
+    if (i < len(a) and a[i] == "^") or (j < len(b) and b[j] == "^"):
+      if i >= len(a):
+        return -1
+      if j >= len(b):
+        return 1
+      if a[i] != "^":
+        return 1
+      if b[j] != "^":
+        return -1
+      i += 1
+      j += 1
+      continue
+    if i >= len(a) or j >= len(b):
+      break
+    pattern  = rpmvercmp.digits if a[i].isdigit() else rpmvercmp.alpha
+    segment1 = pattern.match(a, i).group(0)
+    segment2 = pattern.match(b, j)
+    segment2 = segment2.group(0) if segment2 is not None else ""
+    i += len(segment1)
+    j += len(segment2)
+    if segment2 == "":
+      return 1 if pattern is rpmvercmp.digits else -1
+    if pattern is rpmvercmp.digits:
+      segment1 = segment1.lstrip("0")
+      segment2 = segment2.lstrip("0")
+      if len(segment1) != len(segment2):
+        return 1 if len(segment1) > len(segment2) else -1
+    if segment1 != segment2:
+      return 1 if segment1 > segment2 else -1
+  if i >= len(a) and j >= len(b):
+    return 0
+  return -1 if i >= len(a) else 1
+
+rpmvercmp.digits = re.compile(r'[0-9]+')
+rpmvercmp.alpha  = re.compile(r'[a-zA-Z]+')
+
+
+def compare_evr(evr1, evr2):
+  epoch1, version1, release1 = evr1
+  epoch2, version2, release2 = evr2
+  result = (int(epoch1 or 0) > int(epoch2 or 0)) - (int(epoch1 or 0) < int(epoch2 or 0))
+  if result != 0:
+    return result
+  result = rpmvercmp(version1 or "", version2 or "")
+  if result != 0 or not release1 or not release2:
+    return result
+  return rpmvercmp(release1, release2)
+
+
+def parse_size(value):
+  # "500M", "2G", "1048576"
+  units = { "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4 }
+  value = str(value).strip().upper().rstrip("B").rstrip("I")
+  if len(value) > 0 and value[-1] in units:
+    return int(float(value[:-1]) * units[value[-1]])
+  return int(value)
+
+
+def format_size(size):
+  for unit in [ "B", "KiB", "MiB", "GiB" ]:
+    if abs(size) < 1024 or unit == "GiB":
+      return ("%d " % size if unit == "B" else "%.1f " % size) + unit
+    size /= 1024.0
+
+
+class RichDependency:
+  # boolean dependencies like "(foo if bar)" or "(a or (b and c))"
+  tokens = re.compile(r'\(|\)|[^\s()]+')
+  operators = ("and", "or", "if", "else", "unless", "with", "without")
+
+  def __init__(self, text):
+    self.position = 0
+    self.items = self.tokens.findall(text)
+    self.tree = self.expression()
+
+  def expression(self):
+    token = self.items[self.position]
+    self.position += 1
+    if token != "(":
+      # simple dependency "name [op version]"
+      name = token
+      if self.position + 1 < len(self.items) and self.items[self.position] in ("=", "<", ">", "<=", ">="):
+        flags = { "=": "EQ", "<": "LT", ">": "GT", "<=": "LE", ">=": "GE" }[self.items[self.position]]
+        evr = self.items[self.position + 1]
+        self.position += 2
+        epoch = "0"
+        if ":" in evr:
+          epoch, evr = evr.split(":", 1)
+        version, release = (evr.split("-", 1) + [ None ])[:2]
+        return ("dep", (name, flags, epoch, version, release))
+      return ("dep", (name, None, None, None, None))
+    operands  = [ self.expression() ]
+    operators = []
+    while self.items[self.position] != ")":
+      operators.append(self.items[self.position])
+      self.position += 1
+      operands.append(self.expression())
+    self.position += 1
+    if len(operators) == 0:
+      return operands[0]
+    if operators[0] in ("if", "unless"):
+      result = (operators[0], operands[0], operands[1])
+      if len(operators) > 1 and operators[1] == "else":
+        result = result + (operands[2],)
+      return result
+    return (operators[0], operands)
+
+
+class Resolver:
+  # Dependency closure of a package list from the primary metadata of the repositories,
+  # similar to what dnf installs into an empty root
+  def __init__(self, arch=None, weak_deps=True):
+    machine = arch if arch is not None else os.uname().machine
+    self.arches    = set([ machine, "noarch" ])
+    if machine in ("i686", "i586", "i386"):
+      self.arches |= set([ "i386", "i586", "i686" ])
+    self.weak_deps = weak_deps
+    self.packages  = {}
+    self.provides  = {}
+    self.files     = {}
+    self.filelists = []
+    self.missing   = []
+    self.sources   = {}
+
+  def add_repo(self, repo_name, base_url, primary_file, filelists_file=None):
+    # only the newest version of every name.arch is used, like a fresh install does
+    count = 0
+    for package in PrimaryParser(primary_file, True).packages():
+      if not package["arch"] in self.arches:
+        continue
+      package["repo"]     = repo_name
+      package["base_url"] = base_url
+      key = (package["name"], package["arch"])
+      if key in self.packages and compare_evr(self.evr(self.packages[key]), self.evr(package)) >= 0:
+        continue
+      self.packages[key] = package
+      count += 1
+    if filelists_file is not None:
+      self.filelists.append(filelists_file)
+    self.index()
+    return count
+
+  def evr(self, package):
+    return (package["epoch"], package["version"], package["release"])
+
+  def nevra(self, package):
+    return package["name"]+"-"+package["epoch"]+":"+package["version"]+"-"+package["release"]+"."+package["arch"]
+
+  def index(self):
+    self.provides = {}
+    self.files    = {}
+    for package in self.packages.values():
+      for provide in package.get("provides", []):
+        self.provides.setdefault(provide[0], []).append((package, provide))
+      for filename in package.get("files", []):
+        self.files.setdefault(filename, []).append(package)
+
+  def overlap(self, provide, require):
+    # rpmdsCompare: do the version ranges of a provide and a require overlap
+    if require[1] is None or provide[1] is None:
+      return True
+    sense = compare_evr(provide[2:], require[2:])
+    pflags = provide[1]
+    rflags = require[1]
+    if sense < 0:
+      return pflags[0] == "G" or rflags[0] == "L"
+    if sense > 0:
+      return pflags[0] == "L" or rflags[0] == "G"
+    return (("E" in pflags or pflags == "LE" or pflags == "GE") and ("E" in rflags or rflags in ("LE", "GE"))) or \
+           (pflags[0] == "L" and rflags[0] == "L") or (pflags[0] == "G" and rflags[0] == "G")
+
+  def candidates(self, require):
+    name = require[0]
+    if name.startswith("/"):
+      result = list(self.files.get(name, []))
+      result.extend(package for package, provide in self.provides.get(name, []))
+      return result
+    return [ package for package, provide in self.provides.get(name, []) if self.overlap(provide, require) ]
+
+  def best(self, candidates, require):
+    # prefer the package named like the dependency, then the shortest name, then the newest
+    def key(package):
+      return (package["name"] != require[0], package["arch"] == "noarch", len(package["name"]), package["name"])
+    newest = sorted(candidates, key=functools.cmp_to_key(lambda a, b: compare_evr(self.evr(b), self.evr(a))))
+    return sorted(newest, key=key)[0]
+
+  def satisfied(self, require, selected):
+    return any(self.nevra(package) in selected for package in self.candidates(require))
+
+  def load_files(self, wanted):
+    # file dependencies outside of the primary file list need the filelists metadata
+    found = False
+    for filelists_file in self.filelists:
+      with open_compressed(filelists_file) as f:
+        for event, element in xml.etree.ElementTree.iterparse(f, events=("end",)):
+          if not element.tag.endswith("}package"):
+            continue
+          files = [ child.text for child in element if child.tag.endswith("}file") and child.text in wanted ]
+          if len(files) > 0:
+            version = [ child for child in element if child.tag.endswith("}version") ][0]
+            key = (element.get("name"), element.get("arch"))
+            package = self.packages.get(key)
+            if package is not None and package["version"] == version.get("ver") and package["release"] == version.get("rel"):
+              for filename in files:
+                self.files.setdefault(filename, []).append(package)
+                found = True
+          element.clear()
+    self.filelists = []
+    return found
+
+  def evaluate(self, tree, selected):
+    # returns the list of dependencies to add, or None if the condition does not apply yet
+    kind = tree[0]
+    if kind == "dep":
+      return [ tree[1] ]
+    if kind in ("and", "with"):
+      result = []
+      for operand in tree[1]:
+        result.extend(self.evaluate(operand, selected) or [])
+      return result
+    if kind == "or":
+      for operand in tree[1]:
+        if operand[0] == "dep" and self.satisfied(operand[1], selected):
+          return []
+      for operand in tree[1]:
+        if operand[0] != "dep" or len(self.candidates(operand[1])) > 0:
+          return self.evaluate(operand, selected)
+      return self.evaluate(tree[1][0], selected)
+    if kind in ("if", "unless"):
+      condition = tree[2]
+      applies = condition[0] == "dep" and self.satisfied(condition[1], selected)
+      if kind == "unless":
+        applies = not applies
+      if applies:
+        return self.evaluate(tree[1], selected)
+      if len(tree) > 3:
+        return self.evaluate(tree[3], selected)
+      return None
+    return []
+
+  def resolve(self, package_list):
+    selected = {}
+    queue    = []
+    deferred = []
+    self.missing = []
+
+    def require(dependency, origin):
+      if isinstance(dependency, str):
+        dependency = (dependency, None, None, None, None)
+      if dependency[0].startswith("("):
+        deferred.append((RichDependency(dependency[0]).tree, origin))
+        return
+      if self.satisfied(dependency, selected):
+        return
+      candidates = self.candidates(dependency)
+      if len(candidates) == 0:
+        self.missing.append((dependency, origin))
+        return
+      package = self.best(candidates, dependency)
+      selected[self.nevra(package)] = package
+      queue.append(package)
+
+    for name in package_list:
+      require(name, None)
+
+    while True:
+      while len(queue) > 0:
+        package = queue.pop()
+        for dependency in package.get("requires", []):
+          require(dependency, package["name"])
+        if self.weak_deps:
+          for dependency in package.get("recommends", []):
+            if dependency[0].startswith("(") or len(self.candidates(dependency)) > 0:
+              require(dependency, package["name"])
+
+      # conditional dependencies can become true by packages selected later
+      pending = []
+      for tree, origin in deferred:
+        dependencies = self.evaluate(tree, selected)
+        if dependencies is None:
+          pending.append((tree, origin))
+          continue
+        for dependency in dependencies:
+          require(dependency, origin)
+      deferred[:] = pending
+
+      missing_files = set(dependency[0] for dependency, origin in self.missing if dependency[0].startswith("/"))
+      if len(queue) == 0 and len(missing_files) > 0 and len(self.filelists) > 0:
+        missing = self.missing
+        self.missing = []
+        if self.load_files(missing_files):
+          for dependency, origin in missing:
+            require(dependency, origin)
+      if len(queue) == 0:
+        break
+
+    return sorted(selected.values(), key=lambda package: package["name"])
+
+  def report(self, packages):
+    download  = sum(package.get("size", 0) for package in packages)
+    installed = sum(package.get("installed", 0) for package in packages)
+    print(str(len(packages))+" packages, download size "+format_size(download)+", installed size "+format_size(installed))
+    for dependency, origin in self.missing:
+      print("Nothing provides "+dependency[0]+(" needed by "+origin if origin is not None else ""))
+    return download, installed
+
+  def load_configuration(self, configuration):
+    # repositories from repo_url, a local snapshot or the mirrors
+    target   = configuration['target']
+    work     = configuration['work']
+    metadata = RepoMetadata(target['os_version'], work.get('http_proxy', ''))
+    rpm      = RedhatPackageManager()
+    cache_dir = os.path.join(work['build_root'], "cache", "repodata")
+    for repo_name in target['repo_list']:
+      kind, url = rpm.repo_source(target['os_name'], repo_name, target.get('repo_url', {}))
+      if kind is None or kind == "apk":
+        continue
+      # dnf names its cache directory by the configured metalink, mirrorlist or baseurl
+      self.sources[repo_name] = metadata.expand(url)
+      base_url, files = metadata.repodata(kind, url, os.path.join(cache_dir, target['os_name']+"-"+str(target['os_version']), repo_name), [ "primary", "filelists" ])
+      count = self.add_repo(repo_name, base_url, files["primary"], files.get("filelists"))
+      print("Repository "+repo_name+": "+str(count)+" packages from "+base_url)
+
+  def warm_cache(self, packages, cache, metadata, package_manager, os_version, workers=8):
+    # download the packages into the package cache, and into the layout of the package manager
+    # cache, so the next install finds them ("<repoid>-<hash>" like dnf, "<repoid>" for yum)
+    backend = package_manager_backend(package_manager)
+    rpm = RedhatPackageManager()
+    tree = os.path.join(cache.tree_dir(package_manager), os.uname().machine, str(os_version))
+    def fetch(package):
+      blob = None
+      if package.get("checksum_type") == "sha256" and os.path.exists(cache.blob_path(package["checksum"])):
+        blob = cache.blob_path(package["checksum"])
+        downloaded = 0
+      else:
+        tmp_dir  = os.path.join(cache.cache_dir, "tmp")
+        filename = os.path.join(tmp_dir, os.path.basename(package["href"]) + "." + str(threading.get_ident()))
+        metadata.fetch_to(package["base_url"].rstrip("/")+"/"+package["href"], filename, package.get("checksum"), package.get("checksum_type", "sha256"))
+        blob = cache.store(filename)
+        os.remove(filename)
+        downloaded = package.get("size", 0)
+      package["blob"] = blob
+      repo_dir = package["repo"]
+      if backend.hashed_repo_dirs:
+        source = self.sources.get(package["repo"], package["base_url"])
+        repo_dir += "-" + hashlib.sha256(metadata.expand(source).encode('utf-8')).hexdigest()[:16]
+      target_dir = os.path.join(tree, repo_dir, "packages")
+      PackageManagerBase().mkdir_p(target_dir)
+      cache.link_or_copy(blob, os.path.join(target_dir, os.path.basename(package["href"])))
+      return downloaded
+    downloaded = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      for result in executor.map(fetch, packages):
+        downloaded += result
+    print("Package cache warmed: "+str(len(packages))+" packages, "+format_size(downloaded)+" downloaded")
+    return downloaded
+
+
+class LockFile:
+  # Exact package set of a profile, installed from the package cache without repository metadata
+  #   packages: [ { nevra, sha256, size, url } ]
+  def __init__(self, filename):
+    self.filename = filename
+
+  def inputs(self, target):
+    return {
+      "os_name"          : target['os_name'],
+      "os_version"       : str(target['os_version']),
+      "package_list"     : list(target['package_list']),
+      "package_list_add" : list(target.get('package_list_add', [])),
+    }
+
+  def write(self, target, packages):
+    content = self.inputs(target)
+    content["arch"]     = os.uname().machine
+    content["packages"] = []
+    for package in packages:
+      content["packages"].append({
+        "nevra"  : package["name"]+"-"+package["epoch"]+":"+package["version"]+"-"+package["release"]+"."+package["arch"],
+        "sha256" : os.path.basename(package["blob"]),
+        "size"   : package.get("size", 0),
+        "url"    : package["base_url"].rstrip("/")+"/"+package["href"],
+      })
+    tmp = self.filename + ".tmp"
+    with open(tmp, "w") as f:
+      yaml.dump(content, f, explicit_start=True, indent=2, default_flow_style=False)
+    os.replace(tmp, self.filename)
+    print("Lockfile "+self.filename+": "+str(len(packages))+" packages")
+
+  def load(self, target):
+    with open(self.filename) as f:
+      content = yaml.safe_load(f)
+    for key, value in self.inputs(target).items():
+      if str(content.get(key)) != str(value):
+        raise ValueError("lockfile "+self.filename+" is out of date ("+key+" changed), run: imagebuild.py lock")
+    return content["packages"]
+
+  def digest(self):
+    with open(self.filename, "rb") as f:
+      return hashlib.sha256(f.read()).hexdigest()
+
+  def fetch(self, target, cache, metadata, package_dir, workers=8):
+    # links the locked packages from the cache, missing ones are downloaded and verified
+    packages = self.load(target)
+    PackageManagerBase().mkdir_p(package_dir)
+    for filename in os.listdir(package_dir):
+      os.remove(os.path.join(package_dir, filename))
+    def fetch_package(package):
+      blob = cache.blob_path(package["sha256"])
+      if not os.path.exists(blob):
+        filename = os.path.join(cache.cache_dir, "tmp", os.path.basename(package["url"]) + "." + str(threading.get_ident()))
+        metadata.fetch_to(package["url"], filename, package["sha256"], "sha256")
+        size = os.path.getsize(filename)
+        cache.store(filename)
+        os.remove(filename)
+      else:
+        size = None
+      path = os.path.join(package_dir, os.path.basename(package["url"]))
+      cache.link_or_copy(blob, path)
+      return path, size
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(fetch_package, packages))
+    cache.hits   += sum(1 for path, size in results if size is None)
+    cache.misses += sum(1 for path, size in results if size is not None)
+    cache.downloaded_bytes += sum(size for path, size in results if size is not None)
+    return [ path for path, size in results ]
+
+
+class RepoSnapshot:
+  # Point in time copies of repositories below <build_root>/snapshots/<os>-<version>/<id>/<repo>.
+  # Packages are hardlinks to the package cache, so snapshots share unchanged packages.
+  def __init__(self, snapshot_root, os_name, os_version, http_proxy='', cache=None):
+    self.root       = os.path.join(snapshot_root, os_name + "-" + str(os_version))
+    self.os_name    = os_name
+    self.os_version = os_version
+    self.metadata   = RepoMetadata(os_version, http_proxy)
+    self.cache      = cache
+
+  def resolve(self, snapshot_id="latest"):
+    path = os.path.join(self.root, snapshot_id)
+    if snapshot_id in ("", "none") or not os.path.isdir(path):
+      return None, None
+    path = os.path.realpath(path)
+    return os.path.basename(path), path
+
+  def repo_url(self, snapshot_id, repo_list):
+    snapshot_id, path = self.resolve(snapshot_id)
+    repo_url = {}
+    if path is None:
+      return None, repo_url
+    for repo_name in repo_list:
+      repo_dir = os.path.join(path, repo_name)
+      if os.path.exists(os.path.join(repo_dir, "repodata", "repomd.xml")):
+        repo_url[repo_name] = "file://" + repo_dir
+    return snapshot_id, repo_url
+
+  def link_or_fetch(self, url, filename, previous, checksum, checksum_type):
+    # unchanged files are hardlinked from the previous snapshot
+    if previous is not None and os.path.exists(previous):
+      try:
+        os.link(previous, filename)
+        return
+      except OSError:
+        pass
+    self.metadata.fetch_to(url, filename, checksum, checksum_type)
+
+  def mirror_package(self, mirrors, repo_dir, package):
+    # the mirror of the metadata first, the other mirrors when it fails
+    filename = os.path.join(repo_dir, package["href"])
+    PackageManagerBase().mkdir_p(os.path.dirname(filename))
+    if package.get("checksum_type") == "sha256" and self.cache is not None:
+      blob = self.cache.blob_path(package["checksum"])
+      if os.path.exists(blob):
+        self.cache.link_or_copy(blob, filename)
+        return 0
+    last_error = None
+    for mirror in mirrors:
+      try:
+        self.metadata.fetch_to(mirror.rstrip("/")+"/"+package["href"], filename, package.get("checksum"), package.get("checksum_type", "sha256"))
+        break
+      except (OSError, ValueError) as exc:
+        last_error = exc
+    else:
+      raise IOError("no usable mirror for "+package["href"]+": "+str(last_error))
+    if self.cache is not None:
+      self.cache.link_or_copy(self.cache.store(filename), filename)
+    return package.get("size", 0)
+
+  def mirror_repo(self, repo_name, kind, url, repo_dir, previous_dir):
+    # the metadata; returns the mirrors (the one of the metadata first) and the repomd entries
+    last_error = None
+    mirrors = self.metadata.mirrors(kind, url)
+    for mirror in mirrors:
+      try:
+        content = self.metadata.fetch(mirror.rstrip("/")+"/repodata/repomd.xml")
+      except OSError as exc:
+        last_error = exc
+        continue
+      PackageManagerBase().mkdir_p(os.path.join(repo_dir, "repodata"))
+      with open(os.path.join(repo_dir, "repodata", "repomd.xml"), "wb") as f:
+        f.write(content)
+      repomd = self.metadata.parse_repomd(content)
+      for entry in repomd.values():
+        previous = os.path.join(previous_dir, repo_name, entry["href"]) if previous_dir is not None else None
+        self.link_or_fetch(mirror.rstrip("/")+"/"+entry["href"], os.path.join(repo_dir, entry["href"]), previous, entry.get("checksum"), entry.get("checksum_type", "sha256"))
+      return [ mirror ] + [ other for other in mirrors if other != mirror ], repomd
+    raise IOError("no usable mirror for "+repo_name+": "+str(last_error))
+
+  def mirror_packages(self, repo_name, mirrors, repo_dir, selected):
+    downloaded = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+      futures = [ executor.submit(self.mirror_package, mirrors, repo_dir, package) for package in selected ]
+      for future in concurrent.futures.as_completed(futures):
+        downloaded += future.result()
+    print("Snapshot "+repo_name+": "+str(len(selected))+" packages, "+str(downloaded)+" bytes downloaded from "+mirrors[0])
+
+  def select_packages(self, repos, packages, package_lists):
+    # repo name -> packages to mirror: "closure" the dependency closures of the package lists,
+    # resolved from the metadata of the snapshot; "all" every package; "none" only metadata
+    selected = { repo_name: [] for repo_name in repos }
+    if packages == "all":
+      for repo_name, (mirrors, repomd, repo_dir) in repos.items():
+        if "primary" in repomd:
+          selected[repo_name] = list(PrimaryParser(os.path.join(repo_dir, repomd["primary"]["href"])).packages())
+    elif packages == "closure":
+      resolver = Resolver()
+      for repo_name, (mirrors, repomd, repo_dir) in repos.items():
+        if "primary" in repomd:
+          filelists = os.path.join(repo_dir, repomd["filelists"]["href"]) if "filelists" in repomd else None
+          resolver.add_repo(repo_name, mirrors[0], os.path.join(repo_dir, repomd["primary"]["href"]), filelists)
+      closure = {}
+      for package_list in package_lists:
+        packages = resolver.resolve(package_list)
+        resolver.report(packages)
+        if len(resolver.missing) > 0:
+          raise ValueError("cannot resolve the packages of the snapshot")
+        closure.update((resolver.nevra(package), package) for package in packages)
+      for package in closure.values():
+        selected[package["repo"]].append(package)
+    elif packages != "none":
+      raise ValueError("unknown snapshot packages "+str(packages)+", use closure, all or none")
+    return selected
+
+  def create(self, repo_list, repo_url={}, packages="closure", package_lists=()):
+    snapshot_id = datetime.datetime.today().strftime("%Y%m%d%H%M%S")
+    previous_id, previous_dir = self.resolve("latest")
+    tmp_dir = os.path.join(self.root, "."+snapshot_id+".tmp")
+    PackageManagerBase().mkdir_p(tmp_dir)
+    rpm = RedhatPackageManager()
+    try:
+      repos = collections.OrderedDict()
+      for repo_name in repo_list:
+        kind, url = rpm.repo_source(self.os_name, repo_name, repo_url)
+        if kind is None or kind == "apk":
+          print("Snapshot: skipping repository "+repo_name)
+          continue
+        repo_dir = os.path.join(tmp_dir, repo_name)
+        mirrors, repomd = self.mirror_repo(repo_name, kind, url, repo_dir, previous_dir)
+        repos[repo_name] = (mirrors, repomd, repo_dir)
+      selected = self.select_packages(repos, packages, package_lists)
+      for repo_name, (mirrors, repomd, repo_dir) in repos.items():
+        self.mirror_packages(repo_name, mirrors, repo_dir, selected[repo_name])
+    except BaseException:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      raise
+
+    path = os.path.join(self.root, snapshot_id)
+    os.rename(tmp_dir, path)
+    latest = os.path.join(self.root, "latest")
+    # left behind by an interrupted run
+    if os.path.lexists(latest + ".tmp"):
+      os.remove(latest + ".tmp")
+    os.symlink(snapshot_id, latest + ".tmp")
+    os.replace(latest + ".tmp", latest)
+    print("Created snapshot "+path)
+    return snapshot_id
+
+
+class BuildFingerprint:
+  def __init__(self, build_dir):
+    self.filename = os.path.join(build_dir, "fingerprint.json")
+
+  def compute(self, configuration):
+    target   = configuration['target']
+    repo_url = target.get('repo_url', {})
+    rpm      = RedhatPackageManager()
+    metadata = RepoMetadata(target['os_version'], configuration['work'].get('http_proxy', ''))
+
+    repomd = {}
+    if configuration['work'].get('locked', 0):
+      # the lockfile pins every package, the repositories do not matter
+      repomd = { "lockfile": LockFile(target['lockfile']).digest() }
+    for repo_name in (target['repo_list'] if len(repomd) == 0 else []):
+      kind, url = rpm.repo_source(target['os_name'], repo_name, repo_url)
+      if kind is None:
+        continue
+      try:
+        repomd[repo_name] = metadata.repomd_digest(kind, url)
+      except (OSError, ValueError, xml.etree.ElementTree.ParseError) as exc:
+        print("Cannot read metadata of repository "+repo_name+": "+str(exc))
+        return None
+      if repomd[repo_name] is None:
+        return None
+
+    # every section changing the root or its exports; the image name and the
+    # oci tag are left out as an unchanged image is only re-tagged
+    inputs = {
+      "target"           : target,
+      "http_proxy"       : configuration['work'].get('http_proxy', ''),
+      "prune"            : configuration.get('prune'),
+      "dedup"            : configuration.get('dedup'),
+      "analyze"          : configuration.get('analyze'),
+      "docker"           : { k: v for k, v in configuration['docker'].items() if k != "image" } if 'docker' in configuration else None,
+      "oci"              : { k: v for k, v in configuration['oci'].items() if k != "tag" } if 'oci' in configuration else None,
+      "repomd"           : repomd,
+      "base"             : { "target": configuration['base']['target'], "prune": configuration['base'].get('prune') } if 'base' in configuration else None,
+    }
+    content = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  def load(self):
+    try:
+      with open(self.filename) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return {}
+
+  def save(self, fingerprint, image_name="", image_id="", oci_digest=""):
+    content = {
+      "fingerprint" : fingerprint,
+      "image_name"  : image_name,
+      "image_id"    : image_id,
+      "oci_digest"  : oci_digest,
+      "created"     : datetime.datetime.today().isoformat(),
+    }
+    tmp = self.filename + ".tmp"
+    with open(tmp, "w") as f:
+      json.dump(content, f, indent=2)
+    os.replace(tmp, self.filename)
+
+
+class ThroughputWriter:
+  def __init__(self, fileobj, label, interval=10.0):
+    self.fileobj  = fileobj
+    self.label    = label
+    self.interval = interval
+    self.bytes    = 0
+    self.start    = time.time()
+    self.last     = self.start
+
+  def write(self, data):
+    self.fileobj.write(data)
+    self.bytes += len(data)
+    now = time.time()
+    if now - self.last >= self.interval:
+      self.last = now
+      print(self.report(now))
+    return len(data)
+
+  def rate(self, now=None):
+    if now is None:
+      now = time.time()
+    elapsed = max(now - self.start, 1e-6)
+    return self.bytes / elapsed
+
+  def report(self, now=None):
+    return self.label+": "+"%.1f" % (self.bytes / 1048576.0)+" MiB, "+"%.1f" % (self.rate(now) / 1048576.0)+" MiB/s"
+
+
+class SparseFileReader:
+  # Data of a sparse file in the PAX 1.0 format: the map of data segments as
+  # decimal numbers padded to a full block, followed by the data of the segments
+  def __init__(self, fd, segments):
+    self.fd       = fd
+    self.segments = list(segments)
+    array = [ str(len(segments)) ]
+    for offset, size in segments:
+      array.append(str(offset))
+      array.append(str(size))
+    header = ("\n".join(array)+"\n").encode('ascii')
+    header += b'\0' * (-len(header) % tarfile.BLOCKSIZE)
+    self.header = header
+    self.size   = len(header) + sum(size for offset, size in segments)
+
+  def read(self, size):
+    result = self.header[:size]
+    self.header = self.header[size:]
+    while len(result) < size and len(self.segments) > 0:
+      offset, length = self.segments[0]
+      if length == 0:
+        self.segments.pop(0)
+        continue
+      data = os.pread(self.fd, min(size - len(result), length), offset)
+      if len(data) == 0:
+        raise IOError("sparse file changed while reading")
+      if len(data) == length:
+        self.segments.pop(0)
+      else:
+        self.segments[0] = (offset + len(data), length - len(data))
+      result += data
+    return result
+
+
+class TarStreamWriter:
+  def __init__(self):
+    self.files    = 0
+    self.errors   = 0
+
+  def walk(self, root, relpath="."):
+    # fixed order: entries sorted by name, directories before their content
+    fullpath = root if relpath == "." else os.path.join(root, relpath)
+    with os.scandir(fullpath) as it:
+      entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+      entry_relpath = entry.name if relpath == "." else os.path.join(relpath, entry.name)
+      st = entry.stat(follow_symlinks=False)
+      yield entry_relpath, entry.path, st
+      if stat.S_ISDIR(st.st_mode):
+        yield from self.walk(root, entry_relpath)
+
+  def xattrs(self, path):
+    result = {}
+    try:
+      names = os.listxattr(path, follow_symlinks=False)
+    except OSError as exc:
+      if exc.errno in (errno.ENOTSUP, errno.EPERM):
+        return result
+      raise
+    for name in names:
+      value = os.getxattr(path, name, follow_symlinks=False)
+      result["SCHILY.xattr."+name] = value.decode('utf-8', 'surrogateescape')
+    return result
+
+  def data_segments(self, fd, size):
+    segments = []
+    offset = 0
+    while offset < size:
+      try:
+        data = os.lseek(fd, offset, os.SEEK_DATA)
+      except OSError as exc:
+        if exc.errno == errno.ENXIO:
+          break
+        raise
+      hole = os.lseek(fd, data, os.SEEK_HOLE)
+      segments.append((data, hole - data))
+      offset = hole
+    # a trailing hole is recorded as an empty segment at the end of the file
+    if len(segments) == 0 or segments[-1][0] + segments[-1][1] < size:
+      segments.append((size, 0))
+    return segments
+
+  def tarinfo(self, arcname, path, st):
+    info = tarfile.TarInfo(arcname)
+    info.mode  = stat.S_IMODE(st.st_mode)
+    info.uid   = st.st_uid
+    info.gid   = st.st_gid
+    info.mtime = int(st.st_mtime)
+    info.uname = ""
+    info.gname = ""
+    info.pax_headers = self.xattrs(path)
+    return info
+
+  def add(self, tar, arcname, path, st, hardlinks):
+    info = self.tarinfo(arcname, path, st)
+    mode = st.st_mode
+
+    if stat.S_ISREG(mode) and st.st_nlink > 1:
+      key = (st.st_dev, st.st_ino)
+      if key in hardlinks:
+        info.type     = tarfile.LNKTYPE
+        info.linkname = hardlinks[key]
+        tar.addfile(info)
+        return
+      hardlinks[key] = arcname
+
+    if stat.S_ISDIR(mode):
+      info.type = tarfile.DIRTYPE
+      tar.addfile(info)
+    elif stat.S_ISLNK(mode):
+      info.type     = tarfile.SYMTYPE
+      info.linkname = os.readlink(path)
+      tar.addfile(info)
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+      info.type     = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+      info.devmajor = os.major(st.st_rdev)
+      info.devminor = os.minor(st.st_rdev)
+      tar.addfile(info)
+    elif stat.S_ISFIFO(mode):
+      info.type = tarfile.FIFOTYPE
+      tar.addfile(info)
+    elif stat.S_ISREG(mode):
+      fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+      try:
+        with os.fdopen(fd, 'rb', closefd=False) as f:
+          if st.st_blocks * 512 < st.st_size:
+            segments = self.data_segments(fd, st.st_size)
+            reader   = SparseFileReader(fd, segments)
+            info.pax_headers.update({
+              "GNU.sparse.major"    : "1",
+              "GNU.sparse.minor"    : "0",
+              "GNU.sparse.name"     : arcname,
+              "GNU.sparse.realsize" : str(st.st_size),
+            })
+            info.name = os.path.join(os.path.dirname(arcname), "GNUSparseFile.0", os.path.basename(arcname))
+            info.size = reader.size
+            tar.addfile(info, reader)
+          else:
+            info.size = st.st_size
+            tar.addfile(info, f)
+      finally:
+        os.close(fd)
+    else:
+      # sockets are not archived
+      return
+    self.files += 1
+
+  def write(self, root, fileobj, entries=None, whiteouts=()):
+    # entries: only these paths (sorted, parents first) and the whiteout files of a delta layer
+    tar = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT, bufsize=1024*1024)
+    hardlinks = {}
+    if entries is None:
+      root_info = self.tarinfo(".", root, os.lstat(root))
+      root_info.type = tarfile.DIRTYPE
+      tar.addfile(root_info)
+      for relpath, path, st in self.walk(root):
+        self.add(tar, "./"+relpath, path, st, hardlinks)
+    else:
+      for relpath in whiteouts:
+        info = tarfile.TarInfo("./"+os.path.join(os.path.dirname(relpath), ".wh."+os.path.basename(relpath)))
+        info.mode = 0o600
+        tar.addfile(info)
+      for relpath in entries:
+        path = os.path.join(root, relpath)
+        self.add(tar, "./"+relpath, path, os.lstat(path), hardlinks)
+    tar.close()
+    return self.files
+
+
+class LayerDelta:
+  # Keeps a manifest of the install root of the last exported image, so the next export
+  # can be a layer with only the added and changed files and whiteouts for deleted ones.
+  # Manifest entries: relpath -> [ type, mode, uid, gid, size, mtime_ns, digest, ino, ctime_ns ]
+  # The sha256 of a regular file is reused while size, mtime, inode and ctime are unchanged.
+  def __init__(self, install_dir, state_file, max_layers=10):
+    self.install_dir = install_dir
+    self.state_file  = state_file
+    self.max_layers  = max_layers
+    self.previous    = None
+    self.files       = {}
+    self.entries     = []
+    self.whiteouts   = []
+    self.hashed      = 0
+
+  def load(self):
+    try:
+      with gzip.open(self.state_file, "rt") as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def save(self, image, layers):
+    PackageManagerBase().mkdir_p(os.path.dirname(self.state_file))
+    tmp = self.state_file + ".tmp"
+    with gzip.open(tmp, "wt", compresslevel=1) as f:
+      json.dump({ "image": image, "layers": layers, "files": self.files }, f)
+    os.replace(tmp, self.state_file)
+
+  def entry(self, path, st, previous):
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+      if previous is not None and previous[0] == "f" and previous[4] == st.st_size and previous[5] == st.st_mtime_ns \
+          and previous[7] == st.st_ino and previous[8] == st.st_ctime_ns:
+        digest = previous[6]
+      else:
+        digest = PackageCache(None).checksum(path)
+        self.hashed += 1
+      kind = "f"
+    elif stat.S_ISDIR(mode):
+      kind, digest = "d", ""
+    elif stat.S_ISLNK(mode):
+      kind, digest = "l", os.readlink(path)
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode) or stat.S_ISFIFO(mode):
+      kind, digest = "c", str(mode)+":"+str(st.st_rdev)
+    else:
+      return None
+    return [ kind, stat.S_IMODE(mode), st.st_uid, st.st_gid, st.st_size if kind == "f" else 0, st.st_mtime_ns, digest, st.st_ino, st.st_ctime_ns ]
+
+  def compute(self):
+    # returns True if the changes can be a layer on top of the previous image
+    start = time.time()
+    self.previous = self.load()
+    previous_files = self.previous["files"] if self.previous is not None else {}
+    self.files = {}
+    for relpath, path, st in TarStreamWriter().walk(self.install_dir):
+      entry = self.entry(path, st, previous_files.get(relpath))
+      if entry is not None:
+        self.files[relpath] = entry
+
+    changed = set()
+    for relpath, entry in self.files.items():
+      old = previous_files.get(relpath)
+      if old is None or old[:7] != entry[:7]:
+        changed.add(relpath)
+        if old is not None and old[0] != entry[0]:
+          self.whiteouts.append(relpath)
+        # parent directories are part of the layer
+        parent = os.path.dirname(relpath)
+        while parent != "" and not parent in changed:
+          changed.add(parent)
+          parent = os.path.dirname(parent)
+    removed = previous_files.keys() - self.files.keys()
+    for relpath in removed:
+      # a whiteout of a directory hides everything below it
+      if not os.path.dirname(relpath) in removed:
+        self.whiteouts.append(relpath)
+    self.entries   = sorted(changed)
+    self.whiteouts = sorted(self.whiteouts)
+    print("Layer delta: "+str(len(self.entries))+" changed, "+str(len(self.whiteouts))+" deleted of "+str(len(self.files))+" entries, "+
+          str(self.hashed)+" files hashed in "+"%.2f" % (time.time() - start)+"s")
+    return self.previous is not None and self.previous.get("layers", 0) < self.max_layers
+
+
+class ParallelCompressor:
+  # Compresses fixed size blocks on all cores. Every block becomes an independent
+  # gzip member or zstd frame, the concatenation is a valid gzip / zstd stream.
+  # The digests of the uncompressed and compressed data are computed on the way.
+  def __init__(self, fileobj, compression="gzip", level=None, block_size=4*1024*1024, workers=None):
+    if compression == "zstd" and zstandard is None:
+      raise RuntimeError("zstd compression needs the python zstandard module")
+    if compression not in ("gzip", "zstd"):
+      raise RuntimeError("unknown compression "+str(compression))
+    self.fileobj      = fileobj
+    self.compression  = compression
+    self.level        = level
+    self.block_size   = block_size
+    self.workers      = workers or os.cpu_count() or 1
+    self.executor     = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+    self.pending      = collections.deque()
+    self.buffer       = bytearray()
+    self.diff_id      = hashlib.sha256()
+    self.digest       = hashlib.sha256()
+    self.size         = 0
+
+  def compress(self, block):
+    if self.compression == "zstd":
+      return zstandard.ZstdCompressor(level=self.level or 3).compress(block)
+    compressor = zlib.compressobj(self.level or 6, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+  def write(self, data):
+    self.diff_id.update(data)
+    self.buffer += data
+    while len(self.buffer) >= self.block_size:
+      block = bytes(self.buffer[:self.block_size])
+      del self.buffer[:self.block_size]
+      self.pending.append(self.executor.submit(self.compress, block))
+      # bounded number of blocks in flight
+      while len(self.pending) > 2 * self.workers:
+        self.drain_one()
+    return len(data)
+
+  def drain_one(self):
+    data = self.pending.popleft().result()
+    self.digest.update(data)
+    self.size += len(data)
+    self.fileobj.write(data)
+
+  def close(self):
+    if len(self.buffer) > 0:
+      self.pending.append(self.executor.submit(self.compress, bytes(self.buffer)))
+      self.buffer = bytearray()
+    while len(self.pending) > 0:
+      self.drain_one()
+    self.executor.shutdown()
+
+
+class OciLayout:
+  def __init__(self, layout_dir):
+    self.layout_dir = layout_dir
+    self.blobs_dir  = os.path.join(layout_dir, "blobs", "sha256")
+
+  def architecture(self):
+    table = {
+      "x86_64"  : "amd64",
+      "aarch64" : "arm64",
+      "armv7l"  : "arm",
+      "i686"    : "386",
+      "ppc64le" : "ppc64le",
+      "s390x"   : "s390x",
+    }
+    machine = os.uname().machine
+    return table.get(machine, machine)
+
+  def init(self):
+    PackageManagerBase().mkdir_p(self.blobs_dir)
+    filename = os.path.join(self.layout_dir, "oci-layout")
+    if not os.path.exists(filename):
+      self.write_json(filename, { "imageLayoutVersion": "1.0.0" })
+
+  def write_json(self, filename, content):
+    tmp = filename + ".tmp." + str(os.getpid())
+    with open(tmp, "w") as f:
+      json.dump(content, f, indent=2, sort_keys=True)
+    os.replace(tmp, filename)
+
+  def write_blob(self, content, media_type):
+    digest = hashlib.sha256(content).hexdigest()
+    filename = os.path.join(self.blobs_dir, digest)
+    if not os.path.exists(filename):
+      tmp = filename + ".tmp." + str(os.getpid())
+      with open(tmp, "wb") as f:
+        f.write(content)
+      os.replace(tmp, filename)
+    return { "mediaType": media_type, "digest": "sha256:"+digest, "size": len(content) }
+
+  def write_layer(self, install_dir, compression="gzip", level=None, block_size=4*1024*1024, delta=None):
+    self.init()
+    tmp = os.path.join(self.blobs_dir, "layer.tmp." + str(os.getpid()))
+    with open(tmp, "wb") as f:
+      compressor = ParallelCompressor(f, compression, level, block_size)
+      writer     = ThroughputWriter(compressor, "Exported")
+      try:
+        if delta is not None:
+          TarStreamWriter().write(install_dir, writer, delta.entries, delta.whiteouts)
+        else:
+          TarStreamWriter().write(install_dir, writer)
+        compressor.close()
+      except BaseException:
+        compressor.executor.shutdown(cancel_futures=True)
+        f.close()
+        os.remove(tmp)
+        raise
+    print(writer.report()+", compressed to "+"%.1f" % (compressor.size / 1048576.0)+" MiB with "+compression)
+    digest = compressor.digest.hexdigest()
+    os.replace(tmp, os.path.join(self.blobs_dir, digest))
+    descriptor = {
+      "mediaType" : "application/vnd.oci.image.layer.v1.tar+"+compression,
+      "digest"    : "sha256:"+digest,
+      "size"      : compressor.size,
+    }
+    return descriptor, "sha256:"+compressor.diff_id.hexdigest()
+
+  def write_image(self, layers, diff_ids, tag):
+    created = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    config = {
+      "created"      : created,
+      "architecture" : self.architecture(),
+      "os"           : "linux",
+      "config"       : { "Env": [ "PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin" ], "Cmd": [ "/bin/bash" ] },
+      "rootfs"       : { "type": "layers", "diff_ids": diff_ids },
+      "history"      : [ { "created": created, "created_by": "imagebuild" } for layer in layers ],
+    }
+    config_descriptor = self.write_blob(json.dumps(config, sort_keys=True).encode('utf-8'), "application/vnd.oci.image.config.v1+json")
+    manifest = {
+      "schemaVersion" : 2,
+      "mediaType"     : "application/vnd.oci.image.manifest.v1+json",
+      "config"        : config_descriptor,
+      "layers"        : layers,
+    }
+    manifest_descriptor = self.write_blob(json.dumps(manifest, sort_keys=True).encode('utf-8'), "application/vnd.oci.image.manifest.v1+json")
+    self.tag(manifest_descriptor, tag)
+    return manifest_descriptor
+
+  def read_index(self):
+    try:
+      with open(os.path.join(self.layout_dir, "index.json")) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return { "schemaVersion": 2, "manifests": [] }
+
+  def tag(self, manifest_descriptor, tag):
+    index = self.read_index()
+    descriptor = dict(manifest_descriptor)
+    descriptor["annotations"] = { "org.opencontainers.image.ref.name": tag }
+    manifests = [ m for m in index["manifests"] if m.get("annotations", {}).get("org.opencontainers.image.ref.name") != tag ]
+    manifests.append(descriptor)
+    index["manifests"] = manifests
+    self.write_json(os.path.join(self.layout_dir, "index.json"), index)
+
+  def tag_existing(self, digest, tag):
+    for manifest in self.read_index()["manifests"]:
+      if manifest["digest"] == digest:
+        self.tag(manifest, tag)
+        return True
+    return False
+
+  def read_blob(self, digest):
+    with open(os.path.join(self.blobs_dir, digest.split(":", 1)[1])) as f:
+      return json.load(f)
+
+  def export(self, install_dir, tag, compression="gzip", level=None, block_size=4*1024*1024, delta=None):
+    # with a delta the layer is stacked on the layers of the previous image
+    layers   = []
+    diff_ids = []
+    if delta is not None:
+      try:
+        previous = self.read_blob(delta.previous["image"])
+        layers   = previous["layers"]
+        diff_ids = self.read_blob(previous["config"]["digest"])["rootfs"]["diff_ids"]
+      except (OSError, ValueError, KeyError):
+        print("Previous OCI image "+str(delta.previous["image"])+" not found, exporting a full layer")
+        delta = None
+    print("Creating OCI image: "+self.layout_dir+":"+tag+(" (delta layer "+str(len(layers)+1)+")" if delta is not None else ""))
+    layer, diff_id = self.write_layer(install_dir, compression, level, block_size, delta)
+    manifest = self.write_image(layers + [ layer ], diff_ids + [ diff_id ], tag)
+    manifest["layers"] = len(layers) + 1
+    print(manifest["digest"])
+    return manifest
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+  def __init__(self, socket_path, timeout=None):
+    http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+    self.socket_path = socket_path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socket_path)
+
+
+class ChunkedWriter:
+  # Request body in chunked transfer encoding, the size of the archive is not known in advance
+  def __init__(self, connection, cancelled=None):
+    self.connection = connection
+    self.cancelled  = cancelled
+
+  def write(self, data):
+    if self.cancelled is not None and self.cancelled.is_set():
+      raise IOError("cancelled")
+    if len(data) > 0:
+      self.connection.send(b"%x\r\n" % len(data))
+      self.connection.send(data)
+      self.connection.send(b"\r\n")
+    return len(data)
+
+  def close(self):
+    self.connection.send(b"0\r\n\r\n")
+
+
+class DockerEngine:
+  # Client of the Docker Engine API on its unix socket: no shell and no docker command,
+  # the archive is streamed into the request, and the answers are json, not text to scrape.
+  # Progress streams are written to the log file of the request, like the output of a command.
+  def __init__(self, socket_path="/var/run/docker.sock", runner=None, timeout=300):
+    self.socket_path = socket_path
+    self.runner      = runner if runner is not None else ProcessRunner()
+    self.timeout     = timeout
+
+  def split_name(self, name):
+    # "registry:5000/repo:tag": the tag is after the last ":" behind the last "/"
+    repo, sep, tag = name.rpartition(":")
+    if sep == "" or "/" in tag:
+      return name, "latest"
+    return repo, tag
+
+  def request(self, method, path, query=None, body_writer=None, content_type="application/x-tar", timeout=None):
+    if query:
+      path += "?" + urllib.parse.urlencode(query)
+    connection = UnixHTTPConnection(self.socket_path, timeout or self.timeout)
+    connection.putrequest(method, path)
+    if body_writer is not None:
+      connection.putheader("Content-Type", content_type)
+      connection.putheader("Transfer-Encoding", "chunked")
+    else:
+      connection.putheader("Content-Length", "0")
+    connection.endheaders()
+    if body_writer is not None:
+      writer = ChunkedWriter(connection, self.runner.cancelled)
+      try:
+        body_writer(writer)
+        writer.close()
+      except (BrokenPipeError, ConnectionResetError):
+        # the daemon rejected the request before reading the body, its answer tells why
+        pass
+    return connection, connection.getresponse()
+
+  def messages(self, response, name):
+    # a stream of json objects, "error" ends it
+    log_file = self.runner.log_file(name)
+    log      = open(log_file, "wb") if log_file is not None else None
+    result   = []
+    try:
+      for line in response:
+        if log is not None:
+          log.write(line)
+        line = line.strip()
+        if len(line) == 0:
+          continue
+        try:
+          message = json.loads(line)
+        except ValueError:
+          message = { "error": line.decode('utf-8', 'replace') }
+        if "error" in message:
+          raise IOError(message.get("errorDetail", {}).get("message", message["error"]))
+        result.append(message)
+    finally:
+      if log is not None:
+        log.close()
+    return result
+
+  def error(self, response):
+    body = response.read()
+    try:
+      return json.loads(body)["message"]
+    except (ValueError, KeyError, TypeError):
+      return str(response.status)+" "+response.reason+" "+body.decode('utf-8', 'replace').strip()
+
+  def import_rootfs(self, install_dir, image_name, timeout=None):
+    repo, tag = self.split_name(image_name)
+    print("POST /images/create?fromSrc=- "+repo+":"+tag+" ("+self.socket_path+")")
+    files  = []
+    writer = []
+    def write_archive(body):
+      writer.append(ThroughputWriter(body, "Uploaded"))
+      files.append(TarStreamWriter().write(install_dir, writer[0]))
+    try:
+      connection, response = self.request("POST", "/images/create", { "fromSrc": "-", "repo": repo, "tag": tag }, write_archive, timeout=timeout)
+      try:
+        if response.status != 200:
+          print("Docker import failed: "+self.error(response))
+          return None
+        messages = self.messages(response, "docker-import")
+      finally:
+        connection.close()
+    except (OSError, http.client.HTTPException) as exc:
+      print("Docker import failed: "+str(exc))
+      return None
+    if len(writer) > 0:
+      print(writer[0].report())
+    if len(files) == 0:
+      return None
+    print("Exported "+str(files[0])+" files")
+    # the last status is the id of the new image
+    ids = [ message["status"] for message in messages if str(message.get("status", "")).startswith("sha256:") ]
+    return ids[-1] if len(ids) > 0 else ""
+
+  def load(self, write_archive, timeout=None):
+    try:
+      connection, response = self.request("POST", "/images/load", { "quiet": "1" }, write_archive, timeout=timeout)
+      try:
+        if response.status != 200:
+          print("Docker load failed: "+self.error(response))
+          return False
+        self.messages(response, "docker-load")
+      finally:
+        connection.close()
+    except (OSError, http.client.HTTPException) as exc:
+      print("Docker load failed: "+str(exc))
+      return False
+    return True
+
+  def inspect(self, image):
+    try:
+      connection, response = self.request("GET", "/images/"+urllib.parse.quote(image, safe="")+"/json")
+      try:
+        if response.status != 200:
+          response.read()
+          return None
+        return json.loads(response.read())
+      finally:
+        connection.close()
+    except (OSError, ValueError, http.client.HTTPException):
+      return None
+
+  def tag(self, image, name):
+    repo, tag = self.split_name(name)
+    print("POST /images/"+image+"/tag "+repo+":"+tag)
+    try:
+      connection, response = self.request("POST", "/images/"+urllib.parse.quote(image, safe="")+"/tag", { "repo": repo, "tag": tag })
+      try:
+        if response.status != 201:
+          print("Docker tag failed: "+self.error(response))
+          return 1
+        response.read()
+      finally:
+        connection.close()
+    except (OSError, http.client.HTTPException) as exc:
+      print("Docker tag failed: "+str(exc))
+      return 1
+    return 0
+
+
+class Docker:
+  # The docker command, or the Engine API if there is an engine (DockerEngine)
+  def __init__(self, runner=None, engine=None):
+    if runner is None:
+      runner = ProcessRunner()
+    self.runner = runner
+    self.engine = engine
+
+  def import_rootfs(self, install_dir, image_name, timeout=None):
+    # Stream the root directory as tar archive into "docker import", the
+    # archive is written in-process, so errors are not hidden behind docker
+    if self.engine is not None:
+      return self.engine.import_rootfs(install_dir, image_name, timeout)
+    cmd = [ 'docker', 'import', '-', image_name ]
+    print(" ".join(cmd))
+    files  = []
+    writer = []
+    def write_archive(stdin):
+      writer.append(ThroughputWriter(stdin, "Exported"))
+      files.append(TarStreamWriter().write(install_dir, writer[0]))
+
+    result = self.runner.run(cmd, "docker-import", timeout=timeout, stdin_writer=write_archive, capture=True)
+    if len(writer) > 0:
+      print(writer[0].report())
+    if result.returncode != 0 or len(files) == 0:
+      if not self.runner.echo:
+        self.runner.print_tail(result)
+      return None
+    print("Exported "+str(files[0])+" files")
+    output = result.output.decode('utf-8').strip()
+    return output.splitlines()[-1].strip() if output != "" else ""
+
+  def load_delta(self, install_dir, delta, image_name, work_dir, timeout=None):
+    # "docker load" of an archive whose manifest lists the layers of the previous image, but
+    # contains only the new layer: layers the daemon already has are not read from the archive
+    if self.engine is not None:
+      previous = self.engine.inspect(delta.previous["image"])
+      if previous is None:
+        return None, 0
+      diff_ids = previous["RootFS"]["Layers"]
+    else:
+      result = self.runner.run(['docker', 'image', 'inspect', '--format', '{{json .RootFS.Layers}}', delta.previous["image"]], echo=False, capture=True)
+      if result.returncode != 0:
+        return None, 0
+      diff_ids = json.loads(result.output.decode('utf-8'))
+
+    PackageManagerBase().mkdir_p(work_dir)
+    layer_file = os.path.join(work_dir, "layer.tar")
+    with open(layer_file, "wb") as f:
+      files = TarStreamWriter().write(install_dir, f, delta.entries, delta.whiteouts)
+    diff_id = "sha256:" + PackageCache(None).checksum(layer_file)
+    diff_ids.append(diff_id)
+    created = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    config = json.dumps({
+      "created"      : created,
+      "architecture" : OciLayout("").architecture(),
+      "os"           : "linux",
+      "config"       : {},
+      "rootfs"       : { "type": "layers", "diff_ids": diff_ids },
+      "history"      : [ { "created": created, "created_by": "imagebuild" } for layer in diff_ids ],
+    }, sort_keys=True).encode('utf-8')
+    config_digest = hashlib.sha256(config).hexdigest()
+    manifest = json.dumps([ {
+      "Config"   : config_digest+".json",
+      "RepoTags" : [ image_name ],
+      "Layers"   : [ layer.split(":", 1)[1]+"/layer.tar" for layer in diff_ids ],
+    } ]).encode('utf-8')
+
+    def write_archive(stdin):
+      tar = tarfile.open(fileobj=stdin, mode='w|', format=tarfile.PAX_FORMAT)
+      tar.add(layer_file, diff_id.split(":", 1)[1]+"/layer.tar")
+      for name, content in [ (config_digest+".json", config), ("manifest.json", manifest) ]:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+      tar.close()
+
+    if self.engine is not None:
+      print("POST /images/load ("+str(files)+" files in layer "+str(len(diff_ids))+")")
+      loaded = self.engine.load(write_archive, timeout)
+      os.remove(layer_file)
+      return ("sha256:"+config_digest, len(diff_ids)) if loaded else (None, 0)
+    cmd = [ 'docker', 'load' ]
+    print(" ".join(cmd)+" ("+str(files)+" files in layer "+str(len(diff_ids))+")")
+    result = self.runner.run(cmd, "docker-load", timeout=timeout, stdin_writer=write_archive, capture=True)
+    os.remove(layer_file)
+    if result.returncode != 0:
+      if not self.runner.echo:
+        self.runner.print_tail(result)
+      return None, 0
+    return "sha256:"+config_digest, len(diff_ids)
+
+  def image_exists(self, image):
+    if self.engine is not None:
+      return self.engine.inspect(image) is not None
+    return self.runner.run(['docker', 'image', 'inspect', image], echo=False).returncode == 0
+
+  def tag(self, image, name):
+    if self.engine is not None:
+      return self.engine.tag(image, name)
+    cmd = [ 'docker', 'tag', image, name ]
+    print(" ".join(cmd))
+    return self.runner.run(cmd, "docker-tag").returncode
+
+  def tag_latest(self, image, image_name):
+    image_prefix = image_name.split(':')[0]
+    return self.tag(image, image_prefix + ':latest')
+
+
+class RpmHeader:
+  NAME    = 1000
+  VERSION = 1001
+  RELEASE = 1002
+  EPOCH   = 1003
+  ARCH    = 1022
+
+  def __init__(self, filename):
+    with open(filename, 'rb') as f:
+      # skip the lead, the signature header is padded to 8 bytes
+      f.seek(96)
+      self.read_header(f, True)
+      self.tags = self.read_header(f, False)
+
+  def read_header(self, f, pad):
+    magic, nindex, hsize = struct.unpack(">4s4xII", f.read(16))
+    if magic[:3] != b'\x8e\xad\xe8':
+      raise ValueError("not a rpm header")
+    index = f.read(nindex * 16)
+    store = f.read(hsize)
+    if pad and hsize % 8 != 0:
+      f.read(8 - hsize % 8)
+
+    tags = {}
+    for i in range(nindex):
+      tag, type, offset, count = struct.unpack(">iiii", index[i*16:i*16+16])
+      if type == 4:
+        tags[tag] = struct.unpack(">i", store[offset:offset+4])[0]
+      elif type == 6:
+        tags[tag] = store[offset:store.index(b'\0', offset)].decode('utf-8')
+    return tags
+
+  def nevra(self):
+    epoch = self.tags.get(self.EPOCH, 0)
+    return "%s-%s:%s-%s.%s" % (self.tags[self.NAME], epoch, self.tags[self.VERSION], self.tags[self.RELEASE], self.tags[self.ARCH])
+
+
+class RootClone:
+  # Copies an install root cheaply: reflinks (FICLONE) share the data blocks until one side writes.
+  # Without reflink support files are hardlinked, except below the copy_up directories
+  # which the package manager, scriptlets and patching modify in place (rpmdb, /etc, logs);
+  # those are copied. Files replaced by rpm are written to a new inode, the base stays intact.
+  # The package databases are always copied, even with a configured copy_up list.
+  FICLONE = 0x40049409
+  copy_up = [ "etc", "var", "root", "run", "tmp", "home" ]
+  package_state = [ "usr/lib/sysimage", "var/lib/rpm", "var/lib/dnf", "lib/apk" ]
+
+  def __init__(self, source, destination, copy_up=None):
+    self.source      = source
+    self.destination = destination
+    self.copy_up     = [ os.path.normpath(path.strip("/")) for path in (copy_up if copy_up is not None else RootClone.copy_up) + RootClone.package_state ]
+    self.mode        = "reflink"
+    self.files       = 0
+    self.links       = {}
+
+  def reflink(self, src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+      fcntl.ioctl(fdst.fileno(), RootClone.FICLONE, fsrc.fileno())
+
+  def copied(self, relpath):
+    return any(relpath == path or relpath.startswith(path + os.sep) for path in self.copy_up)
+
+  def shared(self):
+    # package database files still sharing their inode with the source root
+    result = []
+    for path in RootClone.package_state:
+      for dirpath, dirnames, filenames in os.walk(os.path.join(self.destination, path)):
+        for name in filenames:
+          dst = os.path.join(dirpath, name)
+          src = os.path.join(self.source, os.path.relpath(dst, self.destination))
+          try:
+            if os.path.samefile(src, dst):
+              result.append(os.path.relpath(dst, self.destination))
+          except OSError:
+            continue
+    return result
+
+  def clone_file(self, src, dst, relpath):
+    if self.mode == "reflink":
+      try:
+        self.reflink(src, dst)
+        return
+      except OSError as exc:
+        if not exc.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EPERM):
+          raise
+        os.remove(dst)
+        self.mode = "hardlink"
+    if self.mode == "hardlink" and not self.copied(relpath):
+      try:
+        os.link(src, dst)
+        return
+      except OSError as exc:
+        if not exc.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+          raise
+        self.mode = "copy"
+    shutil.copyfile(src, dst, follow_symlinks=False)
+
+  def metadata(self, src, dst, st):
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+      os.chmod(dst, stat.S_IMODE(st.st_mode))
+      for name, value in TarStreamWriter().xattrs(src).items():
+        os.setxattr(dst, name[len("SCHILY.xattr."):], value.encode('utf-8', 'surrogateescape'), follow_symlinks=False)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+  def clone(self):
+    start = time.time()
+    if os.path.lexists(self.destination):
+      shutil.rmtree(self.destination)
+    PackageManagerBase().mkdir_p(os.path.dirname(self.destination))
+    directories = []
+    for dirpath, dirnames, filenames in os.walk(self.source):
+      relative = os.path.relpath(dirpath, self.source)
+      target_dir = os.path.normpath(os.path.join(self.destination, relative))
+      os.mkdir(target_dir)
+      directories.append((dirpath, target_dir, os.lstat(dirpath)))
+      for name in filenames + [ name for name in dirnames if os.path.islink(os.path.join(dirpath, name)) ]:
+        src = os.path.join(dirpath, name)
+        dst = os.path.join(target_dir, name)
+        relpath = os.path.normpath(os.path.join(relative, name))
+        st = os.lstat(src)
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode) and (st.st_dev, st.st_ino) in self.links:
+          # keep hardlinks within the root as hardlinks
+          os.link(self.links[(st.st_dev, st.st_ino)], dst)
+          continue
+        if stat.S_ISLNK(st.st_mode):
+          os.symlink(os.readlink(src), dst)
+        elif stat.S_ISREG(st.st_mode):
+          self.clone_file(src, dst, relpath)
+          self.files += 1
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode) or stat.S_ISFIFO(st.st_mode):
+          os.mknod(dst, st.st_mode, st.st_rdev)
+        else:
+          continue
+        if st.st_nlink > 1:
+          self.links[(st.st_dev, st.st_ino)] = dst
+        self.metadata(src, dst, st)
+    # directory times last, creating the entries changed them
+    for src, dst, st in reversed(directories):
+      self.metadata(src, dst, st)
+    shared = self.shared() if self.mode == "hardlink" else []
+    if len(shared) > 0:
+      raise OSError(errno.EMLINK, "package database shared with "+self.source, shared[0])
+    print("Cloned "+self.source+" to "+self.destination+" ("+self.mode+"): "+str(self.files)+" files in "+"%.2f" % (time.time() - start)+"s")
+    return self.mode
+
+
+class BuildSteps:
+  # Named build steps with dependencies and a checkpoint per step in checkpoint_dir.
+  # A step is skipped when its checkpoint has the same input hash and none of its
+  # dependencies ran again, so a failed build resumes at the first invalid step.
+  def __init__(self, checkpoint_dir, force=False, from_step=None, only_step=None):
+    self.checkpoint_dir = checkpoint_dir
+    self.force     = force
+    self.from_step = from_step
+    self.only_step = only_step
+    self.steps     = collections.OrderedDict()
+    self.outputs   = {}
+    self.ran       = set()
+
+  def add(self, name, function, inputs, depends=[]):
+    self.steps[name] = (function, inputs, [ depend for depend in depends if depend is not None ])
+    return name
+
+  def order(self):
+    result  = []
+    visited = {}
+    def visit(name):
+      if visited.get(name) == 1:
+        raise ValueError("build steps have a cycle at "+name)
+      if visited.get(name) == 2:
+        return
+      visited[name] = 1
+      for depend in self.steps[name][2]:
+        visit(depend)
+      visited[name] = 2
+      result.append(name)
+    for name in self.steps:
+      visit(name)
+    return result
+
+  def downstream(self, name):
+    result = set([ name ])
+    for step in self.order():
+      if any(depend in result for depend in self.steps[step][2]):
+        result.add(step)
+    return result
+
+  def key(self, name):
+    content = json.dumps(self.steps[name][1], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  def checkpoint_file(self, name):
+    return os.path.join(self.checkpoint_dir, name+".json")
+
+  def checkpoint(self, name):
+    try:
+      with open(self.checkpoint_file(name)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def invalidate(self, names):
+    for name in names:
+      if os.path.exists(self.checkpoint_file(name)):
+        os.remove(self.checkpoint_file(name))
+
+  def save(self, name, output):
+    PackageManagerBase().mkdir_p(self.checkpoint_dir)
+    tmp = self.checkpoint_file(name) + ".tmp"
+    with open(tmp, "w") as f:
+      json.dump({ "step": name, "input": self.key(name), "output": output, "finished": time.time() }, f, indent=2, sort_keys=True)
+    os.replace(tmp, self.checkpoint_file(name))
+
+  def up_to_date(self, name, checkpoint, ran):
+    forced = self.downstream(self.from_step) if self.from_step in self.steps else set()
+    return not self.force and not name in forced and checkpoint is not None and checkpoint.get("input") == self.key(name) \
+      and not any(depend in ran for depend in self.steps[name][2])
+
+  def complete(self):
+    # every step has a checkpoint of its current inputs; fills in the outputs of the checkpoints
+    for name in self.order():
+      checkpoint = self.checkpoint(name)
+      if checkpoint is None or checkpoint.get("input") != self.key(name):
+        return False
+      self.outputs.setdefault(name, checkpoint.get("output", {}))
+    return True
+
+  def pending(self):
+    # the steps a run would execute
+    result = []
+    for name in self.order():
+      if self.only_step is not None:
+        if name == self.only_step:
+          result.append(name)
+      elif not self.up_to_date(name, self.checkpoint(name), result):
+        result.append(name)
+    return result
+
+  def run(self):
+    for name in self.order():
+      function, inputs, depends = self.steps[name]
+      checkpoint = self.checkpoint(name)
+      if self.only_step is not None and name != self.only_step:
+        self.outputs[name] = checkpoint["output"] if checkpoint is not None else {}
+        continue
+      if self.only_step is not None:
+        missing = [ depend for depend in depends if self.checkpoint(depend) is None ]
+        if len(missing) > 0:
+          raise ValueError("step "+name+" needs the completed steps "+", ".join(missing))
+      elif self.up_to_date(name, checkpoint, self.ran):
+        print("Step "+name+": up to date")
+        self.outputs[name] = checkpoint.get("output", {})
+        continue
+
+      # everything built on top of this step becomes invalid before it runs
+      self.invalidate(self.downstream(name))
+      output = function()
+      self.outputs[name] = output if output is not None else {}
+      self.ran.add(name)
+      self.save(name, self.outputs[name])
+    return self.outputs
+
+
+class BuildLock:
+  # Advisory lock of a build directory, held for a whole build. Builds of the same
+  # profile wait for each other, builds of other profiles are not affected.
+  def __init__(self, build_dir):
+    self.filename = os.path.join(build_dir, ".lock")
+    self.file     = None
+
+  def __enter__(self):
+    PackageManagerBase().mkdir_p(os.path.dirname(self.filename))
+    self.file = open(self.filename, "a+")
+    try:
+      fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      self.file.seek(0)
+      print("Waiting for the build of "+os.path.dirname(self.filename)+" (pid "+self.file.read().strip()+")")
+      fcntl.flock(self.file, fcntl.LOCK_EX)
+    self.file.truncate(0)
+    self.file.write(str(os.getpid()))
+    self.file.flush()
+    return self
+
+  def __exit__(self, *args):
+    fcntl.flock(self.file, fcntl.LOCK_UN)
+    self.file.close()
+    self.file = None
+
+
+class BuildTrace:
+  # Wall time, cpu time (of this process and its children) and the peak rss of the
+  # children for every phase. Written as json and in the chrome trace event format.
+  def __init__(self):
+    self.start    = time.time()
+    self.events   = []
+    self.stack    = []
+    self.subphase = None
+
+  def usage(self):
+    own      = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+      "wall"         : time.time(),
+      "cpu"          : own.ru_utime + own.ru_stime,
+      "children_cpu" : children.ru_utime + children.ru_stime,
+      "max_rss"      : children.ru_maxrss,
+    }
+
+  def add(self, name, start, wall, cpu=0.0, children_cpu=0.0, max_rss_kb=None, parent=None):
+    self.events.append({
+      "name"              : name,
+      "parent"            : parent,
+      "start"             : round(start - self.start, 6),
+      "wall_seconds"      : round(wall, 6),
+      "cpu_seconds"       : round(cpu, 6),
+      "children_cpu_seconds" : round(children_cpu, 6),
+      "children_max_rss_kb"  : max_rss_kb,
+    })
+
+  def finish(self, name, before, parent=None):
+    after = self.usage()
+    # ru_maxrss of the children is a high water mark, it is only attributed
+    # to a phase if it was raised by a child of this phase
+    max_rss = after["max_rss"] if after["max_rss"] > before["max_rss"] else None
+    self.add(name, before["wall"], after["wall"] - before["wall"], after["cpu"] - before["cpu"],
+             after["children_cpu"] - before["children_cpu"], max_rss, parent)
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    before = self.usage()
+    self.stack.append(name)
+    try:
+      yield
+    finally:
+      self.mark(None)
+      self.stack.pop()
+      self.finish(name, before, self.stack[-1] if len(self.stack) > 0 else None)
+      print("Phase "+name+": "+"%.2f" % self.events[-1]["wall_seconds"]+"s")
+
+  def mark(self, name):
+    # switch to a new sub phase of the current phase, None ends the current sub phase
+    if self.subphase is not None:
+      subphase, before = self.subphase
+      self.finish(self.stack[-1]+": "+subphase, before, self.stack[-1])
+      self.subphase = None
+    if name is not None and len(self.stack) > 0:
+      self.subphase = (name, self.usage())
+
+  def total(self):
+    return time.time() - self.start
+
+  def chrome_trace(self):
+    events = []
+    for event in self.events:
+      events.append({
+        "name" : event["name"],
+        "cat"  : "subphase" if event["parent"] is not None else "phase",
+        "ph"   : "X",
+        "pid"  : os.getpid(),
+        "tid"  : 1,
+        "ts"   : int(event["start"] * 1000000),
+        "dur"  : int(event["wall_seconds"] * 1000000),
+        "args" : {
+          "cpu_seconds"          : event["cpu_seconds"],
+          "children_cpu_seconds" : event["children_cpu_seconds"],
+          "children_max_rss_kb"  : event["children_max_rss_kb"],
+        },
+      })
+    return { "traceEvents": events, "displayTimeUnit": "ms" }
+
+  def write(self, build_dir):
+    PackageManagerBase().mkdir_p(build_dir)
+    content = {
+      "start"         : datetime.datetime.fromtimestamp(self.start).isoformat(),
+      "total_seconds" : round(self.total(), 6),
+      "phases"        : self.events,
+    }
+    for filename, data in [ ("trace.json", content), ("trace-chrome.json", self.chrome_trace()) ]:
+      fullpath = os.path.join(build_dir, filename)
+      with open(fullpath + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+      os.replace(fullpath + ".tmp", fullpath)
+
+
+class BuildMetrics:
+  # Metrics of every build run, as a textfile for the node exporter (one file per profile,
+  # replaced atomically) and as a json line appended to <build_root>/metrics/history.jsonl.
+  # Metrics of a root (size, files, packages, pruned bytes) are measured once, when it is
+  # published, and kept in roots/<id>/metrics.json.
+  def __init__(self, configuration):
+    self.configuration = configuration
+    work = configuration['work']
+    self.history_file  = os.path.join(work['build_root'], "metrics", "history.jsonl")
+    self.textfile_dir  = work.get('metrics_textfile_dir', os.path.join(work['build_root'], "metrics"))
+
+  def installed_packages(self, install_dir, runner):
+    apk_db = os.path.join(install_dir, "lib", "apk", "db", "installed")
+    if os.path.exists(apk_db):
+      with open(apk_db, encoding="utf-8", errors="replace") as f:
+        return sum(1 for line in f if line.startswith("P:"))
+    result = runner.run([ 'rpm', '--root', install_dir, '-qa' ], capture=True, echo=False)
+    if result.returncode != 0:
+      return None
+    return len(result.output.split())
+
+  def measure_root(self, root_dir, outputs, runner):
+    # root_dir contains rootfs, outputs are the ones of the rootfs steps
+    install_dir = os.path.join(root_dir, "rootfs")
+    inodes = set()
+    size   = 0
+    files  = 0
+    for path, st in ImageAnalyzer(install_dir, None).walk():
+      if stat.S_ISREG(st.st_mode):
+        files += 1
+      if not (st.st_dev, st.st_ino) in inodes:
+        inodes.add((st.st_dev, st.st_ino))
+        size += st.st_blocks * 512
+    metrics = {
+      "rootfs_bytes"       : size,
+      "rootfs_files"       : files,
+      "installed_packages" : self.installed_packages(install_dir, runner),
+      "pruned_bytes"       : outputs.get("patch", {}).get("pruned", {}),
+      "dedup_saved_bytes"  : outputs.get("dedup", {}).get("saved"),
+    }
+    with open(os.path.join(root_dir, "metrics.json"), "w") as f:
+      json.dump(metrics, f, indent=2, sort_keys=True)
+    return metrics
+
+  def collect(self, trace, status, run_metrics):
+    configuration = self.configuration
+    target = configuration['target']
+    work   = configuration['work']
+    result = {
+      "time"            : datetime.datetime.now().isoformat(),
+      "profile"         : target['profile'],
+      "os_name"         : target['os_name'],
+      "os_version"      : str(target['os_version']),
+      "package_manager" : target.get('package_manager'),
+      "build_datetime"  : work['build_datetime'],
+      "exit_status"     : status,
+      "duration_seconds": round(trace.total(), 6),
+      "phases"          : { event["name"]: event["wall_seconds"] for event in trace.events if event["parent"] is None },
+    }
+    result.update(run_metrics)
+    link = work['install_dir']
+    if os.path.islink(link):
+      root_dir = os.path.dirname(os.path.realpath(link))
+      result["root"] = os.path.basename(root_dir)
+      try:
+        with open(os.path.join(root_dir, "metrics.json")) as f:
+          result.update(json.load(f))
+      except (OSError, ValueError):
+        pass
+    return result
+
+  def escape(self, value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+  def textfile(self, metrics):
+    labels = "profile=\""+self.escape(metrics["profile"])+"\",os_name=\""+self.escape(metrics["os_name"])+"\",os_version=\""+self.escape(metrics["os_version"])+"\""
+    samples = collections.OrderedDict()
+    def add(name, help, value, extra=""):
+      if value is None:
+        return
+      samples.setdefault(name, (help, []))[1].append(("{"+labels+extra+"}", value))
+    add("imagebuild_build_exit_status",       "Exit status of the last build.", metrics["exit_status"])
+    add("imagebuild_build_success",           "1 if the last build succeeded.", 1 if metrics["exit_status"] == 0 else 0)
+    add("imagebuild_build_timestamp_seconds", "End of the last build.", round(time.time(), 3))
+    add("imagebuild_build_duration_seconds",  "Wall time of the last build.", metrics["duration_seconds"])
+    for phase, seconds in sorted(metrics["phases"].items()):
+      add("imagebuild_phase_duration_seconds", "Wall time of a phase of the last build.", seconds, ",phase=\""+self.escape(phase)+"\"")
+    add("imagebuild_rootfs_bytes",            "Disk usage of the published root.", metrics.get("rootfs_bytes"))
+    add("imagebuild_rootfs_files",            "Regular files of the published root.", metrics.get("rootfs_files"))
+    add("imagebuild_installed_packages",      "Packages installed in the published root.", metrics.get("installed_packages"))
+    for rule, size in sorted((metrics.get("pruned_bytes") or {}).items()):
+      add("imagebuild_pruned_bytes",          "Bytes removed by a prune rule.", size, ",rule=\""+self.escape(rule)+"\"")
+    add("imagebuild_dedup_saved_bytes",       "Bytes saved by hardlinking duplicate files.", metrics.get("dedup_saved_bytes"))
+    cache = metrics.get("package_cache")
+    if cache is not None:
+      add("imagebuild_package_cache_hits",    "Packages of the last install found in the package cache.", cache["hits"])
+      add("imagebuild_package_cache_misses",  "Packages of the last install downloaded.", cache["misses"])
+      add("imagebuild_downloaded_bytes",      "Bytes downloaded by the last install.", cache["downloaded_bytes"])
+      if cache["hits"] + cache["misses"] > 0:
+        add("imagebuild_package_cache_hit_ratio", "Hit ratio of the package cache in the last install.", round(cache["hits"] / float(cache["hits"] + cache["misses"]), 6))
+    lines = []
+    for name, (help, values) in samples.items():
+      lines.append("# HELP "+name+" "+help)
+      lines.append("# TYPE "+name+" gauge")
+      for label_set, value in values:
+        lines.append(name+label_set+" "+str(value))
+    return "\n".join(lines)+"\n"
+
+  def write(self, trace, status, run_metrics):
+    metrics = self.collect(trace, status, run_metrics)
+    try:
+      PackageManagerBase().mkdir_p(self.textfile_dir)
+      filename = os.path.join(self.textfile_dir, "imagebuild-"+metrics["os_name"]+"-"+metrics["os_version"]+"-"+metrics["profile"]+".prom")
+      # the node exporter must never read a partial file
+      tmp = filename + ".tmp." + str(os.getpid())
+      with open(tmp, "w") as f:
+        f.write(self.textfile(metrics))
+      os.replace(tmp, filename)
+      PackageManagerBase().mkdir_p(os.path.dirname(self.history_file))
+      with open(self.history_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(metrics, sort_keys=True)+"\n")
+    except OSError as exc:
+      print("Cannot write the metrics: "+str(exc))
+    return metrics
+
+
+class PackageManagerOutput:
+  # Splits the install phase into sub phases by the progress messages of the package manager,
+  # these are the ones of dnf / yum, other backends bring their own
+  markers = [
+    (re.compile(rb'^Downloading [Pp]ackages', re.M),  "download"),
+    (re.compile(rb'^Running transaction check', re.M), "transaction check"),
+    (re.compile(rb'^Running transaction test', re.M),  "transaction test"),
+    (re.compile(rb'^Running transaction\s*$', re.M),  "transaction"),
+  ]
+
+  def __init__(self, trace, markers=None):
+    self.trace = trace
+    self.rest  = b''
+    if markers is not None:
+      self.markers = markers
+    self.trace.mark("metadata")
+
+  def parse(self, data):
+    # output arrives in chunks, only complete lines are matched
+    data = self.rest + data
+    end  = data.rfind(b'\n') + 1
+    self.rest = data[end:]
+    for pattern, name in self.markers:
+      if pattern.search(data, 0, end):
+        self.trace.mark(name)
+
+
+class PackageManagerBackend:
+  # A package manager which installs the root: its configuration file, command line,
+  # progress messages, and the paths it leaves in the install root.
+  # Paths are relative to the install root.
+  name          = None
+  command       = None
+  fallback      = []          # used in this order, when the command is not found
+  cache_dir     = None        # "cachedir" of the configuration, seeded from the package cache
+  state_dir     = None        # history and yumdb below it are pruned
+  log_name      = None        # <log_name>*.log in var/log are pruned
+  image_conf    = None        # configuration inside the image, patched for nodocs and proxy
+  hashed_repo_dirs = True     # repositories are cached in "<repoid>-<hash>", not in "<repoid>"
+  markers       = PackageManagerOutput.markers
+
+  def __init__(self, command=None):
+    # a command of the profile ("package_manager_command") replaces the one found in PATH
+    if command is not None:
+      self.command = command
+
+  def available(self):
+    return self.command is not None and shutil.which(self.command) is not None
+
+  def conf_file(self, build_dir):
+    return os.path.join(build_dir, "etc", self.name+".conf")
+
+  def conf(self, build_dir, http_proxy='', nodocs='', keepcache=0):
+    return RedhatPackageManager().create_package_manager_conf_file(self.name, build_dir, http_proxy, nodocs, keepcache, self.cache_dir)
+
+  def install_argv(self, conf_file, releasever, install_root, repo_list, package_list):
+    array=[]
+    array.append(self.command)
+    array.append("-y")
+    array.append("-c")
+    array.append(conf_file)
+    array.append("--releasever="+str(releasever))
+    array.append("--nogpg")
+    array.append("--installroot="+install_root)
+    array.append("--disablerepo=*")
+    array.extend(["--enablerepo="+repo for repo in repo_list])
+    array.append("install")
+    array.extend(package_list)
+    return array
+
+  def download_argv(self, install_argv):
+    # None: the packages cannot be downloaded without installing them
+    return install_argv[:2] + [ "--downloadonly" ] + install_argv[2:]
+
+
+class DnfBackend(PackageManagerBackend):
+  name       = "dnf"
+  command    = "dnf"
+  fallback   = [ "dnf5", "microdnf" ]
+  cache_dir  = "var/cache/dnf"
+  state_dir  = "var/lib/dnf"
+  log_name   = "dnf"
+  image_conf = "etc/dnf/dnf.conf"
+
+
+class YumBackend(PackageManagerBackend):
+  name       = "yum"
+  command    = "yum"
+  fallback   = [ "dnf" ]
+  cache_dir  = "var/cache/yum"
+  state_dir  = "var/lib/yum"
+  log_name   = "yum"
+  image_conf = "etc/yum.conf"
+  hashed_repo_dirs = False
+
+
+class Dnf5Backend(PackageManagerBackend):
+  # dnf5 has no "--disablerepo=*", "--repo=" enables only the given repositories;
+  # its system state is below /usr/lib/sysimage instead of /var/lib/dnf
+  name       = "dnf5"
+  command    = "dnf5"
+  fallback   = [ "dnf", "microdnf" ]
+  cache_dir  = "var/cache/libdnf5"
+  state_dir  = "usr/lib/sysimage/libdnf5"
+  log_name   = "dnf5"
+  image_conf = "etc/dnf/dnf.conf"
+  markers = [
+    (re.compile(rb'^Total size of inbound packages', re.M), "download"),
+    (re.compile(rb'^\[\d+/\d+\] Verify package files', re.M), "transaction check"),
+    (re.compile(rb'^\[\d+/\d+\] Prepare transaction', re.M), "transaction test"),
+    (re.compile(rb'^\[\d+/\d+\] Installing ', re.M),      "transaction"),
+  ]
+
+  def install_argv(self, conf_file, releasever, install_root, repo_list, package_list):
+    array = [ self.command, "-y", "--config="+conf_file, "--releasever="+str(releasever), "--no-gpgchecks", "--installroot="+install_root, "--use-host-config" ]
+    array.extend([ "--repo="+repo for repo in repo_list ])
+    if len(repo_list) == 0:
+      array.append("--disable-repo=*")
+    array.append("install")
+    array.extend(package_list)
+    return array
+
+  def download_argv(self, install_argv):
+    # "--downloadonly" is an option of the install command
+    index = install_argv.index("install") + 1
+    return install_argv[:index] + [ "--downloadonly" ] + install_argv[index:]
+
+
+class MicrodnfBackend(PackageManagerBackend):
+  # microdnf (libdnf) is small enough for minimal build hosts, but it has no download only mode
+  name       = "microdnf"
+  command    = "microdnf"
+  fallback   = [ "dnf5", "dnf" ]
+  cache_dir  = "var/cache/yum"
+  state_dir  = "var/lib/dnf"
+  log_name   = "dnf"
+  image_conf = "etc/dnf/dnf.conf"
+  markers = [
+    (re.compile(rb'^Downloading packages', re.M),       "download"),
+    (re.compile(rb'^Running transaction test', re.M),   "transaction test"),
+    (re.compile(rb'^Installing: ', re.M),               "transaction"),
+  ]
+
+  def install_argv(self, conf_file, releasever, install_root, repo_list, package_list):
+    array = [ self.command, "-y", "--config="+conf_file, "--releasever="+str(releasever), "--nogpgcheck", "--noplugins", "--installroot="+install_root, "--disablerepo=*" ]
+    array.extend([ "--enablerepo="+repo for repo in repo_list ])
+    array.append("install")
+    array.extend(package_list)
+    return array
+
+  def download_argv(self, install_argv):
+    return None
+
+
+class ApkBackend(PackageManagerBackend):
+  name     = "apk"
+  command  = "apk"
+  markers  = []
+
+  def conf(self, build_dir, http_proxy='', nodocs='', keepcache=0):
+    return None
+
+  def install_argv(self, conf_file, releasever, install_root, repo_list, package_list):
+    array = [ self.command ]
+    for repo in repo_list:
+      array.extend(["--repository", repo])
+    array.extend([ '--root', install_root, '--allow-untrusted', '--update-cache', '--initdb', '--no-progress', 'add' ])
+    array.extend(package_list)
+    return array
+
+  def download_argv(self, install_argv):
+    return None
+
+
+class FakeBackend(DnfBackend):
+  # A local stub ("package_manager_command") called like dnf, for tests and benchmarks
+  # of everything around the package manager. There is nothing to fall back to.
+  name       = "fake"
+  command    = None
+  fallback   = []
+  log_name   = "fake"
+  image_conf = None
+
+
+package_manager_backends = {
+  "dnf"      : DnfBackend,
+  "yum"      : YumBackend,
+  "dnf5"     : Dnf5Backend,
+  "microdnf" : MicrodnfBackend,
+  "apk"      : ApkBackend,
+  "fake"     : FakeBackend,
+}
+
+
+def package_manager_backend(name, command=None):
+  if not name in package_manager_backends:
+    raise ValueError("unknown package manager "+str(name)+", known are "+", ".join(sorted(package_manager_backends)))
+  return package_manager_backends[name](command)
+
+
+def select_package_manager(names, command=None):
+  # "package_manager" of a profile is a name or a list of names in the order of preference,
+  # followed by the fallbacks of each; the first one found on the build host is used
+  if not isinstance(names, list):
+    names = [ names ]
+  candidates = []
+  for name in names:
+    for candidate in [ name ] + package_manager_backend(name).fallback:
+      if not candidate in candidates:
+        candidates.append(candidate)
+  for candidate in candidates:
+    # the command of the profile belongs to the first choice only
+    if package_manager_backend(candidate, command if candidate == names[0] else None).available():
+      if candidate != names[0]:
+        print("Package manager "+names[0]+" not found, using "+candidate)
+      return candidate
+  print("Package manager "+names[0]+" not found")
+  return names[0]
+
+
+class PackageCache:
+  # Layout below the cache directory:
+  #   blobs/<sha256>       content addressed package files
+  #   nevra/<nevra>.rpm    hardlink to the blob of a package
+  #   tree/<pm>/...        hardlinks in the layout of the cache directory of <pm> in an install root
+  # Everything is a hardlink or an atomic rename, so concurrent builds can share the cache.
+
+  def __init__(self, cache_dir, runner=None):
+    self.cache_dir = cache_dir
+    self.runner    = runner if runner is not None else ProcessRunner()
+    self.seeded    = set()
+    self.hits      = 0
+    self.misses    = 0
+    self.downloaded_bytes = 0
+
+  def link_or_copy(self, src, dst):
+    # renaming a hardlink over the same file would leave the temporary link behind
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+      return
+    tmp = dst + ".tmp." + str(os.getpid()) + "." + str(threading.get_ident())
+    try:
+      os.link(src, tmp)
+    except OSError as exc:
+      if exc.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+        shutil.copy2(src, tmp)
+      else:
+        raise
+    os.replace(tmp, dst)
+
+  def checksum(self, filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(1024*1024), b''):
+        h.update(block)
+    return h.hexdigest()
+
+  def blob_path(self, checksum):
+    return os.path.join(self.cache_dir, "blobs", checksum)
+
+  def tree_dir(self, package_manager):
+    return os.path.join(self.cache_dir, "tree", package_manager)
+
+  def seed(self, install_dir, package_manager, os_version):
+    # only the part of the tree matching "cachedir=/<cache_dir of the backend>/$basearch/$releasever"
+    relative = os.path.join(os.uname().machine, str(os_version))
+    source   = os.path.join(self.tree_dir(package_manager), relative)
+    target   = os.path.join(install_dir, package_manager_backend(package_manager).cache_dir, relative)
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(source):
+      target_dir = os.path.join(target, os.path.relpath(dirpath, source))
+      PackageManagerBase().mkdir_p(target_dir)
+      for filename in filenames:
+        dst = os.path.join(target_dir, filename)
+        if os.path.exists(dst):
+          continue
+        self.link_or_copy(os.path.join(dirpath, filename), dst)
+        st = os.stat(dst)
+        self.seeded.add((st.st_dev, st.st_ino))
+        count += 1
+    print("Package cache: seeded "+str(count)+" packages from "+source)
+    return count
+
+  def store(self, filename):
+    checksum = self.checksum(filename)
+    blob = self.blob_path(checksum)
+    if not os.path.exists(blob):
+      PackageManagerBase().mkdir_p(os.path.dirname(blob))
+      self.link_or_copy(filename, blob)
+    try:
+      nevra = RpmHeader(blob).nevra()
+      nevra_dir = os.path.join(self.cache_dir, "nevra")
+      PackageManagerBase().mkdir_p(nevra_dir)
+      self.link_or_copy(blob, os.path.join(nevra_dir, nevra+".rpm"))
+    except (ValueError, KeyError, struct.error) as exc:
+      print("Package cache: cannot read header of "+filename+": "+str(exc))
+    return blob
+
+  def harvest(self, install_dir, package_manager):
+    source = os.path.join(install_dir, package_manager_backend(package_manager).cache_dir)
+    tree   = self.tree_dir(package_manager)
+    for dirpath, dirnames, filenames in os.walk(source):
+      for filename in filenames:
+        if not filename.endswith(".rpm"):
+          continue
+        fullpath = os.path.join(dirpath, filename)
+        st = os.stat(fullpath)
+        if (st.st_dev, st.st_ino) in self.seeded:
+          continue
+        self.misses += 1
+        self.downloaded_bytes += st.st_size
+        blob = self.store(fullpath)
+        target_dir = os.path.join(tree, os.path.relpath(dirpath, source))
+        PackageManagerBase().mkdir_p(target_dir)
+        self.link_or_copy(blob, os.path.join(target_dir, filename))
+        # harvested once, a later harvest of the same root must not count it again
+        self.seeded.add((st.st_dev, st.st_ino))
+
+  def count_hits(self, install_dir, start_time):
+    # A hit is a package installed by this transaction, which was not downloaded
+    cmd = ['rpm', '--root', install_dir, '-qa', '--qf', '%{INSTALLTIME}\n']
+    result = self.runner.run(cmd, capture=True, echo=False)
+    if result.returncode != 0:
+      return None
+    installed = [line for line in result.output.split() if line.isdigit() and int(line) >= int(start_time)]
+    self.hits = max(len(installed) - self.misses, 0)
+    return self.hits
+
+  def report(self):
+    result = "Package cache: "+str(self.hits)+" hits, "+str(self.misses)+" misses"
+    result += ", "+str(self.downloaded_bytes)+" bytes downloaded"
+    total = self.hits + self.misses
+    if total > 0:
+      result += " (hit ratio "+"%.1f" % (100.0 * self.hits / total)+"%)"
+    return result
+
+
+# lists accepting the "key+" / "key-" operators; the keys of the path maps are
+# file names (/usr/bin/g++) and never operators
+list_operator_keys = [ "package_list", "package_list_add", "repo_list", "rules" ]
+path_keyed_maps    = [ "symlinks", "dirs" ]
+
+def list_operator(key, value, operators=True):
+  return operators and isinstance(key, str) and key[-1:] in ( "+", "-" ) and key[:-1] in list_operator_keys and isinstance(value, list)
+
+def merge_recursive(target, source, operators=True):
   for key in source:
     value = source[key]
+    # "key+" / "key-" add items to / remove items from the list "key"
+    if list_operator(key, value, operators):
+      merge_list_operator(target, key[:-1], key[-1], value)
     # Dictionaries in dictionaries need special treatment
-    if key in target and isinstance(value, dict):
+    elif key in target and isinstance(value, dict):
       tmp_target = target[key]
-      merge_recursive(tmp_target,value)
+      merge_recursive(tmp_target, value, operators and not key in path_keyed_maps)
       target[key] = tmp_target
     else:
       target[key]  = value
+      # a whole list replaces the additions and removals before it
+      if operators and key in list_operator_keys:
+        target.pop(key+"+", None)
+        target.pop(key+"-", None)
+
+
+def merge_list_operator(target, name, operator, items):
+  if isinstance(target.get(name), list):
+    if operator == "+":
+      target[name] = target[name] + [ item for item in items if not item in target[name] ]
+    else:
+      target[name] = [ item for item in target[name] if not item in items ]
+    return
+  # without the list (package_list is a default of the os) the operators are kept
+  # and applied by apply_list_operators, when the defaults are known
+  added   = target.setdefault(name+"+", [])
+  removed = target.setdefault(name+"-", [])
+  if operator == "-":
+    added, removed = removed, added
+  added.extend([ item for item in items if not item in added ])
+  removed[:] = [ item for item in removed if not item in items ]
+
+
+def apply_list_operators(configuration):
+  for key in configuration:
+    if isinstance(configuration[key], dict) and not key in path_keyed_maps:
+      apply_list_operators(configuration[key])
+  names = set(key[:-1] for key in configuration if list_operator(key, configuration[key]))
+  for name in names:
+    added   = configuration.pop(name+"+", [])
+    removed = configuration.pop(name+"-", [])
+    base    = [ item for item in configuration.get(name, []) if not item in removed ]
+    configuration[name] = base + [ item for item in added if not item in base ]
+
+
+class ProfileResolver:
+  # Profiles parsed with the C yaml loader, with their "extends:" chains merged (extended
+  # profiles first, in the order of the list, paths relative to the profile).
+  # Resolved profiles are cached in memory and in a json file, an entry is
+  #   { files: [ [ path, mtime_ns, size, sha256 ] ], config }
+  # It is valid as long as mtime and size of all files are unchanged; a file with a new
+  # mtime is hashed, and the entry stays valid if the content is the same.
+  def __init__(self, cache_file=None):
+    self.cache_file = cache_file
+    self.entries    = None
+    self.dirty      = False
+    self.parsed     = 0
+    self.hits       = 0
+    self.lock       = threading.RLock()
+
+  def load(self):
+    self.entries = {}
+    if self.cache_file is None:
+      return
+    try:
+      with open(self.cache_file) as f:
+        content = json.load(f)
+      if content.get("version") == 1:
+        self.entries = content["entries"]
+    except (OSError, ValueError, KeyError, AttributeError):
+      pass
+
+  def save(self):
+    with self.lock:
+      if not self.dirty or self.cache_file is None:
+        return
+      try:
+        PackageManagerBase().mkdir_p(os.path.dirname(self.cache_file))
+        tmp = self.cache_file + ".tmp." + str(os.getpid())
+        with open(tmp, "w") as f:
+          json.dump({ "version": 1, "entries": self.entries }, f)
+        os.replace(tmp, self.cache_file)
+        self.dirty = False
+      except OSError as exc:
+        print("Cannot write the profile cache "+self.cache_file+": "+str(exc))
+
+  def valid(self, entry):
+    for item in entry["files"]:
+      path, mtime_ns, size, digest = item
+      try:
+        st = os.stat(path)
+      except OSError:
+        return False
+      if st.st_mtime_ns == mtime_ns and st.st_size == size:
+        continue
+      if st.st_size != size or PackageCache(None).checksum(path) != digest:
+        return False
+      item[1] = st.st_mtime_ns
+      self.dirty = True
+    return True
+
+  def entry(self, filename, parents=()):
+    if filename in parents:
+      raise ValueError("profile "+filename+" extends itself: "+" -> ".join(parents + (filename,)))
+    if self.entries is None:
+      self.load()
+    entry = self.entries.get(filename)
+    if entry is not None and self.valid(entry):
+      self.hits += 1
+      return entry
+
+    with open(filename, "rb") as f:
+      st   = os.fstat(f.fileno())
+      data = f.read()
+    self.parsed += 1
+    own = yaml.load(data, Loader=YamlLoader)
+    if own is None:
+      own = {}
+    if not isinstance(own, dict):
+      raise ValueError("profile "+filename+" is not a mapping")
+    files   = [ [ filename, st.st_mtime_ns, st.st_size, hashlib.sha256(data).hexdigest() ] ]
+    extends = own.pop("extends", [])
+    config  = {}
+    for name in (extends if isinstance(extends, list) else [ extends ]):
+      parent = self.entry(os.path.join(os.path.dirname(filename), name), parents + (filename,))
+      merge_recursive(config, copy.deepcopy(parent["config"]))
+      files.extend([ item for item in parent["files"] if not item[0] in [ known[0] for known in files ] ])
+    merge_recursive(config, own)
+
+    entry = { "files": files, "config": config }
+    try:
+      json.dumps(config)
+    except (TypeError, ValueError):
+      # values json cannot keep (dates) are parsed again next time
+      return entry
+    self.entries[filename] = entry
+    self.dirty = True
+    return entry
+
+  def resolve(self, filename):
+    with self.lock:
+      return copy.deepcopy(self.entry(os.path.abspath(filename))["config"])
+
+
+profile_resolver = ProfileResolver()
 
 
 def merge_config(filename, configuration): 
   if os.path.exists(filename):
-    f = open(filename, 'r')
-    y = yaml.load(f)
-    f.close()
-    merge_recursive(configuration, y)
+    merge_recursive(configuration, profile_resolver.resolve(filename))
 
 class Patch:
   def __init__(self):
     pass 
 
-  def apply(self, target_lang, target_package_manager, install_dir, nodocs, proxy_url):
+  def apply(self, target_lang, target_package_manager, install_dir, nodocs, proxy_url, prune=None):
     self.install_dir = install_dir
     self.target_lang = target_lang
+    self.prune       = prune
 
-    if target_package_manager == "dnf":
-      self.dnf_conf(nodocs,proxy_url)
-    elif target_package_manager == "yum":
-      self.yum_conf(nodocs,proxy_url)
+    image_conf = package_manager_backend(target_package_manager).image_conf
+    if image_conf is not None:
+      self.conf(nodocs, proxy_url, image_conf)
 
     content = self.locale_content()
 #    print(content)
@@ -420,7 +3218,7 @@ class Patch:
 #    print(content)
     self.locale_conf()
     self.adjtime()
-    self.clean(install_dir, target_package_manager)
+    return self.clean(install_dir, target_package_manager)
 
   def locale_conf(self, filename="/etc/locale.conf"):
     print("Patching /etc/locale.conf")
@@ -432,8 +3230,9 @@ class Patch:
     content = self.adjtime_content()
     self.tofile(content, self.install_dir + filename)
 
-  def dnf_conf(self, nodocs, proxy, filename="etc/dnf/dnf.conf"):
-    print("Patching /etc/dnf/dnf.conf")
+  def conf(self, nodocs, proxy, filename="etc/dnf/dnf.conf"):
+    # the configuration of the package manager inside the image (dnf.conf, yum.conf)
+    print("Patching /"+filename)
     configParser = configparser.ConfigParser()
     fullpath     = os.path.join(self.install_dir, filename)
 
@@ -451,22 +3250,6 @@ class Patch:
     configParser.write(out, space_around_delimiters=False)
     out.close()
 
-  def yum_conf(self, nodocs, proxy, filename="etc/yum.conf"):
-    print("Patching /"+filename)
-    configParser = configparser.ConfigParser()
-    fullpath     = os.path.join(self.install_dir, filename)
-    print(fullpath)
-    configParser.read(fullpath)
-
-    if nodocs == 1:
-      configParser.set('main', 'tsflags', 'nodocs')
-    if len(proxy) > 0:
-      configParser.set('main', 'proxy', proxy)
-
-    out = open(fullpath, 'w')
-    configParser.write(out, space_around_delimiters=False)
-    out.close()
-
 
 
  
@@ -485,35 +3268,646 @@ class Patch:
     return "0.0 0 0.0\n0\nUTC\n"
 
   def clean(self,install_root, package_manager):
-    self.test=""
+    pruner = Pruner(install_root, package_manager, self.target_lang, self.prune)
+    return pruner.run()
+
+
+class Pruner:
+  # Rules remove everything matching below "path" (relative to the install root).
+  # type:      "f" files, "d" directories, "" both
+  # match:     shell patterns for the names, default "*"
+  # mindepth/maxdepth: like find, depth 1 are the entries in "path"
+  # keep:      names which are never removed
+  # action:    "remove" or "truncate"
+  # %package_manager%, %state_dir%, %cache_dir% and %log_name% are the ones of the package manager backend
+  rules = {
+    "history"       : { "path": "%state_dir%/history", "type": "f" },
+    "yumdb"         : { "path": "%state_dir%/yumdb", "type": "d", "mindepth": 2, "maxdepth": 2 },
+    "package_cache" : { "path": "%cache_dir%", "type": "f" },
+    "logs"          : { "path": "var/log", "type": "f", "match": [ "%log_name%*.log", "hawkey.log" ], "maxdepth": 1 },
+    "lastlog"       : { "path": "var/log/lastlog", "action": "truncate" },
+    "docs"          : { "path": "usr/share/doc", "mindepth": 1, "maxdepth": 1 },
+    "man"           : { "path": [ "usr/share/man", "usr/share/info" ], "mindepth": 1, "maxdepth": 1 },
+    "locales"       : { "path": "usr/share/locale", "type": "d", "mindepth": 1, "maxdepth": 1, "keep": [ "%lang%" ] },
+    "pycache"       : { "path": "usr", "type": "d", "match": "__pycache__" },
+  }
+  default_rules = [ "history", "yumdb", "package_cache", "logs", "lastlog" ]
+
+  def __init__(self, install_root, package_manager, target_lang="en_US.UTF-8", config=None, batch_size=512):
+    self.install_root    = install_root
+    self.package_manager = package_manager
+    self.backend         = package_manager_backend(package_manager)
+    self.target_lang     = target_lang if isinstance(target_lang, list) else [ target_lang ]
+    self.batch_size      = batch_size
+    if config is None:
+      config = {}
+    self.rules = dict(Pruner.rules)
+    self.rules.update(config.get("custom", {}))
+    self.enabled = list(config.get("rules", Pruner.default_rules)) + [ name for name in config.get("custom", {}) if not name in config.get("rules", []) ]
+    self.reclaimed = {}
+
+  def as_list(self, value):
+    if value is None:
+      return []
+    return value if isinstance(value, list) else [ value ]
+
+  def lang_names(self):
+    # "de_DE.UTF-8" keeps de_DE.UTF-8, de_DE.utf8, de_DE and de
+    names = set()
+    for lang in self.target_lang:
+      names.add(lang)
+      names.add(lang.replace(".UTF-8", ".utf8"))
+      base = lang.split(".")[0]
+      names.add(base)
+      names.add(base.split("_")[0])
+    return names
+
+  def expand(self, value):
+    value = value.replace("%state_dir%", str(self.backend.state_dir))
+    value = value.replace("%cache_dir%", str(self.backend.cache_dir))
+    value = value.replace("%log_name%",  str(self.backend.log_name))
+    return value.replace("%package_manager%", self.package_manager)
+
+  def entry_size(self, path, st):
+    # bytes really freed, files with other hardlinks do not count
+    if stat.S_ISDIR(st.st_mode):
+      size = 0
+      for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+          try:
+            fst = os.lstat(os.path.join(dirpath, filename))
+          except OSError:
+            continue
+          if fst.st_nlink == 1:
+            size += fst.st_size
+      return size
+    return st.st_size if st.st_nlink == 1 else 0
+
+  def matches(self, rule, path, depth=1):
+    type     = rule.get("type", "")
+    patterns = [ self.expand(pattern) for pattern in self.as_list(rule.get("match", "*")) ]
+    mindepth = rule.get("mindepth", 1)
+    maxdepth = rule.get("maxdepth", sys.maxsize)
+    keep     = set()
+    for name in self.as_list(rule.get("keep")):
+      if name == "%lang%":
+        keep |= self.lang_names()
+      else:
+        keep.add(name)
 
-    array = ['find', install_root+'/var/lib/'+package_manager+'/history', '-type' , 'f', '-exec', 'rm', '{}', ';']
-    print(array)
-    subprocess.call(array)
+    try:
+      it = os.scandir(path)
+    except FileNotFoundError:
+      return
+    with it:
+      for entry in it:
+        if entry.name in keep:
+          continue
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if depth >= mindepth:
+          if (type == "" or (type == "d") == is_dir) and any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in patterns):
+            yield entry.path, entry.stat(follow_symlinks=False)
+            continue
+        if is_dir and depth < maxdepth:
+          yield from self.matches(rule, entry.path, depth + 1)
+
+  def remove_batch(self, batch):
+    for path, is_dir in batch:
+      try:
+        if is_dir:
+          shutil.rmtree(path)
+        else:
+          os.unlink(path)
+      except FileNotFoundError:
+        pass
+
+  def apply_rule(self, executor, name, rule):
+    count = 0
+    size  = 0
+    futures = []
+    for path in self.as_list(rule.get("path")):
+      fullpath = os.path.join(self.install_root, self.expand(path).lstrip("/"))
+      if rule.get("action", "remove") == "truncate":
+        if not os.path.isdir(os.path.dirname(fullpath)):
+          continue
+        if os.path.isfile(fullpath):
+          size += self.entry_size(fullpath, os.lstat(fullpath))
+          count += 1
+        with open(fullpath, "w"):
+          pass
+        continue
+      batch = []
+      for match, st in self.matches(rule, fullpath):
+        count += 1
+        size  += self.entry_size(match, st)
+        batch.append((match, stat.S_ISDIR(st.st_mode)))
+        if len(batch) >= self.batch_size:
+          futures.append(executor.submit(self.remove_batch, batch))
+          batch = []
+      if len(batch) > 0:
+        futures.append(executor.submit(self.remove_batch, batch))
+    for future in futures:
+      future.result()
+    return count, size
+
+  def run(self):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+      for name in self.enabled:
+        if not name in self.rules:
+          print("Unknown prune rule "+name)
+          continue
+        count, size = self.apply_rule(executor, name, self.rules[name])
+        self.reclaimed[name] = size
+        print("Pruned "+name+": "+str(count)+" entries, "+str(size)+" bytes")
+    print("Pruned "+str(sum(self.reclaimed.values()))+" bytes in total")
+    return self.reclaimed
+
+
+class Deduplicator:
+  # Replaces byte-identical files with hardlinks to one of them. Files are grouped by size,
+  # only candidates with equal sizes are hashed. Owner, mode and xattrs must match too.
+  # By default only below usr and opt: files in etc and var are modified in place.
+  def __init__(self, install_root, config=None):
+    config = config if isinstance(config, dict) else {}
+    self.install_root = install_root
+    self.paths        = config.get("paths", [ "usr", "opt" ])
+    self.min_size     = config.get("min_size", 1024)
+    self.workers      = config.get("workers", os.cpu_count() or 1)
+    self.linked       = 0
+    self.saved        = 0
+
+  def candidates(self):
+    # size -> { inode: [ paths ] }
+    sizes = {}
+    for path in self.paths:
+      root = os.path.join(self.install_root, path)
+      if not os.path.isdir(root):
+        continue
+      for relpath, fullpath, st in TarStreamWriter().walk(root):
+        if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+          continue
+        inodes = sizes.setdefault(st.st_size, {})
+        inodes.setdefault((st.st_dev, st.st_ino), ([], st))[0].append(fullpath)
+    return [ inodes for inodes in sizes.values() if len(inodes) > 1 ]
+
+  def key(self, paths, st):
+    return (PackageCache(None).checksum(paths[0]), st.st_uid, st.st_gid, st.st_mode,
+            tuple(sorted(TarStreamWriter().xattrs(paths[0]).items())))
+
+  def link(self, source, path):
+    tmp = path + ".dedup." + str(os.getpid())
+    try:
+      os.link(source, tmp)
+    except OSError as exc:
+      if exc.errno == errno.EMLINK:
+        return False
+      raise
+    os.rename(tmp, path)
+    return True
+
+  def run(self):
+    start  = time.time()
+    groups = self.candidates()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+      futures = [ (inodes, { inode: executor.submit(self.key, paths, st) for inode, (paths, st) in inodes.items() }) for inodes in groups ]
+      for inodes, keys in futures:
+        by_key = {}
+        for inode, future in keys.items():
+          by_key.setdefault(future.result(), []).append(inodes[inode])
+        for duplicates in by_key.values():
+          if len(duplicates) < 2:
+            continue
+          # the inode with the first path stays, so repeated builds link the same way
+          duplicates.sort(key=lambda entry: min(entry[0]))
+          source = duplicates[0][0][0]
+          full   = False
+          for paths, st in duplicates[1:]:
+            # the data is only freed with the last link of the inode, which can be outside the paths
+            remaining = st.st_nlink
+            for path in sorted(paths):
+              if not self.link(source, path):
+                full = True
+                break
+              self.linked += 1
+              remaining   -= 1
+            if remaining == 0:
+              self.saved += st.st_blocks * 512
+            if full:
+              break
+    print("Dedup: "+str(self.linked)+" files hardlinked, "+format_size(self.saved)+" saved in "+"%.2f" % (time.time() - start)+"s")
+    return self.saved
+
+
+class ImageAnalyzer:
+  # Index of every file of an install root in sqlite: size, blocks, hardlink identity, owning
+  # package (rpmdb, or the apk database) and category. Every inode is counted once, for the
+  # first of its paths, so the sums of a report add up to the size of the root.
+  categories = [
+    ( "docs",     [ "usr/share/doc/", "usr/share/man/", "usr/share/info/", "usr/share/gtk-doc/" ] ),
+    ( "locale",   [ "usr/share/locale/", "usr/lib/locale/", "usr/share/i18n/" ] ),
+    ( "cache",    [ "var/cache/" ] ),
+    ( "logs",     [ "var/log/" ] ),
+    ( "devel",    [ "usr/include/" ] ),
+    ( "firmware", [ "usr/lib/firmware/" ] ),
+    ( "modules",  [ "usr/lib/modules/" ] ),
+  ]
+
+  def __init__(self, install_dir, db_file, runner=None, workers=None):
+    self.install_dir = install_dir
+    self.db_file     = db_file
+    self.runner      = runner if runner is not None else ProcessRunner()
+    self.workers     = workers or min(32, 4 * (os.cpu_count() or 1))
+    self.errors      = 0
+
+  def scan(self, relpath):
+    rows = []
+    dirs = []
+    try:
+      with os.scandir(os.path.join(self.install_dir, relpath) if relpath != "" else self.install_dir) as it:
+        for entry in it:
+          path = entry.name if relpath == "" else relpath+"/"+entry.name
+          st = entry.stat(follow_symlinks=False)
+          if stat.S_ISDIR(st.st_mode):
+            dirs.append(path)
+          rows.append((path, st))
+    except OSError:
+      self.errors += 1
+    return rows, dirs
+
+  def walk(self):
+    # one parallel walk, every directory is a task; stat releases the GIL
+    entries = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+      pending = { executor.submit(self.scan, "") }
+      while len(pending) > 0:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          rows, dirs = future.result()
+          entries.extend(rows)
+          pending |= set(executor.submit(self.scan, path) for path in dirs)
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+  def owners(self):
+    # path (relative to the root) -> package
+    owners = {}
+    apk_db = os.path.join(self.install_dir, "lib", "apk", "db", "installed")
+    if os.path.exists(apk_db):
+      package = None
+      directory = ""
+      with open(apk_db, encoding="utf-8", errors="replace") as f:
+        for line in f:
+          key, value = line[:2], line[2:].rstrip("\n")
+          if key == "P:":
+            package = value
+          elif key == "F:":
+            directory = value
+            owners.setdefault(directory, package)
+          elif key == "R:":
+            owners.setdefault(directory+"/"+value if directory != "" else value, package)
+      return owners
+    result = self.runner.run([ 'rpm', '--root', self.install_dir, '-qa', '--qf', '[%{=NAME}\t%{FILENAMES}\n]' ], capture=True, echo=False)
+    if result.returncode != 0:
+      print("Analyze: no package database readable in "+self.install_dir)
+      return owners
+    for line in result.output.decode('utf-8', 'surrogateescape').splitlines():
+      package, sep, path = line.partition("\t")
+      if sep != "" and path.startswith("/"):
+        owners.setdefault(path[1:], package)
+    return owners
+
+  def category(self, path):
+    if "/__pycache__/" in path:
+      return "pycache"
+    for name, prefixes in ImageAnalyzer.categories:
+      for prefix in prefixes:
+        if path.startswith(prefix):
+          return name
+    return "other"
+
+  def index(self):
+    start   = time.time()
+    entries = self.walk()
+    owners  = self.owners()
+    counted = set()
+    rows    = []
+    for path, st in entries:
+      if stat.S_ISDIR(st.st_mode):
+        type = "d"
+      elif stat.S_ISREG(st.st_mode):
+        type = "f"
+      elif stat.S_ISLNK(st.st_mode):
+        type = "l"
+      else:
+        type = "o"
+      inode = (st.st_dev, st.st_ino)
+      first = 0 if inode in counted else 1
+      counted.add(inode)
+      parts = path.split("/")
+      rows.append((path, type, st.st_size, st.st_blocks * 512, st.st_ino, st.st_nlink, first,
+                   owners.get(path), self.category(path), "/".join(parts[:min(3, len(parts) - 1)]) or "."))
+
+    PackageManagerBase().mkdir_p(os.path.dirname(self.db_file))
+    tmp = self.db_file + ".tmp." + str(os.getpid())
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute("CREATE TABLE files (path TEXT PRIMARY KEY, type TEXT, size INTEGER, blocks INTEGER, ino INTEGER, nlink INTEGER, counted INTEGER, package TEXT, category TEXT, dir TEXT)")
+    db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+    db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    db.executemany("INSERT INTO info VALUES (?, ?)", [ ("root", self.install_dir), ("created", datetime.datetime.now().isoformat()) ])
+    db.commit()
+    db.close()
+    os.replace(tmp, self.db_file)
+    print("Analyze: "+str(len(rows))+" entries, "+str(len(owners))+" owned paths indexed in "+"%.2f" % (time.time() - start)+"s"+
+          (", "+str(self.errors)+" directories not readable" if self.errors > 0 else ""))
+    return self.db_file
+
+  def report(self, top=20, db_file=None):
+    db = sqlite3.connect(db_file or self.db_file)
+    total, = db.execute("SELECT SUM(blocks) FROM files WHERE counted").fetchone()
+    total  = total or 0
+    print("Image size: "+format_size(total)+" on disk")
+    for title, column in [ ("package", "COALESCE(package, '(not owned)')"), ("directory", "dir"), ("category", "category") ]:
+      print("")
+      print("%-40s %10s %7s %8s" % ("by "+title, "disk", "share", "files"))
+      for name, blocks, files in db.execute("SELECT "+column+" AS name, SUM(blocks * counted), SUM(type = 'f') FROM files GROUP BY name ORDER BY 2 DESC LIMIT ?", (top,)):
+        print("%-40s %10s %6.1f%% %8d" % (name[:40], format_size(blocks), 100.0 * blocks / max(total, 1), files))
+    db.close()
+
+  def diff(self, old_db_file, top=20, db_file=None):
+    # size changes from an older index to this one
+    db = sqlite3.connect(db_file or self.db_file)
+    db.execute("ATTACH DATABASE ? AS old", (old_db_file,))
+    for title, column in [ ("package", "COALESCE(package, '(not owned)')"), ("directory", "dir"), ("category", "category") ]:
+      print("")
+      print("%-40s %10s %10s %10s" % ("by "+title, "before", "after", "change"))
+      rows = db.execute(
+        "SELECT name, SUM(before), SUM(after) FROM ("+
+        " SELECT "+column+" AS name, 0 AS before, blocks * counted AS after FROM main.files"+
+        " UNION ALL SELECT "+column+" AS name, blocks * counted AS before, 0 AS after FROM old.files)"+
+        " GROUP BY name HAVING SUM(before) != SUM(after) ORDER BY ABS(SUM(after) - SUM(before)) DESC LIMIT ?", (top,))
+      for name, before, after in rows:
+        print("%-40s %10s %10s %10s" % (name[:40], format_size(before), format_size(after), ("+" if after >= before else "-")+format_size(abs(after - before))))
+    added,   = db.execute("SELECT COUNT(*) FROM main.files WHERE path NOT IN (SELECT path FROM old.files)").fetchone()
+    removed, = db.execute("SELECT COUNT(*) FROM old.files WHERE path NOT IN (SELECT path FROM main.files)").fetchone()
+    changed, = db.execute("SELECT COUNT(*) FROM main.files AS new JOIN old.files AS previous USING (path) WHERE new.size != previous.size OR new.type != previous.type").fetchone()
+    before,  = db.execute("SELECT COALESCE(SUM(blocks), 0) FROM old.files WHERE counted").fetchone()
+    after,   = db.execute("SELECT COALESCE(SUM(blocks), 0) FROM main.files WHERE counted").fetchone()
+    print("")
+    print("Image size: "+format_size(before)+" -> "+format_size(after)+", "+str(added)+" paths added, "+str(removed)+" removed, "+str(changed)+" changed")
+    db.close()
+
+
+def record_uses(build_dir, **uses):
+  # what a profile uses outside its build directory (snapshot, lockfile), for the garbage collector
+  filename = os.path.join(build_dir, "uses.json")
+  content = {}
+  try:
+    with open(filename) as f:
+      content = json.load(f)
+  except (OSError, ValueError):
+    pass
+  content.update(uses)
+  PackageManagerBase().mkdir_p(build_dir)
+  with open(filename + ".tmp", "w") as f:
+    json.dump(content, f, indent=2, sort_keys=True)
+  os.replace(filename + ".tmp", filename)
+
+
+class GarbageCollector:
+  # Removes the least recently used build directories, old and staged roots, cached packages,
+  # repository metadata and snapshots below the build root until it fits into the budget.
+  # Never removed: builds holding their lock, the snapshot and lockfile packages used by
+  # a profile, the latest snapshots, and everything used within the last min_age seconds.
+  # Sizes are counted per inode, so hardlinks between cache, snapshots and roots are counted once.
+  def __init__(self, build_root, budget, min_age=3600, dry_run=False):
+    self.build_root = build_root
+    self.budget     = budget
+    self.min_age    = min_age
+    self.dry_run    = dry_run
+    self.inodes     = {}
+
+  def last_use(self, path):
+    return os.lstat(path).st_mtime
+
+  def scan(self, path, exclude=()):
+    # inode -> number of links below path
+    result = collections.Counter()
+    for dirpath, dirnames, filenames in os.walk(path):
+      dirnames[:] = [ name for name in dirnames if not os.path.join(dirpath, name) in exclude ]
+      for name in [ "." ] + filenames + [ name for name in dirnames if os.path.islink(os.path.join(dirpath, name)) ]:
+        st = os.lstat(os.path.join(dirpath, name))
+        key = (st.st_dev, st.st_ino)
+        self.inodes[key] = (st.st_blocks * 512, 1 if stat.S_ISDIR(st.st_mode) else st.st_nlink)
+        result[key] += 1
+    return result
 
-    array = ['find', install_root+'/var/lib/'+package_manager+'/yumdb', '-mindepth','2', '-maxdepth','2',  '-type' , 'd', '-exec', 'rm', '-rf', '{}', ';']
-    print(array)
-    subprocess.call(array)
+  def entry(self, kind, path, last_use, pinned=False, exclude=(), inodes=None, build_dir=None):
+    return {
+      "kind"      : kind,
+      "path"      : path,
+      "last_use"  : last_use,
+      "pinned"    : pinned,
+      "inodes"    : inodes if inodes is not None else self.scan(path, exclude),
+      "children"  : [],
+      "evicted"   : False,
+      "build_dir" : build_dir,
+    }
 
- 
-    array = ['find', install_root+'/var/cache/'+package_manager, '-type' , 'f', '-exec', 'rm', '{}', ';']
-    print(array)
-    subprocess.call(array)
-
-
-    log_dir_wildcard = install_root+"/var/log/"+package_manager+"*.log"
-    for file in glob.glob(log_dir_wildcard):
-      print(file)
-      os.remove(file) 
-    log_dir_wildcard = install_root+"/var/log/hawkey.log"
-    for file in glob.glob(log_dir_wildcard):
-      print(file)
-      os.remove(file) 
-    log_dir_wildcard = install_root+"/var/log/lastlog"
-    for file in glob.glob(log_dir_wildcard):
-      print(file)
-      os.remove(file) 
-    subprocess.call(['touch', log_dir_wildcard])
+  def running(self, build_dir):
+    if not os.path.exists(os.path.join(build_dir, ".lock")):
+      return False
+    try:
+      with open(os.path.join(build_dir, ".lock"), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.flock(f, fcntl.LOCK_UN)
+      return False
+    except BlockingIOError:
+      return True
+
+  def entries(self):
+    result     = []
+    snapshots  = set()
+    lockfiles  = set()
+    cache_dir  = os.path.join(self.build_root, "cache")
+    snapshot_dir = os.path.join(self.build_root, "snapshots")
+
+    for build_dir in sorted(glob.glob(os.path.join(self.build_root, "*", "*"))):
+      if not os.path.isdir(build_dir) or build_dir.startswith(cache_dir) or build_dir.startswith(snapshot_dir) or os.path.islink(build_dir):
+        continue
+      running = self.running(build_dir)
+      try:
+        with open(os.path.join(build_dir, "uses.json")) as f:
+          uses = json.load(f)
+      except (OSError, ValueError):
+        uses = {}
+      if running and uses.get("snapshot"):
+        snapshots.add(os.path.realpath(uses["snapshot"]))
+      if uses.get("lockfile") and os.path.exists(uses["lockfile"]):
+        lockfiles.add(uses["lockfile"])
+
+      # roots which are not published and a left over staging directory go before the build directory
+      link = os.path.join(build_dir, "install")
+      published = os.path.dirname(os.path.realpath(link)) if os.path.islink(link) else None
+      children = [ path for path in glob.glob(os.path.join(build_dir, "roots", "*")) if path != published ]
+      if os.path.isdir(os.path.join(build_dir, "staging")):
+        children.append(os.path.join(build_dir, "staging"))
+      lock = os.path.join(build_dir, ".lock")
+      parent = self.entry("build", build_dir, self.last_use(lock if os.path.exists(lock) else build_dir), running, children, build_dir=build_dir)
+      for child in children:
+        entry = self.entry("root", child, self.last_use(child), running, build_dir=build_dir)
+        parent["children"].append(entry)
+        result.append(entry)
+      result.append(parent)
+
+    # cached packages: one entry per inode (blob, nevra and tree links)
+    pinned_blobs = set()
+    for lockfile in lockfiles:
+      try:
+        with open(lockfile) as f:
+          pinned_blobs |= set(package["sha256"] for package in yaml.safe_load(f)["packages"])
+      except (OSError, ValueError, KeyError, TypeError, yaml.YAMLError) as exc:
+        print("Garbage collection: cannot read lockfile "+lockfile+": "+str(exc))
+    packages = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(cache_dir, "packages")):
+      for name in filenames:
+        path = os.path.join(dirpath, name)
+        st = os.lstat(path)
+        key = (st.st_dev, st.st_ino)
+        self.inodes[key] = (st.st_blocks * 512, st.st_nlink)
+        package = packages.setdefault(key, { "paths": [], "last_use": max(st.st_atime, st.st_ctime), "pinned": False })
+        package["paths"].append(path)
+        if os.path.basename(dirpath) == "blobs" and name in pinned_blobs:
+          package["pinned"] = True
+    for key, package in packages.items():
+      entry = self.entry("package", package["paths"][0], package["last_use"], package["pinned"], inodes=collections.Counter({ key: len(package["paths"]) }))
+      entry["paths"] = package["paths"]
+      result.append(entry)
+
+    for path in glob.glob(os.path.join(cache_dir, "repodata", "*", "*", "*")):
+      result.append(self.entry("repodata", path, self.last_use(path)))
+
+    for os_dir in glob.glob(os.path.join(snapshot_dir, "*")):
+      latest = os.path.realpath(os.path.join(os_dir, "latest"))
+      for path in glob.glob(os.path.join(os_dir, "*")):
+        if os.path.islink(path) or not os.path.isdir(path):
+          continue
+        result.append(self.entry("snapshot", path, self.last_use(path), os.path.realpath(path) == latest or os.path.realpath(path) in snapshots))
+    return result
+
+  def snapshot_in_use(self, path):
+    for uses_file in glob.glob(os.path.join(self.build_root, "*", "*", "uses.json")):
+      build_dir = os.path.dirname(uses_file)
+      try:
+        with open(uses_file) as f:
+          snapshot = json.load(f).get("snapshot")
+      except (OSError, ValueError, AttributeError):
+        continue
+      if snapshot and os.path.realpath(snapshot) == os.path.realpath(path) and self.running(build_dir):
+        return True
+    return False
+
+  def unchanged(self, entry):
+    # cached packages: a new link (a build installing it) or a use since the scan keeps them
+    for path in entry.get("paths", [ entry["path"] ]):
+      try:
+        st = os.lstat(path)
+      except FileNotFoundError:
+        continue
+      size, nlink = self.inodes[(st.st_dev, st.st_ino)] if (st.st_dev, st.st_ino) in self.inodes else (0, -1)
+      # links removed since the scan are the roots evicted before
+      if st.st_nlink > nlink or max(st.st_atime, st.st_ctime) > entry["last_use"]:
+        return False
+    return True
+
+  def remove(self, entry):
+    # the scan is not atomic: everything is checked again right before it is removed,
+    # and the build lock is held while a build directory or one of its roots is removed
+    if entry["kind"] == "package" and not self.unchanged(entry):
+      return False
+    if entry["kind"] == "snapshot" and self.snapshot_in_use(entry["path"]):
+      return False
+    with contextlib.ExitStack() as stack:
+      if entry["build_dir"] is not None:
+        lock = os.path.join(entry["build_dir"], ".lock")
+        if os.path.exists(lock):
+          f = stack.enter_context(open(lock, "a+"))
+          try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          except BlockingIOError:
+            return False
+          if entry["kind"] == "build" and self.last_use(lock) > entry["last_use"]:
+            return False
+        link = os.path.join(entry["build_dir"], "install")
+        if entry["kind"] == "root" and os.path.islink(link) and os.path.dirname(os.path.realpath(link)) == entry["path"]:
+          return False
+      for path in entry.get("paths", [ entry["path"] ]):
+        if os.path.isdir(path) and not os.path.islink(path):
+          shutil.rmtree(path)
+        elif os.path.lexists(path):
+          os.remove(path)
+    return True
+
+  def run(self):
+    PackageManagerBase().mkdir_p(self.build_root)
+    with open(os.path.join(self.build_root, ".gc.lock"), "w") as lock:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        print("Garbage collection: already running")
+        return 0
+      start   = time.time()
+      entries = self.entries()
+      links   = collections.Counter()
+      for entry in entries:
+        links.update(entry["inodes"])
+      known = collections.Counter(links)
+      # an inode is only freed when all of its links are removed
+      used = sum(size for key, (size, nlink) in self.inodes.items() if key in links)
+      print("Garbage collection: "+format_size(used)+" used, budget "+format_size(self.budget))
+
+      evicted = []
+      def evict(entry):
+        freed = 0
+        for child in entry["children"]:
+          if not child["evicted"]:
+            freed += evict(child)
+        entry["evicted"] = True
+        for key, count in entry["inodes"].items():
+          links[key] -= count
+          size, nlink = self.inodes[key]
+          # links outside of the build root keep the data
+          if links[key] == 0 and nlink <= known[key]:
+            freed += size
+        evicted.append((entry, freed))
+        return freed
+
+      candidates = [ entry for entry in entries if not entry["pinned"] and entry["last_use"] < start - self.min_age ]
+      for entry in sorted(candidates, key=lambda entry: entry["last_use"]):
+        if used <= self.budget:
+          break
+        if entry["evicted"]:
+          continue
+        used -= evict(entry)
+
+      freed_total = 0
+      for entry, freed in evicted:
+        if entry["kind"] != "package" or self.dry_run:
+          print(("Would remove " if self.dry_run else "Removing ")+entry["kind"]+" "+entry["path"]+" ("+format_size(freed)+", last used "+
+                datetime.datetime.fromtimestamp(entry["last_use"]).strftime("%Y-%m-%d %H:%M")+")")
+        if not self.dry_run and not self.remove(entry):
+          print("Garbage collection: keeping "+entry["kind"]+" "+entry["path"]+", used since the scan")
+          used += freed
+          continue
+        freed_total += freed
+      packages = sum(1 for entry, freed in evicted if entry["kind"] == "package")
+      print("Garbage collection: "+("would free " if self.dry_run else "freed ")+format_size(freed_total)+" ("+str(len(evicted))+" entries, "+
+            str(packages)+" packages), "+format_size(used)+" used"+(", over budget" if used > self.budget else "")+
+            " in "+"%.2f" % (time.time() - start)+"s")
+      return freed_total
 
 
 class Installer:
@@ -522,9 +3916,10 @@ class Installer:
 
   def prepare_redhat_distribution(self,configuration, work,target,os_name,os_version):
     rpm = RedhatPackageManager()
+    backend = package_manager_backend(target.package_manager, configuration['target'].get('package_manager_command'))
 
     yum_repos_dir  = os.path.join(work.build_dir, "etc", "yum.repos.d")
-    repo_conf_file = os.path.join(work.build_dir, "etc", target.package_manager+".conf")
+    repo_conf_file = backend.conf_file(work.build_dir)
     home_dir       = os.path.join(work.build_dir, "root")
     rpm_build_file = os.path.join(home_dir, ".rpmmacros")
     rpm_dir        = os.path.join(work.install_dir, "etc", "rpm")
@@ -543,7 +3938,8 @@ class Installer:
     # FIXME need to create all of the configs
     #print(work.http_proxy)
     #sys.exit(0)
-    content = rpm.create_package_manager_conf_file(target.package_manager, work.build_dir, work.http_proxy, target.nodocs)
+    keepcache = 1 if work.package_cache != "" else 0
+    content = backend.conf(work.build_dir, work.http_proxy, target.nodocs, keepcache)
     #print(content)
     #exit(1)
     rpm.tofile(content, repo_conf_file)
@@ -562,7 +3958,7 @@ class Installer:
         rpm.tofile(content, os.path.join(yum_repos_dir, repo_name+".repo" ))
  
     elif os_name == "centos":
-      content = rpm.install_yum_repo_centos()
+      content = rpm.install_yum_repo_centos(repo_url)
       rpm.tofile(content, os.path.join(yum_repos_dir, "fedora-updates-testing.repo"))
 
     # lang_all = 0 (FALSE) --> install only specific languages
@@ -574,23 +3970,31 @@ class Installer:
       rpm.tofile(content, os.path.join(rpm_dir ,"macros.image-language.conf"))
       rpm.tofile(content, os.path.join(home_dir,".rpmmacros"))
 
-    cmd = rpm.install_distribution(
-      target.package_manager, 
+    if configuration['work'].get('locked', 0):
+      # local package files and no repositories: no metadata download and no depsolving
+      cache = PackageCache(work.package_cache if work.package_cache != "" else os.path.join(work.build_root, "cache", "packages"), self.runner)
+      metadata = RepoMetadata(os_version, work.http_proxy)
+      try:
+        packages = LockFile(target.lockfile).fetch(configuration['target'], cache, metadata, os.path.join(work.build_dir, "packages"))
+      except (OSError, ValueError) as exc:
+        print("Cannot install from the lockfile: "+str(exc))
+        sys.exit(1)
+      print(cache.report())
+      self.run_metrics["package_cache"] = { "hits": cache.hits, "misses": cache.misses, "downloaded_bytes": cache.downloaded_bytes }
+      return backend.install_argv(repo_conf_file, target.os_version, work.install_dir, [], packages)
+
+    cmd = backend.install_argv(
+      repo_conf_file,
       target.os_version, 
       work.install_dir,
       target.repo_list,
-      target.package_list,
-      work.build_dir
+      target.package_list
     )
     return cmd
 
   def prepare_alpine_distribution(self, configuration, work, target):
-    apm = AlpinePackageManager()
-    array = ['apk']
-    for repo in target.repo_list:
-      array.extend(["--repository", repo])
-    array.extend([ '--root', work.install_dir , '--allow-untrusted', '--update-cache' , '--initdb', '--no-progress', 'add', 'alpine-base' ])
-    cmd=array
+    backend = package_manager_backend("apk", configuration['target'].get('package_manager_command'))
+    cmd = backend.install_argv(None, target.os_version, work.install_dir, target.repo_list, [ 'alpine-base' ])
     return cmd
 
   def populate_build_version(self, build_version_format, work,os_name,os_version):
@@ -622,8 +4026,13 @@ class Installer:
 
 
   def main(self, default_configuration, config_file=""):
+    configuration = self.configure(default_configuration, config_file)
+    self.build(configuration)
+
+  def configure(self, default_configuration, config_file="", parents=()):
 
-    configuration         = default_configuration.copy()
+    start                 = time.time()
+    configuration         = copy.deepcopy(default_configuration)
     osrelease             = OsRelease()
     locale                = Locale()
     pmb                   = PackageManagerBase()
@@ -649,6 +4058,8 @@ class Installer:
     }
     merge_recursive(configuration, host_configuration)
     filename = "image.yaml"
+    if profile_resolver.cache_file is None:
+      profile_resolver.cache_file = os.path.join(configuration['work']['build_root'], "cache", "profiles.json")
 
     # Merge configs found in "/etc" local or in "etc", "." relative to the script directory
     for dir_prefix in [ "/etc" , os.path.join(sys.path[0], "etc"), sys.path[0] ]:
@@ -658,11 +4069,30 @@ class Installer:
     if config_file != "":
       fullpath = os.path.abspath(config_file)
       merge_config(fullpath, configuration)
+      configuration['target'].setdefault('lockfile', os.path.splitext(fullpath)[0]+".lock")
+
+    # "base: <profile>" builds on a clone of the install root of another profile
+    if isinstance(configuration.get('base'), str):
+      base_file = os.path.join(os.path.dirname(os.path.abspath(config_file)), configuration['base'])
+      if base_file in parents or base_file == os.path.abspath(config_file):
+        raise ValueError("profile "+config_file+" has a cycle in its base profiles")
+      configuration['base'] = self.configure(default_configuration, base_file, parents + (os.path.abspath(config_file),))
 
     target     = configuration['target']
     os_name    = target['os_name'] 
     os_version = target['os_version'] 
 
+    # a list of package managers is a preference, the first one found on the build host is used;
+    # the one of a host without a backend (debian) is replaced by the one of the target os
+    if target['package_manager'] == package_manager and not package_manager in package_manager_backends:
+      target['package_manager'] = pmb.determine_package_manager(os_name, os_version) or package_manager
+    try:
+      target['package_manager'] = select_package_manager(target['package_manager'], target.get('package_manager_command'))
+    except ValueError as exc:
+      sys.exit("Profile "+str(config_file)+": "+str(exc))
+    if configuration['work'].get('locked', 0) and not os.path.isfile(target.get('lockfile', '')):
+      sys.exit("Cannot install from the lockfile: "+target.get('lockfile', 'profile '+str(config_file))+" does not exist, run: imagebuild.py lock")
+
     if not 'repo_list' in target:
       target['repo_list'] = pmb.get_repository_list(os_name,os_version)
     if not 'repo_list_add' in target:
@@ -671,6 +4101,8 @@ class Installer:
       target['package_list'] = pmb.package_list(os_name,os_version)
     if not 'package_list_add' in target:
       target['package_list_add'] = pmb.package_list_add(os_name,os_version)
+    # "package_list+: [...]" of a profile without a package list adds to the default of the os
+    apply_list_operators(configuration)
 
     configuration['target']=target
     
@@ -679,90 +4111,1180 @@ class Installer:
     work['build_dir']      = os.path.join(configuration['work']['build_root'], target.os_name +"-" + str(target.os_version), target.profile)
     work['install_dir']    = os.path.join(work['build_dir'],"install")
     work['build_datetime'] = datetime.datetime.today().strftime(work['build_datetime'])
+    if not 'package_cache' in work:
+      work['package_cache'] = os.path.join(work['build_root'], "cache", "packages")
+
+    # builds use the latest local snapshot of their repositories, if there is one
+    snapshot = configuration.setdefault('snapshot', {})
+    snapshot.setdefault('dir', os.path.join(work['build_root'], "snapshots"))
+    snapshot.setdefault('use', "latest")
+    snapshot_id, snapshot_url = RepoSnapshot(snapshot['dir'], os_name, os_version).repo_url(str(snapshot['use']), configuration['target']['repo_list'])
+    if snapshot_id is not None:
+      snapshot['id'] = snapshot_id
+      repo_url = configuration['target'].setdefault('repo_url', {})
+      repo_url.update(snapshot_url)
 
     configuration['work']= work
-
-
+    work['configure_seconds'] = round(time.time() - start, 6)
 
     if "docker" in configuration:
       image_name=configuration["docker"]["image"]
-      image_name = image_name.replace("%os_name%",       os_name)
-      image_name = image_name.replace("%os_version%",    str(os_version))
-      image_name = image_name.replace("%profile%",       target.profile)
-      image_name = image_name.replace("%build_version%", self.populate_build_version("%os_name%-%os_version%-%build_datetime%",work,os_name,os_version))
-      image_name = image_name.replace("%build_datetime%", work['build_datetime'])
-
-      configuration["docker"]["image"] = image_name
+      configuration["docker"]["image"] = self.populate_image_name(image_name, work, target, os_name, os_version)
+
+    if "oci" in configuration:
+      oci = configuration["oci"]
+      if oci is None:
+        oci = {}
+      oci.setdefault("dir",         os.path.join(work['build_dir'], "oci"))
+      oci.setdefault("tag",         "%os_name%-%os_version%-%build_datetime%")
+      oci.setdefault("compression", "gzip")
+      for key in [ "dir", "tag" ]:
+        oci[key] = self.populate_image_name(oci[key], work, target, os_name, os_version)
+      configuration["oci"] = oci
+
+    profile_resolver.save()
+    return configuration
+
+  def populate_image_name(self, image_name, work, target, os_name, os_version):
+    image_name = image_name.replace("%os_name%",       os_name)
+    image_name = image_name.replace("%os_version%",    str(os_version))
+    image_name = image_name.replace("%profile%",       target.profile)
+    image_name = image_name.replace("%build_version%", self.populate_build_version("%os_name%-%os_version%-%build_datetime%",work,os_name,os_version))
+    image_name = image_name.replace("%build_datetime%", work['build_datetime'])
+    return image_name
+
+  def build(self, configuration):
+    work = configuration['work']
+    self.trace = BuildTrace()
+    self.trace.add("configure", self.trace.start - work.get('configure_seconds', 0.0), work.get('configure_seconds', 0.0))
+    self.runner = ProcessRunner(
+      log_dir      = os.path.join(work['build_dir'], "log", work['build_datetime']),
+      timeout      = work.get('timeout'),
+      idle_timeout = work.get('idle_timeout'),
+      echo         = not work.get('quiet', 0),
+    )
+    self.timeouts = work.get('timeouts', {})
+    self.run_metrics = {}
+    status = 0
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+      # only set the flag: the handler can interrupt the main thread while it holds the
+      # runner lock, run() kills its process on the next poll
+      previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: self.runner.cancelled.set())
+    try:
+      with BuildLock(work['build_dir']):
+        snapshot = configuration.get('snapshot', {})
+        record_uses(work['build_dir'],
+          snapshot = os.path.join(snapshot['dir'], configuration['target']['os_name']+"-"+str(configuration['target']['os_version']), snapshot['id']) if 'id' in snapshot else None,
+          lockfile = configuration['target']['lockfile'] if work.get('locked', 0) else None)
+        if work.get('gc_budget'):
+          with self.trace.phase("gc"):
+            GarbageCollector(work['build_root'], parse_size(work['gc_budget']), work.get('gc_min_age', 3600)).run()
+        self.run_phases(configuration)
+    except SystemExit as exc:
+      status = exc.code if isinstance(exc.code, int) else 1
+      raise
+    except BaseException:
+      status = 1
+      raise
+    finally:
+      if previous_handler is not None:
+        signal.signal(signal.SIGTERM, previous_handler)
+      self.trace.write(work['build_dir'])
+      if work.get('metrics', 1):
+        BuildMetrics(configuration).write(self.trace, status, self.run_metrics)
+
+  def run_phases(self, configuration):
+    pmb        = PackageManagerBase()
+    target     = DictToObject(configuration['target'])
+    os_name    = target.os_name
+    os_version = target.os_version
+    trace      = self.trace
 
     val=yaml.dump(configuration, explicit_start=True,indent=2, default_flow_style=False)
     print(val)
     work = DictToObject(configuration['work'])
- 
-    pmb.mkdir_p(work.install_dir)
-    dirs = { "target" : {
-         "dirs": {
-           "/bin": {
-              "mode": "0666",
-              "owner": "root",
-              "group": "root"
-               },
-          "/ftp": {
-              "mode":  "0666",
-              "owner": "root",
-              "group": "root"
-              }
-
-      }}}
 
+    with trace.phase("fingerprint"):
+      fingerprint = BuildFingerprint(work.build_dir)
+      build_fingerprint = fingerprint.compute(configuration)
+      resume = configuration['work'].get('from_step') is not None or configuration['work'].get('only_step') is not None
+      if build_fingerprint is not None and not configuration['work'].get('force', 0) and not resume:
+        if self.reuse_build(configuration, fingerprint, build_fingerprint):
+          return
+
+    # The root is built in <build_dir>/staging and published by a symlink swap of
+    # <build_dir>/install, so exports and readers only see complete roots
+    link      = os.path.join(work.build_dir, "install")
+    staging   = os.path.join(work.build_dir, "staging")
+    published = os.path.dirname(os.path.realpath(link)) if os.path.islink(link) else None
+    force     = configuration['work'].get('force', 0)
+    from_step = configuration['work'].get('from_step')
+    only_step = configuration['work'].get('only_step')
+    stage     = DictToObject(dict(configuration['work']))
+
+    rootfs = BuildSteps(os.path.join(staging if os.path.isdir(staging) or published is None else published, "steps"), force, from_step, only_step)
+    install_inputs = {
+      "target"      : configuration['target'],
+      "fingerprint" : build_fingerprint,
+      "lockfile"    : LockFile(configuration['target']['lockfile']).digest() if configuration['work'].get('locked', 0) else None,
+      "base"        : { "target": configuration['base']['target'], "prune": configuration['base'].get('prune') } if 'base' in configuration else None,
+    }
+    install = rootfs.add("install", lambda: self.install_step(configuration, stage, target), install_inputs)
+    patch   = rootfs.add("patch", lambda: self.patch_step(configuration, stage, target),
+      { "lang": target.lang, "nodocs": target.nodocs, "proxy": target.proxy, "prune": configuration.get("prune") }, [ install ])
+    if configuration.get("dedup"):
+      patch = rootfs.add("dedup", lambda: self.dedup_step(configuration, stage), configuration["dedup"], [ patch ])
+    dirs    = rootfs.add("dirs", lambda: self.dirs_step(configuration, stage), configuration['target'], [ patch ])
+    if os_name == "fedora":
+      dirs  = rootfs.add("rpm-import", lambda: self.rpm_import_step(stage, os_name, os_version), { "os_name": os_name, "os_version": os_version }, [ dirs ])
+    if configuration.get("analyze"):
+      rootfs.add("analyze", lambda: self.analyze_step(configuration, stage), configuration["analyze"], [ dirs ])
 
-    #sys.exit(0)
- 
-    if os_name == "alpine":
-      cmd = self.prepare_alpine_distribution(configuration,work,target)
-    else:
-      cmd = self.prepare_redhat_distribution(configuration,work,target,os_name,os_version) 
+    # exports are valid for one published root, its id is known after the rootfs steps
+    root    = {}
+    exports = BuildSteps(os.path.join(work.build_dir, "steps"), force, from_step, only_step)
+    if "docker" in configuration:
+      docker_import = exports.add("docker-import", lambda: self.docker_import_step(configuration, export), { "docker": configuration["docker"], "root": root })
+      exports.add("docker-tag", lambda: self.docker_tag_step(configuration), { "docker": configuration["docker"], "root": root }, [ docker_import ])
+    if "oci" in configuration:
+      exports.add("oci-export", lambda: self.oci_export_step(configuration, export), { "oci": configuration["oci"], "root": root })
 
-    print(cmd)
-    return_code = pmb.execute2(cmd, work.build_dir+"/root") 
-    if return_code != 0:
-      sys.exit(1)
+    for name in [ from_step, only_step ]:
+      if name is not None and not name in rootfs.steps and not name in exports.steps:
+        print("unknown step "+name+", steps of this build: "+", ".join(rootfs.order() + exports.order()))
+        sys.exit(1)
 
-    Patch().apply(target.lang, target.package_manager,work.install_dir,target.nodocs, target.proxy)
+    try:
+      pending = rootfs.pending()
+      if len(pending) > 0:
+        if pending[0] == "install" or (published is None and not os.path.isdir(staging)):
+          # a new install always starts in an empty root
+          if os.path.lexists(staging):
+            shutil.rmtree(staging)
+          pmb.mkdir_p(staging)
+        elif not os.path.isdir(staging):
+          with trace.phase("stage"):
+            RootClone(os.path.join(published, "rootfs"), os.path.join(staging, "rootfs"), configuration['work'].get('copy_up')).clone()
+            shutil.copytree(os.path.join(published, "steps"), os.path.join(staging, "steps"))
+        rootfs.checkpoint_dir = os.path.join(staging, "steps")
+        stage.install_dir     = os.path.join(staging, "rootfs")
+        rootfs.run()
+      # also a staged root with all steps done by a build which failed before its publish
+      if len(pending) > 0 or (os.path.isdir(staging) and rootfs.complete()):
+        if configuration['work'].get('metrics', 1):
+          with trace.phase("metrics"):
+            BuildMetrics(configuration).measure_root(staging, rootfs.outputs, self.runner)
+        with trace.phase("publish"):
+          self.publish(work, staging)
+
+      root["id"] = os.path.basename(os.path.dirname(os.path.realpath(link)))
+      export  = DictToObject(dict(configuration['work'], install_dir=os.path.realpath(link)))
+      outputs = exports.run()
+    except ValueError as exc:
+      print(str(exc))
+      sys.exit(1)
 
-    self.create_dirs(pmb, work.install_dir,configuration['target'])
-    self.create_symlinks(pmb, work.install_dir,configuration['target'])
+    if build_fingerprint is not None and only_step is None:
+      image_name = configuration["docker"]["image"] if "docker" in configuration else ""
+      fingerprint.save(build_fingerprint, image_name, outputs.get("docker-import", {}).get("image_id", ""), outputs.get("oci-export", {}).get("digest", ""))
+
+  def publish(self, work, staging):
+    # roots/<build_datetime>/{rootfs,steps}; the previous root is kept for readers still using it
+    pmb       = PackageManagerBase()
+    roots_dir = os.path.join(work.build_dir, "roots")
+    link      = os.path.join(work.build_dir, "install")
+    pmb.mkdir_p(roots_dir)
+    root_id = work.build_datetime
+    count   = 1
+    while os.path.exists(os.path.join(roots_dir, root_id)):
+      count  += 1
+      root_id = work.build_datetime + "." + str(count)
+    os.rename(staging, os.path.join(roots_dir, root_id))
+
+    previous_id = None
+    if os.path.islink(link):
+      previous_id = os.path.basename(os.path.dirname(os.path.realpath(link)))
+    elif os.path.isdir(link):
+      # install directory of a build before roots were published
+      previous_id = "previous-" + root_id
+      pmb.mkdir_p(os.path.join(roots_dir, previous_id))
+      os.rename(link, os.path.join(roots_dir, previous_id, "rootfs"))
+    tmp = link + ".tmp"
+    if os.path.lexists(tmp):
+      os.remove(tmp)
+    os.symlink(os.path.join("roots", root_id, "rootfs"), tmp)
+    os.replace(tmp, link)
+    print("Published "+os.path.join(roots_dir, root_id))
+
+    for name in os.listdir(roots_dir):
+      if name != root_id and name != previous_id:
+        shutil.rmtree(os.path.join(roots_dir, name))
+
+  def install_step(self, configuration, work, target):
+    pmb        = PackageManagerBase()
+    trace      = self.trace
+    os_name    = target.os_name
+    os_version = target.os_version
+    backend    = package_manager_backend(target.package_manager)
+
+    # A size budget is checked against the resolved package set before anything is installed
+    if os_name != "alpine" and configuration['target'].get('size_budget') is not None:
+      with trace.phase("resolve"):
+        self.check_size_budget(configuration)
+
+    if 'base' in configuration:
+      with trace.phase("base"):
+        self.clone_base(configuration, work.install_dir)
 
+    pmb.mkdir_p(work.install_dir)
 
-    if os_name == "fedora":
+    with trace.phase("prepare"):
+      if os_name == "alpine":
+        cmd = self.prepare_alpine_distribution(configuration,work,target)
+      else:
+        cmd = self.prepare_redhat_distribution(configuration,work,target,os_name,os_version) 
+
+    # a locked install gets local package files, LockFile.fetch counted the cache hits and downloads
+    cache = None
+    if os_name != "alpine" and work.package_cache != "" and not configuration['work'].get('locked', 0):
+      cache = PackageCache(work.package_cache, self.runner)
+      cache.seed(work.install_dir, target.package_manager, os_version)
+    start_time = time.time()
+
+    # With stage limits (several builds in a pipeline) the packages are fetched
+    # into the cache first, so downloads overlap with installs and exports of other builds
+    download_cmd = backend.download_argv(cmd)
+    if os_name != "alpine" and len(stage_limits) > 0 and not configuration['work'].get('locked', 0) and download_cmd is not None:
+      with trace.phase("download"), self.stage("download"):
+        print(download_cmd)
+        return_code = pmb.execute2(download_cmd, work.build_dir+"/root", None, self.runner, "download", self.timeouts.get("download"))
+        if return_code != 0 or self.runner.cancelled.is_set():
+          sys.exit(1)
+        if cache is not None:
+          cache.harvest(work.install_dir, target.package_manager)
+
+    with trace.phase("install"), self.stage("install"):
+      print(cmd)
+      return_code = pmb.execute2(cmd, work.build_dir+"/root", PackageManagerOutput(trace, backend.markers).parse, self.runner, "install", self.timeouts.get("install"))
+      trace.mark(None)
+      if return_code != 0 or self.runner.cancelled.is_set():
+        sys.exit(1)
+
+      if cache is not None:
+        cache.harvest(work.install_dir, target.package_manager)
+        cache.count_hits(work.install_dir, start_time)
+        print(cache.report())
+        self.run_metrics["package_cache"] = { "hits": cache.hits, "misses": cache.misses, "downloaded_bytes": cache.downloaded_bytes }
+
+  def clone_base(self, configuration, install_dir):
+    # The base root is built (or found up to date) once, then cloned; the package
+    # manager installs only what the variant adds on top of it
+    base = copy.deepcopy(configuration['base'])
+    for key in [ "os_name", "os_version", "package_manager" ]:
+      if str(base['target'][key]) != str(configuration['target'][key]):
+        print("Base profile "+base['target']['profile']+" has a different "+key)
+        sys.exit(1)
+    base.pop("docker", None)
+    base.pop("oci", None)
+    base['work'].pop('from_step', None)
+    base['work'].pop('only_step', None)
+    print("Building base profile "+base['target']['profile'])
+    Installer().build(base)
+    # the lock keeps the published base root from being replaced while it is cloned
+    with BuildLock(base['work']['build_dir']):
+      RootClone(os.path.realpath(base['work']['install_dir']), install_dir, configuration['work'].get('copy_up')).clone()
+
+  def patch_step(self, configuration, work, target):
+    with self.trace.phase("patch"):
+      pruned = Patch().apply(target.lang, target.package_manager,work.install_dir,target.nodocs, target.proxy, configuration.get("prune"))
+    return { "pruned": pruned }
+
+  def dedup_step(self, configuration, work):
+    with self.trace.phase("dedup"):
+      saved = Deduplicator(work.install_dir, configuration["dedup"]).run()
+    return { "saved": saved }
+
+  def dirs_step(self, configuration, work):
+    pmb = PackageManagerBase()
+    with self.trace.phase("dirs"):
+      self.create_dirs(pmb, work.install_dir,configuration['target'])
+      self.create_symlinks(pmb, work.install_dir,configuration['target'])
+
+  def rpm_import_step(self, work, os_name, os_version):
+    with self.trace.phase("rpm import"):
       cmd = [ 'chroot', work.install_dir, 'rpm', '--import', '/etc/pki/rpm-gpg/RPM-GPG-KEY-'+os_name+'-'+str(os_version)+'-primary' ]
       print(" ".join(cmd))
-      return_code = pmb.execute2(cmd, "/root")
+      return_code = PackageManagerBase().execute2(cmd, "/root", None, self.runner, "rpm-import", self.timeouts.get("rpm-import"))
       print(return_code)
+      if return_code != 0:
+        sys.exit(1)
+
+  def analyze_step(self, configuration, work):
+    # the index is kept next to the root, roots/<id>/analyze.sqlite after publishing
+    analyze = configuration["analyze"] if isinstance(configuration["analyze"], dict) else {}
+    with self.trace.phase("analyze"):
+      analyzer = ImageAnalyzer(work.install_dir, os.path.join(os.path.dirname(work.install_dir), "analyze.sqlite"), self.runner)
+      analyzer.index()
+      analyzer.report(analyze.get("top", 20))
+
+  def docker_import_step(self, configuration, work):
+    image_name=configuration["docker"]["image"]
+    print("Creating image: "+image_name)
+    docker = self.docker(configuration)
+    delta  = None
+    if configuration["docker"].get("delta", 0):
+      with self.trace.phase("docker delta"):
+        delta = LayerDelta(work.install_dir, os.path.join(work.build_dir, "delta", "docker.json.gz"), configuration["docker"].get("max_layers", 10))
+        if not delta.compute() or not docker.image_exists(delta.previous["image"]):
+          delta.previous = None
+    with self.trace.phase("docker import"), self.stage("export"):
+      image_id = None
+      layers   = 1
+      if delta is not None and delta.previous is not None:
+        image_id, layers = docker.load_delta(work.install_dir, delta, image_name, os.path.join(work.build_dir, "delta"), self.timeouts.get("docker-import"))
+      if image_id is None:
+        image_id = docker.import_rootfs(work.install_dir, image_name, self.timeouts.get("docker-import"))
+        layers   = 1
+      if image_id is None:
+          sys.exit(10)
+    if delta is not None:
+      delta.save(image_id, layers)
+    return { "image_id": image_id }
+
+  def docker(self, configuration):
+    # docker.api: "socket" the Engine API, "cli" the docker command, "auto" (default) the
+    # API if its socket (docker.socket, DOCKER_HOST=unix://... or /var/run/docker.sock) exists
+    docker = configuration.get("docker") or {}
+    api    = docker.get("api", "auto")
+    socket_path = docker.get("socket")
+    if socket_path is None:
+      host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+      socket_path = host[len("unix://"):] if host.startswith("unix://") else None
+    if api == "socket" or (api == "auto" and socket_path is not None and os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode)):
+      return Docker(self.runner, DockerEngine(socket_path or "/var/run/docker.sock", self.runner, docker.get("socket_timeout", 300)))
+    return Docker(self.runner)
+
+  def docker_tag_step(self, configuration):
+    image_name=configuration["docker"]["image"]
+    with self.trace.phase("docker tag"):
+      # not checkpointed, the next build tags again
+      if self.docker(configuration).tag_latest(image_name, image_name) != 0:
+        sys.exit(10)
+
+  def oci_export_step(self, configuration, work):
+    oci   = configuration["oci"]
+    delta = None
+    if oci.get("delta", 0):
+      with self.trace.phase("oci delta"):
+        delta = LayerDelta(work.install_dir, os.path.join(work.build_dir, "delta", "oci.json.gz"), oci.get("max_layers", 10))
+        if not delta.compute():
+          delta.previous = None
+    with self.trace.phase("oci export"), self.stage("export"):
+      layout = OciLayout(oci["dir"])
+      manifest = layout.export(work.install_dir, oci["tag"], oci["compression"], oci.get("level"), oci.get("block_size", 4*1024*1024),
+        delta if delta is not None and delta.previous is not None else None)
+    if delta is not None:
+      delta.save(manifest["digest"], manifest["layers"])
+    return manifest
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    # limits how many builds of a pool are in the same stage at the same time
+    semaphore = stage_limits.get(name)
+    if semaphore is None:
+      yield
+      return
+    self.trace.mark("waiting")
+    semaphore.acquire()
+    self.trace.mark(None)
+    try:
+      yield
+    finally:
+      semaphore.release()
+
+  def check_size_budget(self, configuration):
+    target   = configuration['target']
+    budget   = parse_size(target['size_budget'])
+    resolver = Resolver()
+    resolver.load_configuration(configuration)
+    packages = resolver.resolve(target['package_list'] + target.get('package_list_add', []))
+    download, installed = resolver.report(packages)
+    if installed > budget:
+      print("Installed size "+format_size(installed)+" exceeds the size budget of "+format_size(budget))
+      sys.exit(1)
 
+  def reuse_build(self, configuration, fingerprint, build_fingerprint):
+    # Nothing relevant changed since the last build: only re-tag the existing image
+    previous = fingerprint.load()
+    if previous.get("fingerprint") != build_fingerprint:
+      return False
+    if not os.path.isdir(configuration['work']['install_dir']):
+      return False
+
+    docker     = self.docker(configuration)
+    image_id   = previous.get("image_id", "")
+    oci_digest = previous.get("oci_digest", "")
     if "docker" in configuration:
-      image_name=configuration["docker"]["image"]
-      print("Creating image: "+image_name)
-      #a="cd \"" + work.install_dir + "\" && tar -c . |docker import - \""+image_name+"\""
-      #subprocess.call(a,  shell=True)
-      cmd="tar -c . |docker import - \""+image_name+"\""
-      ps = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT, cwd=work.install_dir)
-      output = ps.communicate()[0]
-      output = output.decode('utf-8').rstrip()
-      if ps.returncode != 0:
-          sys.exit(10)
-      #digest, image_id = output.split(':')
-      #print(image_id)
-      print(output)
-      image_prefix = image_name.split(':')[0]
-      cmd = 'docker tag ' + image_name + ' ' + image_prefix + ':latest'
-      print(cmd)
-      subprocess.call(cmd,  shell=True)
+      if image_id == "" or not docker.image_exists(image_id):
+        return False
+    if "oci" in configuration:
+      oci = configuration["oci"]
+      if not OciLayout(oci["dir"]).tag_existing(oci_digest, oci["tag"]):
+        return False
+
+    image_name = ""
+    if "docker" in configuration:
+      image_name = configuration["docker"]["image"]
+      print("Inputs unchanged (fingerprint "+build_fingerprint+"), re-tagging "+image_id+" as "+image_name)
+      if docker.tag(image_id, image_name) != 0:
+        return False
+      docker.tag_latest(image_id, image_name)
+    else:
+      print("Inputs unchanged (fingerprint "+build_fingerprint+"), skipping build")
+    fingerprint.save(build_fingerprint, image_name, image_id, oci_digest)
+    return True
+
+# Semaphores of the pipeline stages, shared by the worker processes of a BuildPool
+stage_limits = {}
+
+def init_build_worker(limits):
+  stage_limits.update(limits)
+
+def run_build_job(configuration, log_file):
+  # Runs in a worker process, everything written to stdout/stderr
+  # (including the output of child processes) goes to the job log
+  sys.stdout.flush()
+  sys.stderr.flush()
+  PackageManagerBase().mkdir_p(os.path.dirname(log_file))
+  fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  os.dup2(fd, 1)
+  os.dup2(fd, 2)
+  os.close(fd)
+
+  start = time.time()
+  try:
+    Installer().build(configuration)
+    return_code = 0
+  except SystemExit as exc:
+    return_code = exc.code if isinstance(exc.code, int) else 1
+  except Exception:
+    traceback.print_exc()
+    return_code = 1
+  sys.stdout.flush()
+  sys.stderr.flush()
+  return return_code, time.time() - start
+
+
+class BuildPool:
+  def __init__(self, jobs, limits=None):
+    self.jobs   = jobs
+    # stage -> number of builds which may be in this stage at the same time
+    self.limits = limits if limits is not None else {}
+
+  def expand_profiles(self, argv):
+    profiles = []
+    for arg in argv:
+      if os.path.isdir(arg):
+        for pattern in [ "*.yaml", "*.yml" ]:
+          profiles.extend(sorted(glob.glob(os.path.join(arg, pattern))))
+      else:
+        profiles.append(arg)
+    return profiles
+
+  def executor(self, workers):
+    semaphores = {}
+    for stage, limit in self.limits.items():
+      if limit is not None and limit > 0:
+        print("Stage "+stage+": at most "+str(limit)+" builds")
+        semaphores[stage] = multiprocessing.Semaphore(limit)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_build_worker, initargs=(semaphores,))
+
+  def run(self, default_configuration, profiles):
+    installer = Installer()
+    jobs      = []
+    build_dirs = {}
+    for profile in profiles:
+      configuration = installer.configure(default_configuration, profile)
+      build_dir = configuration['work']['build_dir']
+      if build_dir in build_dirs:
+        exit("Profiles "+build_dirs[build_dir]+" and "+profile+" use the same build dir "+build_dir)
+      build_dirs[build_dir] = profile
+      log_file = os.path.join(build_dir, "log", "build-"+configuration['work']['build_datetime']+".log")
+      jobs.append([profile, configuration, log_file])
+
+    results = {}
+    workers = max(1, min(self.jobs, len(jobs)))
+    print("Building "+str(len(jobs))+" profiles with "+str(workers)+" workers")
+    with self.executor(workers) as executor:
+      futures = {}
+      for profile, configuration, log_file in jobs:
+        print("Started:  "+profile+" (log: "+log_file+")")
+        futures[executor.submit(run_build_job, configuration, log_file)] = profile
+      for future in concurrent.futures.as_completed(futures):
+        profile = futures[future]
+        try:
+          results[profile] = future.result()
+        except Exception as exc:
+          results[profile] = (1, 0.0)
+          print(profile+": "+str(exc))
+        print("Finished: "+profile+" ("+("ok" if results[profile][0] == 0 else "FAILED")+")")
+
+    return self.summary(jobs, results)
+
+  def summary(self, jobs, results):
+    rows = [ [ "PROFILE", "STATUS", "DURATION", "LOG" ] ]
+    failed = 0
+    for profile, configuration, log_file in jobs:
+      return_code, duration = results[profile]
+      if return_code == 0:
+        status = "ok"
+      else:
+        status = "failed ("+str(return_code)+")"
+        failed += 1
+      rows.append([ profile, status, "%.1fs" % duration, log_file ])
+
+    widths = [ max(len(row[i]) for row in rows) for i in range(len(rows[0])) ]
+    print("")
+    for row in rows:
+      print("  ".join(row[i].ljust(widths[i]) for i in range(len(row))).rstrip())
+    print("")
+    print(str(len(jobs)-failed)+" succeeded, "+str(failed)+" failed")
+    return failed
+
+
+class BuildService:
+  # Long running builder behind a unix socket, one JSON object per line:
+  #   request  { "action": "build", "profile": "/path/profile.yaml", "force": 0 }
+  #            { "action": "status" }
+  #   response { "log": "..." } lines while the build runs, then { "result": 0, "duration": 12.3, "shared": false }
+  # Requests with the same configuration are merged into one build, builds of the
+  # same build_dir run one after another.
+  def __init__(self, default_configuration, socket_path, pool):
+    self.default_configuration = default_configuration
+    self.socket_path = socket_path
+    self.pool        = pool
+    self.jobs        = {}
+    self.build_dirs  = {}
+    self.lock        = threading.Lock()
+    self.installer   = Installer()
+    self.executor    = None
+
+  def key(self, configuration):
+    # the same configuration, apart from the time it was configured at
+    stamp = configuration['work']['build_datetime']
+    content = json.dumps(configuration, sort_keys=True, default=str).replace(stamp, "%build_datetime%")
+    content = re.sub(r'"configure_seconds": [0-9.e-]+', '', content)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  def submit(self, profile, force=0):
+    default_configuration = copy.deepcopy(self.default_configuration)
+    if force:
+      default_configuration['work']['force'] = 1
+    # configure exits with its message on profiles it cannot build
+    try:
+      configuration = self.installer.configure(default_configuration, profile)
+    except SystemExit as exc:
+      raise ValueError(str(exc.code) if not isinstance(exc.code, int) else "cannot configure "+profile)
+    key = self.key(configuration)
+    with self.lock:
+      job = self.jobs.get(key)
+      if job is not None:
+        job["waiters"] += 1
+        return job, True
+      build_dir = configuration['work']['build_dir']
+      job = {
+        "key"           : key,
+        "profile"       : profile,
+        "configuration" : configuration,
+        "log_file"      : os.path.join(build_dir, "log", "build-"+configuration['work']['build_datetime']+".log"),
+        "state"         : "queued",
+        "waiters"       : 1,
+        "result"        : None,
+        "done"          : threading.Event(),
+      }
+      self.jobs[key] = job
+      build_dir_lock = self.build_dirs.setdefault(build_dir, threading.Lock())
+    threading.Thread(target=self.execute, args=(job, build_dir_lock), daemon=True).start()
+    return job, False
+
+  def execute(self, job, build_dir_lock):
+    with build_dir_lock:
+      job["state"] = "running"
+      print("Started:  "+job["profile"]+" (log: "+job["log_file"]+")")
+      try:
+        job["result"] = self.executor.submit(run_build_job, job["configuration"], job["log_file"]).result()
+      except Exception as exc:
+        print(job["profile"]+": "+str(exc))
+        job["result"] = (1, 0.0)
+    with self.lock:
+      del self.jobs[job["key"]]
+      job["state"] = "done"
+    job["done"].set()
+    print("Finished: "+job["profile"]+" ("+("ok" if job["result"][0] == 0 else "FAILED")+", "+str(job["waiters"])+" clients)")
+
+  def follow(self, job, send):
+    # the job log from the start, until the build is done
+    position = 0
+    pending  = b''
+    while True:
+      done = job["done"].is_set()
+      if job["state"] != "queued" and os.path.exists(job["log_file"]):
+        with open(job["log_file"], "rb") as f:
+          f.seek(position)
+          data = f.read()
+        position += len(data)
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+          send({ "log": line.decode('utf-8', 'replace') })
+      if done:
+        break
+      job["done"].wait(0.2)
+    if len(pending) > 0:
+      send({ "log": pending.decode('utf-8', 'replace') })
+
+  def status(self):
+    with self.lock:
+      return [ { "profile": job["profile"], "state": job["state"], "waiters": job["waiters"], "log": job["log_file"] } for job in self.jobs.values() ]
+
+  def handle(self, rfile, wfile):
+    def send(message):
+      wfile.write((json.dumps(message)+"\n").encode('utf-8'))
+      wfile.flush()
+    for line in rfile:
+      try:
+        request = json.loads(line)
+        if request.get("action") == "status":
+          send({ "jobs": self.status() })
+        elif request.get("action") == "build":
+          job, shared = self.submit(request["profile"], request.get("force", 0))
+          self.follow(job, send)
+          return_code, duration = job["result"]
+          send({ "result": return_code, "duration": round(duration, 3), "shared": shared })
+        else:
+          send({ "error": "unknown action "+str(request.get("action")) })
+      except (ValueError, KeyError, OSError, yaml.YAMLError) as exc:
+        send({ "error": str(exc) })
+
+  def serve(self):
+    service = self
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        try:
+          service.handle(self.rfile, self.wfile)
+        except (BrokenPipeError, ConnectionResetError):
+          pass
+
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+    PackageManagerBase().mkdir_p(os.path.dirname(self.socket_path))
+    server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+    server.daemon_threads = True
+    os.chmod(self.socket_path, 0o600)
+    print("Listening on "+self.socket_path+" with "+str(self.pool.jobs)+" workers")
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    with self.pool.executor(self.pool.jobs) as self.executor:
+      try:
+        server.serve_forever()
+      except KeyboardInterrupt:
+        pass
+      finally:
+        server.server_close()
+        os.remove(self.socket_path)
+    return 0
+
+
+class Benchmark:
+  # Timings of the build pipeline and of its components. A stub package manager (the "fake"
+  # backend) writes a synthetic root and a stub docker reads the tar stream, so neither root
+  # privileges, mirrors nor a docker daemon are needed. Results are written as json:
+  #   { start, host, files, repeat, results: { <name>: { seconds: [...], median, ... } } }
+  benchmarks = [ "pipeline", "merge", "prune", "tar", "oci" ]
+
+  def __init__(self, work_dir, repeat=3):
+    self.work_dir = work_dir
+    self.repeat   = repeat
+    self.results  = {}
+
+  def tree(self, root, files):
+    # most files are binaries and libraries, the rest matches the prune rules:
+    # docs, locales, __pycache__, logs and the package manager cache
+    block = random.Random(0).randbytes(65536)
+    langs = [ "de", "en_US", "fr", "ja", "zh_CN" ]
+    size  = 0
+    dirs  = set()
+    for i in range(files):
+      kind = i % 20
+      if kind < 2:
+        path = os.path.join("usr/share/doc", "pkg%04d" % (i // 200), "README-%d" % i)
+      elif kind == 2:
+        path = os.path.join("usr/share/locale", langs[i % len(langs)], "LC_MESSAGES", "pkg%d.mo" % i)
+      elif kind == 3:
+        path = os.path.join("usr/lib/python3/site-packages", "mod%04d" % (i // 200), "__pycache__", "m%d.pyc" % i)
+      else:
+        path = os.path.join("usr/lib/bench", "d%04d" % (i // 200), "f%07d" % i)
+      length = (i * 131) % 16384
+      if i % 2 == 0:
+        data = block[(i * 4096) % 49152:][:length]
+      else:
+        data = ((b"imagebuild %08d " % i) * (length // 20 + 1))[:length]
+      fullpath = os.path.join(root, path)
+      if not os.path.dirname(path) in dirs:
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        dirs.add(os.path.dirname(path))
+      with open(fullpath, "wb") as f:
+        f.write(data)
+      size += length
+    for path in [ "var/log/dnf.log", "var/log/hawkey.log", "var/cache/dnf/x86_64/bench/packages/bench-1-1.x86_64.rpm", "var/lib/dnf/history/history.sqlite" ]:
+      fullpath = os.path.join(root, path)
+      os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+      with open(fullpath, "wb") as f:
+        f.write(block)
+      size += len(block)
+    return size
+
+  def stubs(self):
+    # the stubs run with this python and import this script for the tree
+    stub_dir = os.path.join(self.work_dir, "bin")
+    PackageManagerBase().mkdir_p(stub_dir)
+    package_manager = "\n".join([
+      "#!"+sys.executable,
+      "import os, sys",
+      "sys.path.insert(0, "+repr(os.path.dirname(os.path.abspath(__file__)))+")",
+      "import imagebuild",
+      "args = sys.argv[1:]",
+      "root = [ arg.split('=', 1)[1] for arg in args if arg.startswith('--installroot=') ] or [ args[args.index('--root') + 1] ]",
+      "print('Downloading Packages:', flush=True)",
+      "print('Running transaction', flush=True)",
+      "imagebuild.Benchmark(None).tree(root[0], int(os.environ['IMAGEBUILD_BENCH_FILES']))",
+      "print('Complete!')",
+      "" ])
+    docker = "\n".join([
+      "#!"+sys.executable,
+      "import hashlib, sys",
+      "args = sys.argv[1:]",
+      "if args[:2] == [ 'image', 'inspect' ]:",
+      "  sys.exit(1)",
+      "if args[0] in ( 'import', 'load' ):",
+      "  digest = hashlib.sha256()",
+      "  for data in iter(lambda: sys.stdin.buffer.read(1024*1024), b''):",
+      "    digest.update(data)",
+      "  print('sha256:'+digest.hexdigest())",
+      "" ])
+    for name, content in [ ("fake-package-manager", package_manager), ("docker", docker) ]:
+      filename = os.path.join(stub_dir, name)
+      with open(filename, "w") as f:
+        f.write(content)
+      os.chmod(filename, 0o755)
+    return stub_dir
+
+  def measure(self, name, function, setup=None, **info):
+    # setup is not timed; the output of the benchmarked code goes to the log file
+    seconds = []
+    result  = None
+    with open(os.path.join(self.work_dir, "bench.log"), "a") as log:
+      for i in range(self.repeat):
+        with contextlib.redirect_stdout(log):
+          if setup is not None:
+            setup()
+          start  = time.perf_counter()
+          result = function()
+          seconds.append(round(time.perf_counter() - start, 6))
+    entry = dict(info, seconds=seconds, median=round(statistics.median(seconds), 6))
+    if "bytes" in entry:
+      entry["mib_per_second"] = round(entry["bytes"] / 1048576.0 / max(entry["median"], 1e-6), 3)
+    self.results[name] = entry
+    print(name+": "+"%.3f" % entry["median"]+"s"+(", "+"%.1f" % entry["mib_per_second"]+" MiB/s" if "mib_per_second" in entry else ""))
+    return result
+
+  def pipeline(self, files, default_configuration):
+    # the real configure and build, with the fake package manager, docker and oci exports
+    stub_dir = self.stubs()
+    build_root = os.path.join(self.work_dir, "build")
+    profile = os.path.join(self.work_dir, "bench-"+str(files)+".yaml")
+    with open(profile, "w") as f:
+      yaml.safe_dump({
+        "target" : { "os_name": "centos", "os_version": 7, "profile": "bench-"+str(files), "package_manager": "fake",
+                     "package_manager_command": os.path.join(stub_dir, "fake-package-manager"), "package_list": [ "bench" ] },
+        "docker" : { "image": "bench:%build_datetime%", "api": "cli" },
+        "oci"    : { "compression": "gzip" },
+      }, f)
+    default_configuration = copy.deepcopy(default_configuration)
+    default_configuration['work'].update({ "build_root": build_root, "force": 1, "quiet": 1, "package_cache": "" })
+    default_configuration['snapshot'] = { "use": "none" }
+    phases = []
+    def build():
+      installer = Installer()
+      try:
+        installer.build(installer.configure(default_configuration, profile))
+      except SystemExit as exc:
+        raise RuntimeError("pipeline build failed with "+str(exc.code)+", see "+os.path.join(self.work_dir, "bench.log"))
+      phases.append({ event["name"]: event["wall_seconds"] for event in installer.trace.events if event["parent"] is None })
+    environ = dict(os.environ)
+    os.environ["PATH"] = stub_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["IMAGEBUILD_BENCH_FILES"] = str(files)
+    try:
+      self.measure("pipeline-"+str(files), build, files=files)
+    finally:
+      os.environ.clear()
+      os.environ.update(environ)
+    self.results["pipeline-"+str(files)]["phases"] = { name: round(statistics.median(run.get(name, 0.0) for run in phases), 6) for name in phases[0] }
+
+  def merge(self, default_configuration):
+    # a large profile: long package lists, many repositories and custom prune rules
+    profile = {
+      "target" : {
+        "package_list" : [ "package-%d" % i for i in range(20000) ],
+        "repo_url"     : { "repo-%d" % i: "http://mirror.example.com/repo/%d/$basearch" % i for i in range(2000) },
+      },
+      "prune" : { "custom": { "rule-%d" % i: { "path": "usr/share/rule-%d" % i, "maxdepth": 1 } for i in range(2000) } },
+    }
+    filename = os.path.join(self.work_dir, "merge.yaml")
+    with open(filename, "w") as f:
+      yaml.safe_dump(profile, f)
+    # cold parses the profile every repeat, warm is served by the profile cache
+    def clear():
+      profile_resolver.entries = {}
+    self.measure("merge-config-cold", lambda: merge_config(filename, copy.deepcopy(default_configuration)), clear, bytes=os.path.getsize(filename))
+    self.measure("merge-config-warm", lambda: merge_config(filename, copy.deepcopy(default_configuration)), bytes=os.path.getsize(filename))
+    targets = []
+    self.measure("merge-recursive", lambda: merge_recursive(targets[-1], profile), lambda: targets.append(copy.deepcopy(profile)))
+
+  def prune(self, files):
+    root = os.path.join(self.work_dir, "prune")
+    def setup():
+      if os.path.exists(root):
+        shutil.rmtree(root)
+      self.tree(root, files)
+    patch = Patch()
+    patch.target_lang = "en_US.UTF-8"
+    patch.prune       = { "rules": list(Pruner.rules) }
+    self.measure("prune-"+str(files), lambda: patch.clean(root, "dnf"), setup, files=files)
+    shutil.rmtree(root)
+
+  def tar(self, files, names):
+    root = os.path.join(self.work_dir, "tree")
+    size = self.tree(root, files)
+    def write():
+      with open(os.devnull, "wb") as f:
+        return TarStreamWriter().write(root, f)
+    if "tar" in names:
+      self.measure("tar-"+str(files), write, files=files, bytes=size)
+    if "oci" in names:
+      layout = os.path.join(self.work_dir, "oci")
+      self.measure("oci-"+str(files), lambda: OciLayout(layout).export(root, "bench"), lambda: shutil.rmtree(layout, ignore_errors=True), files=files, bytes=size)
+      shutil.rmtree(layout)
+    shutil.rmtree(root)
+
+  def run(self, names, sizes, default_configuration):
+    for name in names:
+      if not name in Benchmark.benchmarks:
+        raise ValueError("unknown benchmark "+name+", known are "+", ".join(Benchmark.benchmarks))
+    if "merge" in names:
+      self.merge(default_configuration)
+    for files in sizes:
+      if "prune" in names:
+        self.prune(files)
+      if "tar" in names or "oci" in names:
+        self.tar(files, names)
+      if "pipeline" in names:
+        self.pipeline(files, default_configuration)
+    return {
+      "start"   : datetime.datetime.now().isoformat(),
+      "host"    : { "machine": os.uname().machine, "cpus": os.cpu_count(), "python": sys.version.split()[0] },
+      "files"   : list(sizes),
+      "repeat"  : self.repeat,
+      "results" : self.results,
+    }
+
+  def compare(self, baseline, threshold=0.2):
+    # slower than the baseline by more than the threshold is a regression
+    regressions = 0
+    for name in sorted(self.results):
+      if not name in baseline.get("results", {}):
+        continue
+      before = baseline["results"][name]["median"]
+      after  = self.results[name]["median"]
+      change = (after - before) / max(before, 1e-6)
+      regression = change > threshold
+      regressions += 1 if regression else 0
+      print(name+": "+"%.3f" % after+"s, baseline "+"%.3f" % before+"s ("+"%+.1f" % (100.0 * change)+"%)"+(" REGRESSION" if regression else ""))
+    return regressions
+
+
+def submit_build(socket_path, profile, force=0):
+  # client of a BuildService: prints the build log, returns the exit code of the build
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  connection.connect(socket_path)
+  with connection, connection.makefile("rwb") as f:
+    f.write((json.dumps({ "action": "build", "profile": os.path.abspath(profile), "force": force })+"\n").encode('utf-8'))
+    f.flush()
+    for line in f:
+      message = json.loads(line)
+      if "log" in message:
+        print(message["log"])
+      elif "error" in message:
+        print("Build service: "+message["error"])
+        return 1
+      elif "result" in message:
+        print(profile+": "+("ok" if message["result"] == 0 else "failed ("+str(message["result"])+")")+" in "+"%.1fs" % message["duration"]+
+              (", shared with another request" if message["shared"] else ""))
+        return message["result"]
+  return 1
+
+
+def command_serve(default_configuration, argv, parsed_args):
+  # imagebuild.py serve [--socket path]
+  pool = BuildPool(parsed_args.jobs, {
+    "download" : parsed_args.download_jobs,
+    "install"  : parsed_args.install_jobs,
+    "export"   : parsed_args.export_jobs,
+  })
+  socket_path = parsed_args.socket or os.path.join(default_configuration['work']['build_root'], "imagebuild.sock")
+  return BuildService(default_configuration, socket_path, pool).serve()
+
+def command_submit(default_configuration, argv, parsed_args):
+  # imagebuild.py submit [--socket path] profile.yaml ...
+  socket_path = parsed_args.socket or os.path.join(default_configuration['work']['build_root'], "imagebuild.sock")
+  results = [ submit_build(socket_path, profile, 1 if parsed_args.force else 0) for profile in argv ]
+  return 1 if any(result != 0 for result in results) else 0
+
+def command_gc(default_configuration, argv, parsed_args):
+  # imagebuild.py gc [--gc-budget size] [--dry-run]
+  work = Installer().configure(default_configuration, "")['work']
+  if not work.get('gc_budget'):
+    print("No budget, use --gc-budget or work.gc_budget in image.yaml")
+    return 1
+  GarbageCollector(work['build_root'], parse_size(work['gc_budget']), work.get('gc_min_age', 3600), parsed_args.dry_run).run()
+  return 0
+
+def command_snapshot(default_configuration, argv, parsed_args):
+  # imagebuild.py snapshot [profile.yaml ...]
+  installer = Installer()
+  default_configuration = copy.deepcopy(default_configuration)
+  default_configuration.setdefault('snapshot', {})['use'] = "none"
+  # builds of an os version use its latest snapshot: the profiles of one os version
+  # share a snapshot with the packages of all of them
+  groups = collections.OrderedDict()
+  for profile in (argv if len(argv) > 0 else [ "" ]):
+    configuration = installer.configure(default_configuration, profile)
+    target = configuration['target']
+    groups.setdefault((configuration['snapshot']['dir'], target['os_name'], str(target['os_version'])), []).append(configuration)
+  for (snapshot_dir, os_name, os_version), configurations in groups.items():
+    configuration = configurations[0]
+    work      = configuration['work']
+    packages  = configuration['snapshot'].get('packages', "closure")
+    repo_list = []
+    repo_url  = {}
+    for other in configurations:
+      repo_list += [ repo_name for repo_name in other['target']['repo_list'] if not repo_name in repo_list ]
+      repo_url.update(other['target'].get('repo_url', {}))
+      if other['snapshot'].get('packages', "closure") != packages:
+        print("Profiles of "+os_name+" "+os_version+" differ in snapshot.packages, using "+str(packages))
+    package_lists = [ other['target']['package_list'] + other['target'].get('package_list_add', []) for other in configurations ]
+    cache = PackageCache(work['package_cache']) if work['package_cache'] != "" else None
+    try:
+      RepoSnapshot(snapshot_dir, os_name, os_version, work.get('http_proxy', ''), cache).create(repo_list, repo_url, packages, package_lists)
+    except (OSError, ValueError) as exc:
+      print("Cannot create the snapshot of "+os_name+" "+os_version+": "+str(exc))
+      return 1
+  return 0
+
+def command_resolve(default_configuration, argv, parsed_args):
+  # imagebuild.py resolve [--warm-cache] [profile.yaml ...]
+  installer = Installer()
+  failed = 0
+  for profile in (argv if len(argv) > 0 else [ "" ]):
+    configuration = installer.configure(default_configuration, profile)
+    target = configuration['target']
+    work   = configuration['work']
+    if target['os_name'] == "alpine":
+      print("Profile "+target['profile']+": resolving is not supported for alpine")
+      failed += 1
+      continue
+    resolver = Resolver()
+    resolver.load_configuration(configuration)
+    packages = resolver.resolve(target['package_list'] + target.get('package_list_add', []))
+    download, installed = resolver.report(packages)
+    if len(resolver.missing) > 0:
+      failed += 1
+    if target.get('size_budget') is not None and installed > parse_size(target['size_budget']):
+      print("Installed size "+format_size(installed)+" exceeds the size budget of "+format_size(parse_size(target['size_budget'])))
+      failed += 1
+    if parsed_args.warm_cache and work['package_cache'] != "":
+      metadata = RepoMetadata(target['os_version'], work.get('http_proxy', ''))
+      resolver.warm_cache(packages, PackageCache(work['package_cache']), metadata, target['package_manager'], target['os_version'])
+  return 1 if failed > 0 else 0
+
+def command_lock(default_configuration, argv, parsed_args):
+  # imagebuild.py lock [profile.yaml ...]
+  installer = Installer()
+  # the lockfile is written here, it need not exist yet
+  default_configuration = copy.deepcopy(default_configuration)
+  default_configuration['work'].pop('locked', None)
+  failed = 0
+  for profile in (argv if len(argv) > 0 else [ "" ]):
+    configuration = installer.configure(default_configuration, profile)
+    target = configuration['target']
+    work   = configuration['work']
+    if target['os_name'] == "alpine" or not 'lockfile' in target:
+      print("Profile "+target['profile']+": no lockfile for alpine or without a profile file")
+      failed += 1
+      continue
+    resolver = Resolver()
+    resolver.load_configuration(configuration)
+    packages = resolver.resolve(target['package_list'] + target.get('package_list_add', []))
+    resolver.report(packages)
+    if len(resolver.missing) > 0:
+      failed += 1
+      continue
+    cache_dir = work['package_cache'] if work['package_cache'] != "" else os.path.join(work['build_root'], "cache", "packages")
+    metadata  = RepoMetadata(target['os_version'], work.get('http_proxy', ''))
+    resolver.warm_cache(packages, PackageCache(cache_dir), metadata, target['package_manager'], target['os_version'])
+    LockFile(target['lockfile']).write(target, packages)
+    record_uses(work['build_dir'], lockfile=target['lockfile'])
+  return 1 if failed > 0 else 0
+
+def command_bench(default_configuration, argv, parsed_args):
+  # imagebuild.py bench [--bench-files 10000,100000] [--repeat n] [--output file] [--baseline file] [benchmark ...]
+  sizes    = [ int(size) for size in parsed_args.bench_files.split(",") ]
+  work_dir = tempfile.mkdtemp(prefix="imagebuild-bench-")
+  try:
+    results = Benchmark(work_dir, parsed_args.repeat).run(argv if len(argv) > 0 else Benchmark.benchmarks, sizes, default_configuration)
+  except (ValueError, RuntimeError) as exc:
+    print(str(exc))
+    return 1
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  output = parsed_args.output or "bench-"+datetime.datetime.now().strftime("%Y%m%d%H%M%S")+".json"
+  with open(output, "w") as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+  print("Results written to "+output)
+  if parsed_args.baseline:
+    with open(parsed_args.baseline) as f:
+      baseline = json.load(f)
+    benchmark = Benchmark(None)
+    benchmark.results = results["results"]
+    if benchmark.compare(baseline, parsed_args.bench_threshold) > 0:
+      return 1
+  return 0
+
+def command_analyze(default_configuration, argv, parsed_args):
+  # imagebuild.py analyze [--diff] [profile.yaml ...]
+  # --diff with one profile compares its published root with the previous one, with two profiles
+  # the published roots of both; the indexes are built for roots without one
+  installer = Installer()
+  profiles  = argv if len(argv) > 0 else [ "" ]
+  indexes   = []
+  for profile in profiles:
+    work = installer.configure(default_configuration, profile)['work']
+    link = work['install_dir']
+    if not os.path.islink(link):
+      print("Profile "+str(profile)+": no published install root in "+work['build_dir'])
+      return 1
+    roots_dir = os.path.join(work['build_dir'], "roots")
+    # the lock keeps a build from replacing the roots while they are indexed
+    with BuildLock(work['build_dir']):
+      current = os.path.basename(os.path.dirname(os.path.realpath(link)))
+      root_ids = [ current ]
+      if parsed_args.diff and len(profiles) == 1:
+        previous = sorted(name for name in os.listdir(roots_dir) if name != current)
+        if len(previous) == 0:
+          print("Profile "+str(profile)+": no previous root to compare with")
+          return 1
+        root_ids.insert(0, previous[-1])
+      for root_id in root_ids:
+        db_file = os.path.join(roots_dir, root_id, "analyze.sqlite")
+        if not os.path.exists(db_file):
+          ImageAnalyzer(os.path.join(roots_dir, root_id, "rootfs"), db_file).index()
+        indexes.append(db_file)
+  if parsed_args.diff:
+    if len(indexes) != 2:
+      print("--diff compares two roots: one profile (previous and current root) or two profiles")
+      return 1
+    print("Comparing "+indexes[0]+" with "+indexes[1])
+    ImageAnalyzer(None, indexes[1]).diff(indexes[0])
+    return 0
+  for db_file in indexes:
+    print("Index "+db_file)
+    ImageAnalyzer(None, db_file).report()
+  return 0
+
+def command_validate(default_configuration, argv, parsed_args):
+  # imagebuild.py validate [profile.yaml|dir ...]
+  start    = time.time()
+  profiles = BuildPool(1, {}).expand_profiles(argv)
+  if profile_resolver.cache_file is None:
+    profile_resolver.cache_file = os.path.join(default_configuration['work']['build_root'], "cache", "profiles.json")
+  failed = 0
+  for profile in profiles:
+    errors = []
+    try:
+      configuration = profile_resolver.resolve(profile)
+      apply_list_operators(configuration)
+      for section in [ "target", "work", "docker", "prune", "snapshot", "dedup" ]:
+        if section in configuration and not isinstance(configuration[section], dict):
+          errors.append(section+" is not a mapping")
+      target = configuration.get("target", {}) if isinstance(configuration.get("target"), dict) else {}
+      for key in [ "package_list", "package_list_add", "repo_list" ]:
+        if key in target and not (isinstance(target[key], list) and all(isinstance(item, str) for item in target[key])):
+          errors.append("target."+key+" is not a list of names")
+      for name in (target['package_manager'] if isinstance(target.get('package_manager'), list) else [ target.get('package_manager', "dnf") ]):
+        if not name in package_manager_backends:
+          errors.append("unknown package manager "+str(name))
+      if isinstance(configuration.get("base"), str) and not os.path.exists(os.path.join(os.path.dirname(os.path.abspath(profile)), configuration["base"])):
+        errors.append("base profile "+configuration["base"]+" not found")
+    except (OSError, ValueError, yaml.YAMLError) as exc:
+      errors.append(str(exc))
+    for error in errors:
+      print(profile+": "+error)
+    failed += 1 if len(errors) > 0 else 0
+  profile_resolver.save()
+  print(str(len(profiles))+" profiles, "+str(failed)+" invalid, resolved in "+"%.1f" % (1000.0 * (time.time() - start))+" ms ("+
+        str(profile_resolver.parsed)+" files parsed, "+str(profile_resolver.hits)+" from the cache)")
+  return 1 if failed > 0 else 0
+
+commands = {
+  "analyze"  : command_analyze,
+  "bench"    : command_bench,
+  "gc"       : command_gc,
+  "lock"     : command_lock,
+  "resolve"  : command_resolve,
+  "serve"    : command_serve,
+  "snapshot" : command_snapshot,
+  "submit"   : command_submit,
+  "validate" : command_validate,
+}
 
 def parse_cmdline():
     parser = argparse.ArgumentParser("imagebuild")
-    parser.add_argument('argv', metavar='argv', nargs='*', help='file')
+    parser.add_argument('argv', metavar='argv', nargs='*', help='profile files or directories of profile files, or a command ('+', '.join(sorted(commands))+') and its arguments')
     parser.add_argument('--build-root', metavar='build_root', default='/var/lib/build', help='build_root')
-    parsed_args = parser.parse_args()
+    parser.add_argument('--snapshot', metavar='id', help='repository snapshot to build from (default: latest, "none" for the configured repositories)')
+    parser.add_argument('--force', action='store_true', help='build even if the inputs did not change since the last build')
+    parser.add_argument('--timeout', metavar='seconds', type=int, help='overall timeout of a build')
+    parser.add_argument('--idle-timeout', metavar='seconds', type=int, help='cancel a command without any output for this time')
+    parser.add_argument('--from-step', metavar='step', help='rebuild from this step (install, patch, dedup, dirs, rpm-import, analyze, docker-import, docker-tag, oci-export)')
+    parser.add_argument('--only-step', metavar='step', help='run only this step, the steps before it must have completed')
+    parser.add_argument('--gc-budget', metavar='size', help='remove least recently used builds and caches below build_root until they fit into this size (e.g. 200G)')
+    parser.add_argument('--dry-run', action='store_true', help='gc: only print what would be removed')
+    parser.add_argument('--socket', metavar='path', help='unix socket of the build service (default: <build_root>/imagebuild.sock)')
+    parser.add_argument('--locked', action='store_true', help='install the exact packages of the lockfile of the profile')
+    parser.add_argument('--warm-cache', action='store_true', help='resolve: download the resolved packages into the package cache')
+    parser.add_argument('--diff', action='store_true', help='analyze: compare the previous and the current root of a profile, or the roots of two profiles')
+    parser.add_argument('--bench-files', metavar='n,...', default='10000,100000', help='bench: number of files of the synthetic roots')
+    parser.add_argument('--repeat', metavar='n', type=int, default=3, help='bench: runs of every benchmark, the median is reported')
+    parser.add_argument('--output', metavar='file', help='bench: json file of the results (default: bench-<datetime>.json)')
+    parser.add_argument('--baseline', metavar='file', help='bench: compare with the results of an earlier run, exit 1 on regressions')
+    parser.add_argument('--bench-threshold', metavar='fraction', type=float, default=0.2, help='bench: slowdown against the baseline which is a regression')
+    parser.add_argument('-q', '--quiet', action='store_true', help='write the output of commands only to the log files')
+    parser.add_argument('-j', '--jobs', metavar='jobs', type=int, default=os.cpu_count(), help='number of profiles built in parallel')
+    parser.add_argument('--download-jobs', metavar='jobs', type=int, default=4, help='number of builds downloading packages at the same time')
+    parser.add_argument('--install-jobs', metavar='jobs', type=int, default=max(1, (os.cpu_count() or 2) // 2), help='number of builds installing packages at the same time')
+    parser.add_argument('--export-jobs', metavar='jobs', type=int, default=1, help='number of builds exporting images at the same time')
+    # options may follow the command: "analyze --diff profile.yaml"
+    parsed_args = parser.parse_intermixed_args()
     return parsed_args
 
 
@@ -784,16 +5306,46 @@ default_configuration = {
 }
 
 if __name__ == "__main__":
-    if os.geteuid() != 0:
-        exit("You need to have root privileges to run this script.\nPlease try again, this time using 'sudo'. Exiting.")
     parsed_args = parse_cmdline()
+    # benchmarks use stand-ins for everything needing root, validation only reads profiles
+    if os.geteuid() != 0 and not parsed_args.argv[:1] in [ [ "bench" ], [ "validate" ] ]:
+        exit("You need to have root privileges to run this script.\nPlease try again, this time using 'sudo'. Exiting.")
   #print(parsed_args)
     if parsed_args.build_root:
         default_configuration['work']['build_root']=parsed_args.build_root
+    if parsed_args.force:
+        default_configuration['work']['force']=1
+    if parsed_args.timeout:
+        default_configuration['work']['timeout']=parsed_args.timeout
+    if parsed_args.idle_timeout:
+        default_configuration['work']['idle_timeout']=parsed_args.idle_timeout
+    if parsed_args.quiet:
+        default_configuration['work']['quiet']=1
+    if parsed_args.locked:
+        default_configuration['work']['locked']=1
+    if parsed_args.gc_budget:
+        default_configuration['work']['gc_budget']=parsed_args.gc_budget
+    if parsed_args.from_step:
+        default_configuration['work']['from_step']=parsed_args.from_step
+    if parsed_args.only_step:
+        default_configuration['work']['only_step']=parsed_args.only_step
+    if parsed_args.snapshot:
+        default_configuration['snapshot']={ 'use': parsed_args.snapshot }
+    if len(parsed_args.argv) > 0 and parsed_args.argv[0] in commands:
+        sys.exit(commands[parsed_args.argv[0]](default_configuration, parsed_args.argv[1:], parsed_args))
     install=Installer()
 
-    if len(parsed_args.argv) > 0:
-        install.main(default_configuration, parsed_args.argv[0])
+    pool     = BuildPool(parsed_args.jobs, {
+      "download" : parsed_args.download_jobs,
+      "install"  : parsed_args.install_jobs,
+      "export"   : parsed_args.export_jobs,
+    })
+    profiles = pool.expand_profiles(parsed_args.argv)
+    if len(profiles) > 1:
+        failed = pool.run(default_configuration, profiles)
+        sys.exit(1 if failed > 0 else 0)
+    elif len(profiles) > 0:
+        install.main(default_configuration, profiles[0])
     else:
         install.main(default_configuration, "")
 
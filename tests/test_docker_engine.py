@@ -0,0 +1,147 @@
+import hashlib
+import http.server
+import json
+import os
+import socketserver
+import threading
+import urllib.parse
+
+import pytest
+
+import imagebuild
+
+
+class DockerEngineStub:
+  # Stand-in of the Docker Engine API on a unix socket. The id of an imported image is the
+  # sha256 of its archive; the repository "fail" gets an error in the progress stream, an
+  # unknown image a 404 with a json message, like the daemon answers.
+  def __init__(self, socket_path):
+    self.socket_path = socket_path
+    self.images      = {}
+    self.archives    = []
+    self.lock        = threading.Lock()
+    self.server      = None
+
+  def read_chunked(self, rfile):
+    digest = hashlib.sha256()
+    size   = 0
+    while True:
+      length = int(rfile.readline().split(b";")[0], 16)
+      if length == 0:
+        rfile.readline()
+        return digest.hexdigest(), size
+      data = rfile.read(length)
+      digest.update(data)
+      size += len(data)
+      rfile.readline()
+
+  def answer(self, handler, status, content=None, lines=None):
+    if lines is not None:
+      body = "".join(json.dumps(line)+"\n" for line in lines).encode('utf-8')
+    else:
+      body = (json.dumps(content)+"\n").encode('utf-8') if content is not None else b''
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+  def handle(self, handler):
+    url   = urllib.parse.urlsplit(handler.path)
+    query = dict(urllib.parse.parse_qsl(url.query))
+    parts = url.path.split("/")
+    if handler.command == "POST" and url.path == "/images/create":
+      digest, size = self.read_chunked(handler.rfile)
+      self.archives.append(size)
+      if query.get("repo") == "fail":
+        message = "archive/tar: invalid tar header"
+        return self.answer(handler, 200, lines=[ { "status": "Importing" }, { "errorDetail": { "message": message }, "error": message } ])
+      image = "sha256:"+digest
+      with self.lock:
+        self.images.setdefault(image, []).append(query["repo"]+":"+query.get("tag", "latest"))
+      return self.answer(handler, 200, lines=[ { "status": "Importing" }, { "status": image } ])
+    if len(parts) == 4 and parts[1] == "images":
+      image = urllib.parse.unquote(parts[2])
+      with self.lock:
+        names = self.images.get(image)
+        if names is None:
+          return self.answer(handler, 404, { "message": "No such image: "+image })
+        if handler.command == "POST" and parts[3] == "tag":
+          names.append(query["repo"]+":"+query.get("tag", "latest"))
+          return self.answer(handler, 201)
+        if handler.command == "GET" and parts[3] == "json":
+          return self.answer(handler, 200, { "Id": image, "RepoTags": list(names) })
+    return self.answer(handler, 404, { "message": "page not found" })
+
+  def start(self):
+    service = self
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        service.handle(self)
+      def do_POST(self):
+        service.handle(self)
+      def log_message(self, format, *args):
+        pass
+
+    self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+    self.server.daemon_threads = True
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+@pytest.fixture
+def daemon(tmp_path):
+  stub = DockerEngineStub(str(tmp_path / "docker.sock")).start()
+  yield stub
+  stub.stop()
+
+
+@pytest.fixture
+def engine(daemon, tmp_path):
+  return imagebuild.DockerEngine(daemon.socket_path, imagebuild.ProcessRunner(log_dir=str(tmp_path / "log"), echo=False), 30)
+
+
+@pytest.fixture
+def rootfs(tmp_path):
+  root = tmp_path / "rootfs"
+  (root / "usr" / "bin").mkdir(parents=True)
+  (root / "usr" / "bin" / "tool").write_bytes(b"#!/bin/sh\n" * 1000)
+  (root / "etc").mkdir()
+  (root / "etc" / "os-release").write_text("ID=test\n")
+  return root
+
+
+def test_import(engine, daemon, rootfs):
+  image = engine.import_rootfs(str(rootfs), "registry:5000/test/image:1")
+  assert image.startswith("sha256:")
+  assert daemon.images[image] == [ "registry:5000/test/image:1" ]
+  assert daemon.archives[-1] > 0
+  # the progress stream is written to the log of the request
+  assert os.path.exists(engine.runner.log_file("docker-import"))
+
+
+def test_tag(engine, rootfs):
+  image = engine.import_rootfs(str(rootfs), "test:1")
+  assert engine.tag(image, "registry:5000/test:latest") == 0
+  assert engine.inspect(image)["RepoTags"] == [ "test:1", "registry:5000/test:latest" ]
+
+
+def test_import_error(engine, rootfs, capsys):
+  assert engine.import_rootfs(str(rootfs), "fail") is None
+  assert "archive/tar: invalid tar header" in capsys.readouterr().out
+
+
+def test_unknown_image(engine, capsys):
+  assert engine.tag("sha256:missing", "test:1") == 1
+  assert "No such image: sha256:missing" in capsys.readouterr().out
+  assert engine.inspect("sha256:missing") is None
+
+
+def test_split_name(engine):
+  assert engine.split_name("registry:5000/repo") == ("registry:5000/repo", "latest")
+  assert engine.split_name("registry:5000/repo:tag") == ("registry:5000/repo", "tag")
+  assert engine.split_name("repo") == ("repo", "latest")
@@ -0,0 +1,57 @@
+import copy
+import hashlib
+import json
+import os
+
+import yaml
+
+import imagebuild
+
+
+def build_locked(tmp_path, monkeypatch, package):
+  # a locked build of the fake package manager, its only package is in a file:// mirror
+  stub_dir = imagebuild.Benchmark(str(tmp_path)).stubs()
+  monkeypatch.setenv("PATH", stub_dir + os.pathsep + os.environ.get("PATH", ""))
+  monkeypatch.setenv("IMAGEBUILD_BENCH_FILES", "10")
+  profile = tmp_path / "locked.yaml"
+  profile.write_text(yaml.safe_dump({
+    "target" : { "os_name": "centos", "os_version": 7, "profile": "locked", "package_manager": "fake",
+                 "package_manager_command": os.path.join(stub_dir, "fake-package-manager"), "package_list": [ "bench" ] },
+  }))
+  default_configuration = copy.deepcopy(imagebuild.default_configuration)
+  default_configuration['work'].update({ "build_root": str(tmp_path / "build"), "quiet": 1, "force": 1 })
+  default_configuration['snapshot'] = { "use": "none" }
+
+  installer = imagebuild.Installer()
+  target = installer.configure(default_configuration, str(profile))['target']
+  lockfile = dict(imagebuild.LockFile(target['lockfile']).inputs(target), packages=[ {
+    "nevra"  : "bench-0:1-1.x86_64",
+    "sha256" : hashlib.sha256(package.read_bytes()).hexdigest(),
+    "size"   : package.stat().st_size,
+    "url"    : package.as_uri(),
+  } ])
+  with open(target['lockfile'], "w") as f:
+    yaml.safe_dump(lockfile, f)
+
+  default_configuration['work']['locked'] = 1
+  configuration = installer.configure(default_configuration, str(profile))
+  installer.build(configuration)
+  with open(imagebuild.BuildMetrics(configuration).history_file) as f:
+    return [ json.loads(line) for line in f ]
+
+
+def test_locked_build_counts_downloads(tmp_path, monkeypatch):
+  package = tmp_path / "mirror" / "bench-1-1.x86_64.rpm"
+  package.parent.mkdir()
+  package.write_bytes(b"bench package\n" * 100)
+
+  history = build_locked(tmp_path, monkeypatch, package)
+  assert history[-1]["exit_status"] == 0
+  assert history[-1]["package_cache"] == { "hits": 0, "misses": 1, "downloaded_bytes": package.stat().st_size }
+  prom = [ name for name in os.listdir(tmp_path / "build" / "metrics") if name.endswith(".prom") ]
+  with open(tmp_path / "build" / "metrics" / prom[0]) as f:
+    assert "imagebuild_downloaded_bytes{" in f.read()
+
+  # the package is in the cache now
+  history = build_locked(tmp_path, monkeypatch, package)
+  assert history[-1]["package_cache"] == { "hits": 1, "misses": 0, "downloaded_bytes": 0 }